@@ -1,18 +1,89 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import serializers, status
+from rest_framework.parsers import JSONParser
+from django.conf import settings
+from django.core import signing
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from .serializers import *
-from .models import Campaign, Variant
-from .utils import sim_page_visits
-from .simulation import experiment
+from .models import Campaign, SimulationJob, Variant
+from .jobs import submit
+from .buffer import record_response, record_responses
+from .parsers import NDJSONParser
+from .snapshot import get_campaign
+from .tokens import first_response, read_token
+from .utils import ab_assign_batch, sim_page_visits
+from .simulation import (PAYLOADS, compact_dataset, experiment, iter_experiment,
+                         iter_payload, log_checkpoints)
+import json
+import uuid
 
 
+def is_async(request):
+    """ True if the ``async`` query parameter asks for the simulation to
+    run as a job, see the ``jobs`` module.
+    """
+    return request.query_params.get('async', '').lower() in ('1', 'true')
+
+def runs_in_request(N):
+    """ True if a simulation of ``N`` visits is short enough to run in the
+    request, see the ``ABTEST_SIM_SYNC_MAX_N`` setting. Longer simulations
+    are run as jobs so that they do not hold a web worker.
+    """
+    return N <= getattr(settings, 'ABTEST_SIM_SYNC_MAX_N', 10000)
+
+def simulation_checkpoints(N, points=None):
+    """ Checkpoints of a simulation of ``N`` visits. ``points`` log-spaced
+    checkpoints if given, else the default ``CHECKPOINTS``, which are 
+    spaced for 10000 visits, or 50 log-spaced checkpoints for other ``N``.
+    """
+    if points is None and N == 10000:
+        return None
+    return log_checkpoints(N, points=points or 50)
+
+def token_counts(campaign, token_vars, register_impression, register_conversion):
+    """ Impressions and conversions to add for a response carrying a
+    token. Campaigns without ``allow_repeat`` count the first impression
+    and conversion of the visitor only, see ``tokens.first_response``.
+    """
+    if campaign.allow_repeat:
+        return int(register_impression), int(register_conversion)
+    campaign_code, visitor_id = token_vars['c'], token_vars['u']
+    impressions = int(
+        bool(register_impression) 
+        and first_response(campaign_code, visitor_id, 'i')
+    )
+    conversions = int(
+        bool(register_conversion) 
+        and first_response(campaign_code, visitor_id, 'c')
+    )
+    return impressions, conversions
+
+def job_submitted(request, job):
+    """ 202 response with the id and status URL of a submitted job.
+    """
+    return Response(
+        {
+            'job': str(job.pk),
+            'status': job.status,
+            'status_url': request.build_absolute_uri(
+                reverse('JobStatus', args=[job.pk])
+            ),
+        },
+        status=status.HTTP_202_ACCEPTED,
+    )
+
 class ABResponse(APIView):
 
     """ API to collect responses from users.
     This API registers the impressions generated from page views 
     and is also used to register conversions.
     AJAX call to be made using Javascript in the A/B test page. 
+
+    Responses to variants assigned by stateless assignment carry the
+    ``token`` returned by ``ab_assign`` instead of relying on the session,
+    see the ``tokens`` module.
     """
 
     def post(self, request, format=None):
@@ -25,9 +96,28 @@ class ABResponse(APIView):
             register_impression = serializer.data.get('register_impression')
             register_conversion = serializer.data.get('register_conversion')
             params = serializer.data.get('params')
+            token = serializer.data.get('token')
+
+            token_vars = None
+            if token:
+                try:
+                    token_vars = read_token(token)
+                except signing.BadSignature:
+                    return Response(
+                        {'details':'Invalid or expired token'}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                if campaign_code not in (None, token_vars['c']) or \
+                        variant_code not in (None, token_vars['v']):
+                    return Response(
+                        {'details':'Token does not match campaign or variant'}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                campaign_code = token_vars['c']
+                variant_code = token_vars['v']
 
             try:
-                campaign = Campaign.objects.get(code=campaign_code)
+                campaign = get_campaign(code=campaign_code)
             except Campaign.DoesNotExist:
                 return Response(
                     {'details':'Campaign not found'}, 
@@ -37,15 +127,12 @@ class ABResponse(APIView):
             if campaign.active == False:
                 return Response({'details':'Campaign is inactive'})
 
-            try:
-                variant = Variant.objects.get(
-                    code=variant_code,
-                    campaign=campaign,
-                )
-            except Variant.DoesNotExist:
-                return Response(
-                    {'details':'Variant not found'}, 
-                    status=status.HTTP_404_NOT_FOUND
+            if token_vars is not None:
+                return self.post_token(
+                    campaign, 
+                    token_vars, 
+                    register_impression, 
+                    register_conversion,
                 )
 
             session_vars = request.session.get(campaign_code)
@@ -68,23 +155,31 @@ class ABResponse(APIView):
             if campaign.allow_repeat:
                 # When repeated impressions and conversions are allowed for 
                 # The same user/session
-                variant.impressions = variant.impressions + int(register_impression)
-                variant.conversions = variant.conversions + int(register_conversion)
-                variant.conversion_rate = variant.conversions / variant.impressions
-                variant.save()
+                impressions = int(register_impression)
+                conversions = int(register_conversion)
             else:
                 # Not allowing repeated impressions / conversions
-
+                impressions = 0
+                conversions = 0
                 if session_impressions == 1:
                     # Add to variant impressions as this is first impression
-                    variant.impressions = variant.impressions + int(register_impression)
+                    impressions = int(register_impression)
                 if session_conversions == 0 and register_conversion:
                     # Add to variant conversions as this is first conversion
-                    variant.conversions = variant.conversions + int(register_conversion)
+                    conversions = int(register_conversion)
+
+            found = record_response(
+                campaign,
+                variant_code,
+                impressions=impressions,
+                conversions=conversions,
+            )
+            if not found:
+                return Response(
+                    {'details':'Variant not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
 
-                variant.conversion_rate = variant.conversions / variant.impressions
-                variant.save()
-                
             ## Update session impressions / conversions
             request.session[campaign_code]['i'] = session_impressions + int(register_impression)
             request.session[campaign_code]['c'] = session_conversions + int(register_conversion)
@@ -92,8 +187,152 @@ class ABResponse(APIView):
 
             return Response({'details':'Response registered'})
 
+    def post_token(self, campaign, token_vars, register_impression, 
+                   register_conversion):
+        """ Registers a response carrying a token, without the session.
+        """
+        impressions, conversions = token_counts(
+            campaign, token_vars, register_impression, register_conversion
+        )
+        found = record_response(
+            campaign,
+            token_vars['v'],
+            impressions=impressions,
+            conversions=conversions,
+        )
+        if not found:
+            return Response(
+                {'details':'Variant not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response({'details':'Response registered'})
+
+class BatchResponseAPI(APIView):
+
+    """ API to register many responses in one request, i.e. from client
+    SDKs batching events or log shippers. Accepts a JSON array, or newline
+    delimited JSON, of responses in the format of ``ABResponse``, across
+    any number of campaigns. The responses are validated one by one, and
+    the impressions and conversions of the valid ones are aggregated per 
+    variant and written in a single statement (see 
+    ``buffer.record_responses``). Returns a result per response, in order.
+
+    Without a session, responses to campaigns that do not allow repeats 
+    must carry a ``token``.
+    """
+
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request, format=None):
+
+        events = request.data
+        if not isinstance(events, list):
+            return Response(
+                {'details':'Expected an array of responses'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_events = getattr(settings, 'ABTEST_BATCH_MAX_EVENTS', 10000)
+        if len(events) > max_events:
+            return Response(
+                {'details':f'At most {max_events} responses per request'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Validate, and resolve the campaign and variant of each response
+        results = [None] * len(events)
+        responses = []
+        for index, event in enumerate(events):
+            serializer = ABResponseSerializer(data=event)
+            if not serializer.is_valid():
+                results[index] = {'registered': False, 'errors': serializer.errors}
+                continue
+            data = dict(serializer.validated_data)
+            token_vars = None
+            if data.get('token'):
+                try:
+                    token_vars = read_token(data['token'])
+                except signing.BadSignature:
+                    results[index] = {
+                        'registered': False, 'details': 'Invalid or expired token'
+                    }
+                    continue
+                if data.get('campaign_code') not in (None, token_vars['c']) or \
+                        data.get('variant_code') not in (None, token_vars['v']):
+                    results[index] = {
+                        'registered': False, 
+                        'details': 'Token does not match campaign or variant',
+                    }
+                    continue
+                data['campaign_code'] = token_vars['c']
+                data['variant_code'] = token_vars['v']
+            responses.append((index, data, token_vars))
+
+        # Campaign codes parsed once per distinct code, None if invalid
+        campaign_codes = {}
+        for index, data, token_vars in responses:
+            code = data['campaign_code']
+            if code not in campaign_codes:
+                try:
+                    campaign_codes[code] = uuid.UUID(code)
+                except ValueError:
+                    campaign_codes[code] = None
+        campaigns = {
+            campaign.code: campaign 
+            for campaign in Campaign.objects.filter(
+                code__in=[code for code in campaign_codes.values() if code]
+            )
+        }
+        variants = set(
+            Variant.objects.filter(campaign__in=campaigns.values())
+            .values_list('campaign_id', 'code')
+        )
+
+        deltas = {}
+        for index, data, token_vars in responses:
+            campaign = campaigns.get(campaign_codes[data['campaign_code']])
+            if campaign is None:
+                details = 'Campaign not found'
+            elif campaign.active == False:
+                details = 'Campaign is inactive'
+            elif (campaign.pk, data['variant_code']) not in variants:
+                details = 'Variant not found'
+            elif token_vars is None and not campaign.allow_repeat:
+                details = 'Token required for campaigns without repeats'
+            else:
+                details = None
+            if details:
+                results[index] = {'registered': False, 'details': details}
+                continue
+
+            if token_vars is not None:
+                impressions, conversions = token_counts(
+                    campaign, 
+                    token_vars, 
+                    data['register_impression'], 
+                    data['register_conversion'],
+                )
+            else:
+                impressions = int(data['register_impression'])
+                conversions = int(data['register_conversion'])
+            delta = deltas.setdefault((campaign.pk, data['variant_code']), [0, 0])
+            delta[0] += impressions
+            delta[1] += conversions
+            results[index] = {'registered': True}
+
+        record_responses(deltas)
+
+        return Response({
+            'registered': sum(result['registered'] for result in results),
+            'results': results,
+        })
+
 class SimPageVisitsAPI(APIView):
 
+    """ API to simulate page visits to a campaign. With the ``async``
+    query parameter, the visits are simulated by a job and the id of the
+    job is returned, see ``JobStatusAPI``.
+    """
+
     def post(self, request, forma=None):
 
         serializer = SimPageVisitsSerializer(data=request.data)
@@ -116,6 +355,15 @@ class SimPageVisitsAPI(APIView):
                     {'details':'Campaign does not exist'},
                     status=status.HTTP_404_NOT_FOUND
                 )
+            if is_async(request):
+                job = submit(SimulationJob.PAGE_VISITS, {
+                    'campaign_code': str(campaign.code),
+                    'conversion_rates': conversion_rates,
+                    'n': n,
+                    'algo': algo,
+                })
+                return job_submitted(request, job)
+
             sim_page_visits(
                 campaign, 
                 conversion_rates=conversion_rates, 
@@ -126,8 +374,66 @@ class SimPageVisitsAPI(APIView):
             return Response({'details':'Page visits simulated'})
 
 
+class AssignBatchAPI(APIView):
+
+    """ API to assign variants to many users at once, i.e. for server
+    side rendering or email / push sends. Returns a list of variant codes
+    when ``n`` is provided, or a mapping of user id to variant code when
+    ``user_ids`` is provided.
+    """
+
+    def post(self, request, format=None):
+
+        serializer = AssignBatchSerializer(data=request.data)
+        if serializer.is_valid(raise_exception=True):
+
+            campaign_code = serializer.data.get('campaign_code')
+            n = serializer.data.get('n')
+            user_ids = serializer.data.get('user_ids')
+            algo = serializer.data.get('algo')
+            eps = serializer.data.get('eps', 0.1)
+
+            if algo not in ['uniform', 'thompson', 'egreedy', 'UCB1']:
+                return Response(
+                    {'details':'Invalid algorithm provided'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            try:
+                campaign = get_campaign(code=campaign_code)
+            except Campaign.DoesNotExist:
+                return Response(
+                    {'details':'Campaign does not exist'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            if campaign.active == False:
+                return Response({'details':'Campaign is inactive'})
+
+            variant_codes = ab_assign_batch(
+                campaign,
+                n=n,
+                user_ids=user_ids,
+                algo=algo,
+                eps=eps,
+            ).tolist()
+            if user_ids is not None:
+                assignments = dict(zip(user_ids, variant_codes))
+            else:
+                assignments = variant_codes
+
+            return Response({'assignments':assignments})
+
+
 class RunSimulation(APIView):
 
+    """ API to run a simulated A/B/C test. The format of the checkpoints
+    returned is selected with the ``payload`` query parameter: 
+    ``full`` (default) returns the checkpoints of ``experiment``, 
+    ``compact`` and ``params`` return ``simulation.compact_dataset`` with
+    and without the curves. With the ``async`` query parameter, or when
+    ``N`` is above ``ABTEST_SIM_SYNC_MAX_N``, the simulation is run by a
+    job and the id of the job is returned, see ``JobStatusAPI``.
+    """
+
     def post(self, request, format=None):
 
         serializer = SimulationSerializer(data=request.data)
@@ -138,19 +444,140 @@ class RunSimulation(APIView):
             p3 = serializer.data.get('p3')
             algo = serializer.data.get('algo')
             eps = serializer.data.get('eps', 0.1)
+            N = serializer.data.get('N', 10000)
+            payload = request.query_params.get('payload', 'full')
+            checkpoints = simulation_checkpoints(N, serializer.data.get('checkpoints'))
 
             if algo not in ['uniform', 'thompson', 'egreedy', 'UCB1']:
                 return Response(
                     {'details':'Invalid algorithm provided'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            if payload not in PAYLOADS:
+                return Response(
+                    {'details':'Invalid payload provided'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if is_async(request) or not runs_in_request(N):
+                job = submit(SimulationJob.SIMULATION, {
+                    'rates': [p1, p2, p3],
+                    'N': N,
+                    'algo': algo,
+                    'eps': eps,
+                    'checkpoints': checkpoints,
+                    'payload': payload,
+                })
+                return job_submitted(request, job)
+
             data = experiment(
                 p1=p1,
                 p2=p2,
                 p3=p3,
-                N=10000,
+                N=N,
                 algo=algo,
                 eps=eps,
+                checkpoints=checkpoints,
+                curves=payload == 'full',
             )  
+            if payload != 'full':
+                data = compact_dataset(data, curves=payload == 'compact')
 
             return Response(data)
+
+
+class StreamSimulation(APIView):
+
+    """ API to run a simulated A/B/C test, streaming the checkpoints as
+    newline delimited JSON as soon as they are reached, so that the client
+    can plot the first checkpoints while the simulation runs. The format
+    of each checkpoint is selected with the ``payload`` query parameter,
+    see ``simulation.iter_payload``. Simulations of more than 
+    ``ABTEST_SIM_SYNC_MAX_N`` visits are rejected, run them as a job with
+    ``RunSimulation`` instead.
+    """
+
+    def post(self, request, format=None):
+
+        serializer = SimulationSerializer(data=request.data)
+        if serializer.is_valid(raise_exception=True):
+
+            p1 = serializer.data.get('p1')
+            p2 = serializer.data.get('p2')
+            p3 = serializer.data.get('p3')
+            algo = serializer.data.get('algo')
+            eps = serializer.data.get('eps', 0.1)
+            N = serializer.data.get('N', 10000)
+            payload = request.query_params.get('payload', 'full')
+            checkpoints = simulation_checkpoints(N, serializer.data.get('checkpoints'))
+
+            if algo not in ['uniform', 'thompson', 'egreedy', 'UCB1']:
+                return Response(
+                    {'details':'Invalid algorithm provided'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if payload not in PAYLOADS:
+                return Response(
+                    {'details':'Invalid payload provided'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if not runs_in_request(N):
+                return Response(
+                    {'details':'N too large to stream, run the simulation as a job'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            dataset = iter_experiment(
+                [p1, p2, p3],
+                N=N,
+                algo=algo,
+                eps=eps,
+                checkpoints=checkpoints,
+                curves=payload == 'full',
+            )
+            response = StreamingHttpResponse(
+                (json.dumps(data) + '\n' for data in iter_payload(dataset, payload)),
+                content_type='application/x-ndjson',
+            )
+            # Ask proxies such as nginx not to buffer the stream
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+
+class JobStatusAPI(APIView):
+
+    """ API to poll the status and progress of a simulation job. The
+    checkpoints recorded so far are returned from the index given by the
+    ``since`` query parameter, so that a client polling the job receives
+    each checkpoint once. The result is returned once the job is done.
+    """
+
+    def get(self, request, job_id, format=None):
+
+        try:
+            job = SimulationJob.objects.get(pk=job_id)
+        except SimulationJob.DoesNotExist:
+            return Response(
+                {'details':'Job not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        try:
+            since = max(int(request.query_params.get('since', 0)), 0)
+        except ValueError:
+            return Response(
+                {'details':'Invalid since provided'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        checkpoints = json.loads(job.checkpoints)
+        data = {
+            'job': str(job.pk),
+            'kind': job.kind,
+            'status': job.status,
+            'progress': job.progress,
+            'checkpoints': checkpoints[since:],
+            'next': len(checkpoints),
+        }
+        if job.status == SimulationJob.DONE:
+            data['result'] = json.loads(job.result)
+        if job.status == SimulationJob.FAILED:
+            data['error'] = job.error
+        return Response(data)
+
@@ -0,0 +1,293 @@
+""" The buffer module contains a write-behind accumulator for variant
+impressions and conversions.
+
+Instead of issuing one ``UPDATE`` per response beacon, responses are
+coalesced in memory into per (campaign, variant) deltas and written to
+the database in a single bulk statement every ``ABTEST_BUFFER_FLUSH_MS``
+milliseconds or every ``ABTEST_BUFFER_MAX_EVENTS`` events, whichever
+comes first. See ``record_response`` for the entry point used by the
+response API.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db import close_old_connections
+from .counters import bulk_increment, counters_flushed, increment_variant
+from .models import Variant
+from .snapshot import get_variant_values
+
+logger = logging.getLogger(__name__)
+
+BOUNDED_LOSS = 'bounded-loss'
+AT_LEAST_ONCE = 'at-least-once'
+
+
+class EventBuffer:
+    """ In-process accumulator of variant counter deltas.
+
+    The buffer is thread safe. Deltas are flushed with
+    ``counters.bulk_increment``, i.e. one ``UPDATE`` statement for all
+    variants that received events since the last flush.
+
+    Two delivery modes are available:
+
+        * *bounded-loss* : A batch that fails to be written is logged and
+          dropped. At most ``max_events`` events (or ``flush_interval``
+          seconds worth of events) can be lost.
+        * *at-least-once* : A batch that fails to be written is merged back
+          into the buffer and retried on the next flush. A batch may be
+          applied twice if the database commits but the connection fails
+          before the result is received.
+
+    In both modes, events still held in memory are lost if the process is
+    killed without running its shutdown hooks (see ``worker_exit``).
+    """
+
+    def __init__(self, max_events=500, flush_interval=0.5,
+                 mode=BOUNDED_LOSS, background=True):
+        """
+        Parameters
+        ----------
+        max_events : int, optional
+            Number of buffered events which triggers a flush. Defaults to 500
+        flush_interval : float, optional
+            Maximum number of seconds an event is held in the buffer.
+            Defaults to 0.5
+        mode : str, optional
+            Delivery mode, ``bounded-loss`` or ``at-least-once``.
+            Defaults to ``bounded-loss``
+        background : bool, optional
+            If True, a daemon thread flushes the buffer every
+            ``flush_interval`` seconds even when no new events arrive.
+            Defaults to True
+        """
+        if mode not in (BOUNDED_LOSS, AT_LEAST_ONCE):
+            raise ValueError(f'Invalid buffer mode: {mode}')
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self.mode = mode
+        self.background = background
+        self._deltas = defaultdict(lambda: [0, 0])
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return self._pending
+
+    def add(self, campaign_id, variant_code, impressions=0, conversions=0):
+        """ Add an event to the buffer. Flushes the buffer if
+        ``max_events`` or ``flush_interval`` is reached.
+
+        Parameters
+        ----------
+        campaign_id : int
+            Primary key of the A/B test Campaign
+        variant_code : str
+            Code of the variant (i.e., A, B, C etc)
+        impressions : int, optional
+            Number of impressions to add. Defaults to 0
+        conversions : int, optional
+            Number of conversions to add. Defaults to 0
+        """
+        if self.background and self._thread is None:
+            self._start()
+        with self._lock:
+            delta = self._deltas[(campaign_id, variant_code)]
+            delta[0] += impressions
+            delta[1] += conversions
+            self._pending += 1
+            due = (
+                self._pending >= self.max_events or
+                time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered deltas to the database in one statement.
+
+        Returns
+        -------
+        int
+            Number of variant rows updated.
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas = self._deltas
+                pending = self._pending
+                self._deltas = defaultdict(lambda: [0, 0])
+                self._pending = 0
+                self._last_flush = time.monotonic()
+            if not deltas:
+                return 0
+            try:
+                updated = bulk_increment(deltas)
+            except Exception:
+                if self.mode == AT_LEAST_ONCE:
+                    logger.exception('Variant counter flush failed, retrying later')
+                    with self._lock:
+                        for key, (impressions, conversions) in deltas.items():
+                            delta = self._deltas[key]
+                            delta[0] += impressions
+                            delta[1] += conversions
+                        self._pending += pending
+                else:
+                    logger.exception(
+                        'Variant counter flush failed, dropped %d events', pending
+                    )
+                return 0
+        counters_flushed.send(sender=Variant)
+        return updated
+
+    def close(self):
+        """ Stop the background thread and flush remaining events.
+        """
+        self._stopped.set()
+        self.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name='abtest-event-buffer',
+                daemon=True,
+            )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            if time.monotonic() - self._last_flush < self.flush_interval:
+                continue
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Background flush of variant counters failed')
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    """ Returns the event buffer of the current process, or None if
+    buffering is disabled with the ``ABTEST_BUFFER_ENABLED`` setting.
+
+    A new buffer is created after a fork, so gunicorn workers never share
+    the buffer (or background thread) of the master process.
+    """
+    global _buffer, _buffer_pid
+    if not getattr(settings, 'ABTEST_BUFFER_ENABLED', False):
+        return None
+    if _buffer is None or _buffer_pid != os.getpid():
+        with _buffer_lock:
+            if _buffer is None or _buffer_pid != os.getpid():
+                _buffer = EventBuffer(
+                    max_events=getattr(settings, 'ABTEST_BUFFER_MAX_EVENTS', 500),
+                    flush_interval=getattr(settings, 'ABTEST_BUFFER_FLUSH_MS', 500) / 1000,
+                    mode=getattr(settings, 'ABTEST_BUFFER_MODE', BOUNDED_LOSS),
+                )
+                _buffer_pid = os.getpid()
+                atexit.register(_buffer.close)
+    return _buffer
+
+def flush_buffer():
+    """ Flush the event buffer of the current process, if any.
+
+    Returns
+    -------
+    int
+        Number of variant rows updated.
+    """
+    if _buffer is None or _buffer_pid != os.getpid():
+        return 0
+    return _buffer.flush()
+
+def worker_exit(server, worker):
+    """ gunicorn ``worker_exit`` server hook. Flushes the buffered events
+    of a worker before it shuts down. See ``gunicorn.conf.py``.
+    """
+    flush_buffer()
+
+def record_response(campaign, variant_code, impressions=0, conversions=0):
+    """ Register impressions / conversions for a variant.
+
+    Events are added to the event buffer when ``ABTEST_BUFFER_ENABLED``
+    is set, otherwise they are written immediately with
+    ``counters.increment_variant``. Buffered events are checked against
+    the cached variant values of the campaign (see the snapshot module),
+    so that only codes missing from the snapshot need a database query.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign`
+        A/B test Campaign model object
+    variant_code : str
+        Code of the variant (i.e., A, B, C etc)
+    impressions : int, optional
+        Number of impressions to add. Defaults to 0
+    conversions : int, optional
+        Number of conversions to add. Defaults to 0
+
+    Returns
+    -------
+    bool
+        False if the variant does not exist.
+    """
+    event_buffer = get_buffer()
+    if (impressions or conversions) and event_buffer is None:
+        # Written immediately with a single atomic UPDATE statement
+        return bool(increment_variant(
+            campaign,
+            variant_code,
+            impressions=impressions,
+            conversions=conversions,
+        ))
+
+    found = any(
+        var['code'] == variant_code for var in get_variant_values(campaign)
+    ) or Variant.objects.filter(
+        # Variants created since the snapshot was cached
+        campaign=campaign,
+        code=variant_code,
+    ).exists()
+    if found and (impressions or conversions):
+        event_buffer.add(campaign.pk, variant_code, impressions, conversions)
+    return found
+
+def record_responses(deltas):
+    """ Register impressions / conversions for many variants at once.
+
+    Deltas are added to the event buffer when ``ABTEST_BUFFER_ENABLED``
+    is set, otherwise they are written immediately with a single
+    ``counters.bulk_increment`` statement.
+
+    Parameters
+    ----------
+    deltas : dict: ``{(campaign_id, variant_code): (impressions, conversions)}``
+        Mapping of campaign primary key and variant code to the number of
+        impressions and conversions to add.
+
+    Returns
+    -------
+    int
+        Number of variants with impressions or conversions to add.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    event_buffer = get_buffer()
+    if event_buffer is None:
+        return bulk_increment(deltas)
+    for (campaign_id, variant_code), (impressions, conversions) in deltas.items():
+        event_buffer.add(campaign_id, variant_code, impressions, conversions)
+    return len(deltas)
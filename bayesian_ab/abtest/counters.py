@@ -0,0 +1,301 @@
+""" The counters module contains the database write paths for the
+impression and conversion counters of ``Variant`` objects.
+
+Counters are never updated by reading a ``Variant``, adding to its fields
+in Python and saving it back. Every update is issued as a single
+``UPDATE ... SET impressions = impressions + n`` statement so that
+increments from concurrent workers are never lost, and the row lock is
+only held for the duration of that one statement.
+
+Optionally, increments can be spread across ``ABTEST_COUNTER_SHARDS``
+``VariantCounterShard`` rows per variant, so that concurrent writers do
+not all contend on the lock of a single ``Variant`` row. Shard totals are
+added to the variant counters when they are read with ``variant_values``
+and folded into the ``Variant`` rows by ``materialize_shards``.
+"""
+
+import os
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import (Case, F, FloatField, IntegerField, Q, Sum,
+                              Value, When)
+from django.db.models.functions import Cast, Coalesce, Greatest
+from django.dispatch import Signal
+from .models import Variant, VariantCounterShard
+from .rng import get_buffer
+
+# Sent when deferred counter updates (buffered events, counter shards)
+# have been written to the Variant rows
+counters_flushed = Signal()
+
+
+def counter_updates(impressions=0, conversions=0):
+    """Build the ``update()`` keyword arguments that atomically add
+    ``impressions`` and ``conversions`` to a Variant row and recompute
+    its ``conversion_rate`` in SQL.
+
+    Parameters
+    ----------
+    impressions : int or :obj:`Expression`
+        Number of impressions to add
+    conversions : int or :obj:`Expression`
+        Number of conversions to add
+
+    Returns
+    -------
+    dict
+        Mapping of ``Variant`` field names to database expressions,
+        to be passed to ``QuerySet.update``.
+    """
+    new_impressions = F('impressions') + impressions
+    new_conversions = F('conversions') + conversions
+    return {
+        'impressions': new_impressions,
+        'conversions': new_conversions,
+        # Right hand side column references see the pre-update row, so
+        # the rate is computed from the incremented values explicitly.
+        # Cast avoids integer division, Greatest avoids division by zero
+        # after the counters have been cleared.
+        'conversion_rate': (
+            Cast(new_conversions, FloatField()) /
+            Cast(Greatest(new_impressions, 1), FloatField())
+        ),
+    }
+
+def increment_variant(campaign, variant_code, impressions=0, conversions=0):
+    """Atomically add impressions / conversions to a variant.
+
+    Issues a single ``UPDATE`` statement for the variant row, so no
+    increments are lost when several workers register responses for the
+    same variant concurrently. When ``ABTEST_COUNTER_SHARDS`` is set,
+    the increment is applied to one of the variant's counter shards
+    instead (see ``increment_shard``).
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign` or int
+        A/B test Campaign model object (or its primary key)
+    variant_code : str
+        Code of the variant to update (i.e., A, B, C etc)
+    impressions : int, optional
+        Number of impressions to add. Defaults to 0
+    conversions : int, optional
+        Number of conversions to add. Defaults to 0
+
+    Returns
+    -------
+    int
+        Number of rows updated. 0 if the variant does not exist.
+
+    Examples
+    --------
+    >>> increment_variant(campaign, 'A', impressions=1, conversions=0)
+    1
+    """
+    if getattr(settings, 'ABTEST_COUNTER_SHARDS', 0):
+        return increment_shard(campaign, variant_code, impressions, conversions)
+
+    return Variant.objects.filter(
+        campaign=campaign,
+        code=variant_code,
+    ).update(**counter_updates(impressions, conversions))
+
+def bulk_increment(deltas):
+    """Atomically apply impression / conversion deltas to many variants
+    in one ``UPDATE`` statement.
+
+    The per-variant deltas are expressed as ``CASE WHEN`` expressions,
+    so any number of variants across any number of campaigns are updated
+    with a single round trip to the database.
+
+    Parameters
+    ----------
+    deltas : dict: ``{(campaign_id, variant_code): (impressions, conversions)}``
+        Mapping of campaign primary key and variant code to the number of
+        impressions and conversions to add.
+
+    Returns
+    -------
+    int
+        Number of rows updated.
+
+    Examples
+    --------
+    >>> bulk_increment({
+    ...     (1, 'A'): (120, 14),
+    ...     (1, 'B'): (98, 21),
+    ... })
+    2
+    """
+    if not deltas:
+        return 0
+
+    condition = Q()
+    impression_cases = []
+    conversion_cases = []
+    for (campaign_id, variant_code), (impressions, conversions) in deltas.items():
+        match = Q(campaign_id=campaign_id, code=variant_code)
+        condition |= match
+        impression_cases.append(When(match, then=Value(int(impressions))))
+        conversion_cases.append(When(match, then=Value(int(conversions))))
+
+    return Variant.objects.filter(condition).update(**counter_updates(
+        Case(*impression_cases, default=Value(0), output_field=IntegerField()),
+        Case(*conversion_cases, default=Value(0), output_field=IntegerField()),
+    ))
+
+def shard_index(shards):
+    """ Returns the shard that the current process writes to.
+
+    With the default ``ABTEST_COUNTER_SHARD_BY = 'pid'``, each worker
+    process writes to its own shard (as long as there are at least as
+    many shards as workers), so workers never wait on each other's row
+    locks. With ``'random'`` a shard is picked at random per increment.
+    """
+    if getattr(settings, 'ABTEST_COUNTER_SHARD_BY', 'pid') == 'random':
+        return get_buffer().integers(shards)
+    return os.getpid() % shards
+
+def increment_shard(campaign, variant_code, impressions=0, conversions=0):
+    """Atomically add impressions / conversions to one of the
+    ``VariantCounterShard`` rows of a variant.
+
+    The shard row is created on first use.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign` or int
+        A/B test Campaign model object (or its primary key)
+    variant_code : str
+        Code of the variant to update (i.e., A, B, C etc)
+    impressions : int, optional
+        Number of impressions to add. Defaults to 0
+    conversions : int, optional
+        Number of conversions to add. Defaults to 0
+
+    Returns
+    -------
+    int
+        Number of rows updated. 0 if the variant does not exist.
+    """
+    shard = shard_index(settings.ABTEST_COUNTER_SHARDS)
+    updates = {
+        'impressions': F('impressions') + impressions,
+        'conversions': F('conversions') + conversions,
+    }
+    shards = VariantCounterShard.objects.filter(
+        variant__campaign=campaign,
+        variant__code=variant_code,
+        shard=shard,
+    )
+    updated = shards.update(**updates)
+    if updated:
+        return updated
+
+    variant_id = Variant.objects.filter(
+        campaign=campaign,
+        code=variant_code,
+    ).values_list('pk', flat=True).first()
+    if variant_id is None:
+        return 0
+    try:
+        with transaction.atomic():
+            VariantCounterShard.objects.create(
+                variant_id=variant_id,
+                shard=shard,
+                impressions=impressions,
+                conversions=conversions,
+            )
+        return 1
+    except IntegrityError:
+        # Shard row created concurrently by another worker
+        return shards.update(**updates)
+
+def variant_values(campaign):
+    """ Returns the ``Variant`` field values of a campaign, as used by the
+    assignment algorithms in the utils module.
+
+    When counter sharding is enabled, impressions and conversions that
+    are still held in the counter shards are added to the totals.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign`
+        A/B test Campaign model object
+
+    Returns
+    -------
+    list
+        A list of dictionary mappings of Variant field values ``code``
+        ``impressions`` ``conversions`` ``conversion_rate``
+        ``html_template``, ordered by ``code``.
+    """
+    fields = (
+        'code',
+        'impressions',
+        'conversions',
+        'conversion_rate',
+        'html_template',
+    )
+    variants = campaign.variants.all().order_by('code')
+    if not getattr(settings, 'ABTEST_COUNTER_SHARDS', 0):
+        return list(variants.values(*fields))
+
+    variant_vals = list(variants.annotate(
+        shard_impressions=Coalesce(Sum('counter_shards__impressions'), 0),
+        shard_conversions=Coalesce(Sum('counter_shards__conversions'), 0),
+    ).values(*fields, 'shard_impressions', 'shard_conversions'))
+    for var in variant_vals:
+        var['impressions'] += var.pop('shard_impressions')
+        var['conversions'] += var.pop('shard_conversions')
+        var['conversion_rate'] = var['conversions'] / max(var['impressions'], 1)
+    return variant_vals
+
+def materialize_shards(campaign=None):
+    """ Fold the totals of the counter shards into the ``Variant``
+    counters and reset the shards.
+
+    The shard rows are locked for the duration of the transaction, so
+    increments that arrive meanwhile wait and are kept for the next run.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign`, optional
+        Only materialize the counter shards of this campaign.
+        Defaults to all campaigns.
+
+    Returns
+    -------
+    int
+        Number of variant rows updated.
+    """
+    with transaction.atomic():
+        shards = VariantCounterShard.objects.select_for_update(of=('self',)).filter(
+            Q(impressions__gt=0) | Q(conversions__gt=0)
+        )
+        if campaign is not None:
+            shards = shards.filter(variant__campaign=campaign)
+        shard_ids = []
+        deltas = {}
+        for shard in shards.values(
+            'pk',
+            'variant__campaign_id',
+            'variant__code',
+            'impressions',
+            'conversions',
+        ):
+            shard_ids.append(shard['pk'])
+            key = (shard['variant__campaign_id'], shard['variant__code'])
+            impressions, conversions = deltas.get(key, (0, 0))
+            deltas[key] = (
+                impressions + shard['impressions'],
+                conversions + shard['conversions'],
+            )
+        updated = bulk_increment(deltas)
+        VariantCounterShard.objects.filter(pk__in=shard_ids).update(
+            impressions=0,
+            conversions=0,
+        )
+    if updated:
+        counters_flushed.send(sender=Variant)
+    return updated
@@ -0,0 +1,163 @@
+""" The curves module computes the beta distribution PDF curves plotted
+on the dashboard and the simulation page.
+
+All curves are evaluated on x grids of ``points`` evenly spaced values.
+The default grid over [0, 1] is a single shared read-only array. The
+PDFs of all variants are computed in log-space in one vectorized call,
+which does not overflow for the large alpha, beta parameters of
+campaigns with millions of impressions.
+
+When the posterior mass of all variants lies in a small part of [0, 1],
+a uniform grid over [0, 1] places only a few points under the curves and
+misses their peaks. ``adaptive_grid`` narrows the grid to the interval
+holding the posterior mass of the variants instead.
+
+Curves are cached keyed on ``(a, b)`` and the grid, see ``curves``.
+"""
+
+import numpy as np
+from django.conf import settings
+from scipy.special import betaincinv, betaln, xlog1py, xlogy
+from .memo import LRUCache
+
+POINTS = 500
+
+# Posterior mass left out of an adaptive grid at each end
+TAIL = 1e-6
+
+# Adaptive grids narrower than this fraction of [0, 1] are used,
+# otherwise the shared grid over [0, 1] is
+ADAPTIVE_MAX_WIDTH = 0.5
+
+_grids = {}
+
+_curve_cache = LRUCache(getattr(settings, 'ABTEST_DECISION_CACHE_SIZE', 4096))
+
+def grid(points=POINTS, lo=0.0, hi=1.0):
+    """ Read-only grid of ``points`` evenly spaced x values over
+    [``lo``, ``hi``]. Grids over [0, 1] are created once and shared.
+    """
+    if (lo, hi) != (0.0, 1.0):
+        x = np.linspace(lo, hi, points)
+        x.setflags(write=False)
+        return x
+    x = _grids.get(points)
+    if x is None:
+        x = np.linspace(0, 1, points)
+        x.setflags(write=False)
+        _grids[points] = x
+    return x
+
+def log_pdf(x, a, b):
+    """ Log of the PDF of Beta(a, b) at ``x``. Broadcasts over ``x``,
+    ``a`` and ``b``.
+    """
+    return xlogy(a - 1, x) + xlog1py(b - 1, -x) - betaln(a, b)
+
+def pdf(x, a, b):
+    """ PDFs of Beta(a_i, b_i) for all variants, evaluated in log-space
+    in one vectorized call.
+
+    Parameters
+    ----------
+    x : array_like
+        x values, 0 <= x <= 1
+    a : array_like
+        alpha shape parameters of the variants. a >= 1
+    b : array_like
+        beta shape parameters of the variants. b >= 1
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Array of shape ``a.shape + x.shape`` of the PDF values.
+    """
+    a = np.asarray(a, dtype=float)[..., None]
+    b = np.asarray(b, dtype=float)[..., None]
+    return np.exp(log_pdf(np.asarray(x, dtype=float), a, b))
+
+def adaptive_grid(a, b, points=POINTS):
+    """ Grid narrowed to the interval holding all but ``TAIL`` of the
+    posterior mass of every variant at each end, padded by 5% of its
+    width. Falls back to the shared grid over [0, 1] when the interval
+    is wider than ``ADAPTIVE_MAX_WIDTH``.
+
+    Parameters
+    ----------
+    a : array_like
+        alpha shape parameters of the variants. a >= 1
+    b : array_like
+        beta shape parameters of the variants. b >= 1
+    points : int, optional
+        Number of x values. Defaults to 500
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Read-only grid of x values.
+    """
+    lo = float(np.min(betaincinv(a, b, TAIL)))
+    hi = float(np.max(betaincinv(a, b, 1 - TAIL)))
+    pad = 0.05 * (hi - lo)
+    lo, hi = max(lo - pad, 0.0), min(hi + pad, 1.0)
+    if hi - lo > ADAPTIVE_MAX_WIDTH:
+        return grid(points)
+    # Rounded, so that small changes in the counts reuse cached curves
+    digits = 2 - int(np.floor(np.log10(hi - lo)))
+    step = 10.0 ** -digits
+    lo = round(np.floor(lo / step) * step, digits)
+    hi = round(np.ceil(hi / step) * step, digits)
+    return grid(points, float(max(lo, 0.0)), float(min(hi, 1.0)))
+
+def curves(a, b, points=POINTS, adaptive=False):
+    """ Beta PDF curves of all variants on a common grid.
+
+    Curves are cached keyed on ``(a, b)`` and the grid. Curves missing
+    from the cache are computed together in one vectorized call.
+
+    Parameters
+    ----------
+    a : array_like
+        alpha shape parameters of the variants, i.e. conversions. a >= 1
+    b : array_like
+        beta shape parameters of the variants, i.e. impressions -
+        conversions. b >= 1
+    points : int, optional
+        Number of x values. Defaults to 500
+    adaptive : bool, optional
+        If True, the grid is narrowed to the posterior mass of the
+        variants, see ``adaptive_grid``. Defaults to False
+
+    Returns
+    -------
+    x : :obj:`numpy.ndarray`
+        Read-only grid of x values
+    y : :obj:`numpy.ndarray`
+        (variants x points) array of the PDF values.
+
+    Examples
+    --------
+    >>> x, y = curves([20, 25], [180, 175], adaptive=True)
+    >>> x[0], x[-1]
+    (0.016, 0.273)
+    """
+    a = np.atleast_1d(np.asarray(a, dtype=np.int64))
+    b = np.atleast_1d(np.asarray(b, dtype=np.int64))
+    x = adaptive_grid(a, b, points) if adaptive else grid(points)
+    keys = [
+        (a_i, b_i, float(x[0]), float(x[-1]), points)
+        for a_i, b_i in zip(a.tolist(), b.tolist())
+    ]
+    rows = [_curve_cache.get(key) for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        for i, row in zip(missing, pdf(x, a[missing], b[missing])):
+            row.setflags(write=False)
+            _curve_cache.put(keys[i], row)
+            rows[i] = row
+    return x, np.vstack(rows) if rows else np.empty((0, points))
+
+def clear_cache():
+    """ Clear the cached curves.
+    """
+    _curve_cache.clear()
@@ -0,0 +1,323 @@
+""" The dedup module remembers which visitors already produced an
+impression or a conversion, for campaigns that do not allow repeats,
+without storing a session per visitor (see ``tokens.first_response``).
+
+Visitors are added to a per-campaign rotating Bloom filter, with one key
+for the impression and one for the conversion of a visitor. A Bloom
+filter never forgets a key it has seen, but reports an unseen key as
+seen, so drops its response, with probability ``ABTEST_DEDUP_ERROR_RATE``.
+Its memory is fixed: about 2 bytes per key, so 4 bytes per visitor, for
+an error rate of 0.001, independent of the length of the visitor ids.
+
+A filter holds two generations of ``ABTEST_DEDUP_CAPACITY`` visitors,
+each sized for two keys per visitor.
+When the current generation is full it becomes the previous one and the
+oldest generation is dropped, so memory stays bounded at two generations
+per campaign while the last ``ABTEST_DEDUP_CAPACITY`` to twice as many
+visitors are remembered. Each generation is sized for half the error
+rate, since a visitor is looked up in both.
+
+With ``ABTEST_DEDUP_DIR`` set, the filters are saved to a file per
+campaign in that directory every ``ABTEST_DEDUP_SAVE_INTERVAL`` seconds,
+and when the process exits (see ``worker_exit``). Saving merges the file
+written by other processes into the filter under an exclusive lock of
+the file (``fcntl.flock``), so no process overwrites the visitors saved
+by another, the worker processes of a server converge on the union of
+the visitors they have seen, and a restarted process resumes from the
+file.
+
+Each worker process checks its own filter only, so the filters of the
+workers are only consistent up to ``ABTEST_DEDUP_SAVE_INTERVAL`` seconds.
+A repeated impression or conversion of a visitor that reaches another
+worker than the first one within that interval is counted again. Added
+to the error rate above, duplicates are possible within the save
+interval across workers, and first responses are dropped with
+probability ``ABTEST_DEDUP_ERROR_RATE``. Lower the interval, or run a
+single worker process, to tighten the first bound.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_filters = {}
+_filters_pid = None
+_filters_lock = threading.Lock()
+
+
+class BloomFilter:
+    """ Fixed size set of strings with false positives and no false
+    negatives.
+
+    Examples
+    --------
+    >>> bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    >>> bloom.add('visitor-42')
+    True
+    >>> 'visitor-42' in bloom
+    True
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Number of strings the filter is sized for
+        error_rate : float, optional
+            Probability of an unseen string being reported as seen once
+            ``capacity`` strings were added. Defaults to 0.001
+        """
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        # Optimal number of bits and hash functions
+        self.size = max(
+            int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2)**2)), 8
+        )
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        """ Bit positions of ``key``, by double hashing of a 128 bit hash.
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def contains(self, positions):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def insert(self, positions):
+        """ Sets the bits at ``positions``, returning True if any was unset.
+        """
+        bits = self.bits
+        new = False
+        for p in positions:
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        return new
+
+    def __contains__(self, key):
+        return self.contains(self.positions(key))
+
+    def add(self, key):
+        """ Adds ``key``, returning False if it was (probably) present.
+        """
+        return self.insert(self.positions(key))
+
+    def array(self):
+        """ The bits as a writable :obj:`numpy.ndarray` of bytes, sharing
+        memory with the filter.
+        """
+        return np.frombuffer(self.bits, dtype=np.uint8)
+
+    def approx_len(self):
+        """ Estimated number of strings added, from the fraction of bits set.
+        """
+        ones = int(np.unpackbits(self.array()).sum())
+        if ones >= self.size:
+            return self.capacity
+        return int(round(-self.size / self.hashes * math.log(1 - ones / self.size)))
+
+class RotatingBloomFilter:
+    """ Two generations of Bloom filters, see the module docstring.
+    Thread safe.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, path=None, save_interval=60):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Number of strings per generation
+        error_rate : float, optional
+            Probability of an unseen string being reported as seen.
+            Defaults to 0.001
+        path : str, optional
+            File the filter is saved to and loaded from. Defaults to None,
+            i.e. the filter is kept in memory only
+        save_interval : float, optional
+            Seconds between saves of the filter in a background thread,
+            triggered by ``add``. Defaults to 60
+        """
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.path = path
+        self.save_interval = save_interval
+        self.generation = 0
+        self.count = 0
+        self.current = self._new_filter()
+        self.previous = self._new_filter()
+        self._lock = threading.Lock()
+        self._saving = False
+        self._last_save = time.monotonic()
+        if path is not None and os.path.exists(path):
+            try:
+                self._merge(self._read())
+            except Exception:
+                logger.exception('Unable to load dedup filter %s', path)
+
+    def _new_filter(self):
+        return BloomFilter(self.capacity, self.error_rate / 2)
+
+    def add(self, key):
+        """ Adds ``key``, returning True if it was not seen before.
+        """
+        positions = self.current.positions(key)
+        with self._lock:
+            new = self.current.insert(positions)
+            if new:
+                if self.previous.contains(positions):
+                    # Seen in the previous generation, kept in the current one
+                    new = False
+                self.count += 1
+                if self.count >= self.capacity:
+                    self._rotate()
+        if self.path is not None and \
+                time.monotonic() - self._last_save > self.save_interval:
+            self._schedule_save()
+        return new
+
+    def __contains__(self, key):
+        positions = self.current.positions(key)
+        return self.current.contains(positions) or self.previous.contains(positions)
+
+    def _rotate(self):
+        self.previous = self.current
+        self.current = self._new_filter()
+        self.generation += 1
+        self.count = 0
+
+    def _schedule_save(self):
+        with self._lock:
+            if self._saving:
+                return
+            self._saving = True
+            self._last_save = time.monotonic()
+        threading.Thread(target=self._run_save, daemon=True).start()
+
+    def _run_save(self):
+        try:
+            self.save()
+        except Exception:
+            logger.exception('Unable to save dedup filter %s', self.path)
+        finally:
+            with self._lock:
+                self._saving = False
+
+    def _read(self):
+        with np.load(self.path) as data:
+            meta = data['meta'].tolist()
+            if meta[1:] != [self.current.size, self.current.hashes]:
+                # Written with other settings
+                return None
+            return meta[0], data['current'], data['previous']
+
+    def _merge(self, saved):
+        """ Merges the generations read from a file into the filter.
+        """
+        if saved is None:
+            return
+        generation, current, previous = saved
+        with self._lock:
+            if generation == self.generation:
+                self.current.array()[:] |= current
+                self.previous.array()[:] |= previous
+            elif generation > self.generation:
+                # Rotated by another process, the visitors of this process
+                # are kept for one more generation
+                own = self.current.array().copy()
+                self.current.array()[:] = current
+                self.previous.array()[:] = previous | own
+                self.generation = generation
+            else:
+                self.previous.array()[:] |= current
+            self.count = self.current.approx_len()
+            if self.count >= self.capacity:
+                self._rotate()
+
+    def save(self):
+        """ Merges the file of the filter into the filter, and writes the
+        result back to the file.
+        """
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # Read, merge and write under an exclusive lock, so that concurrent
+        # savers do not overwrite each other's visitors
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(self.path):
+                self._merge(self._read())
+            with self._lock:
+                meta = np.array([self.generation, self.current.size, self.current.hashes])
+                current = self.current.array().copy()
+                previous = self.previous.array().copy()
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, meta=meta, current=current, previous=previous)
+                # Atomic, readers never see a partially written file
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+def get_filter(campaign_code):
+    """ Returns the ``RotatingBloomFilter`` of a campaign in the current
+    process, or None if ``ABTEST_DEDUP_CAPACITY`` is 0.
+    """
+    global _filters, _filters_pid
+    capacity = getattr(settings, 'ABTEST_DEDUP_CAPACITY', 1000000)
+    if not capacity:
+        return None
+    campaign_code = str(campaign_code)
+    if _filters_pid != os.getpid() or campaign_code not in _filters:
+        with _filters_lock:
+            if _filters_pid != os.getpid():
+                # Filters of the parent process are not shared after a fork
+                _filters = {}
+                _filters_pid = os.getpid()
+                atexit.register(save_filters)
+            if campaign_code not in _filters:
+                directory = getattr(settings, 'ABTEST_DEDUP_DIR', None)
+                # An impression and a conversion key per visitor
+                _filters[campaign_code] = RotatingBloomFilter(
+                    2 * capacity,
+                    error_rate=getattr(settings, 'ABTEST_DEDUP_ERROR_RATE', 0.001),
+                    path=directory and os.path.join(directory, f'{campaign_code}.npz'),
+                    save_interval=getattr(settings, 'ABTEST_DEDUP_SAVE_INTERVAL', 60),
+                )
+    return _filters[campaign_code]
+
+def save_filters():
+    """ Saves the filters of the current process.
+    """
+    if _filters_pid != os.getpid():
+        return
+    for bloom in list(_filters.values()):
+        try:
+            bloom.save()
+        except Exception:
+            logger.exception('Unable to save dedup filter %s', bloom.path)
+
+def worker_exit(server, worker):
+    """ gunicorn ``worker_exit`` server hook. Saves the filters of a
+    worker before it shuts down. See ``gunicorn.conf.py``.
+    """
+    save_filters()
@@ -0,0 +1,223 @@
+""" The jobs module runs simulations outside of the request that submitted
+them.
+
+A simulation of a million page visits takes seconds to tens of seconds,
+which ties up a web worker and may exceed the timeout of a proxy in front
+of it. Instead, ``submit`` saves a ``SimulationJob`` and returns at once,
+and the simulation runs on a thread pool of the worker process. The job's
+progress and the checkpoints recorded so far are saved as the simulation
+runs, so that any worker process can report them, see
+``api.JobStatusAPI``.
+
+Jobs run in the process that received them. Jobs still pending or running
+when the process exits are left in that state and are not resumed.
+With the ``ABTEST_JOBS_EAGER`` setting, jobs run in the submitting
+thread before ``submit`` returns, i.e. for tests.
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from .models import Campaign, SimulationJob
+from .simulation import compact_dataset, run_experiment
+from .utils import sim_page_visits
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between progress updates of a job
+PROGRESS_INTERVAL = 0.5
+
+# Number of page visits simulated and written to the variants at once
+# by a page visits job
+PAGE_VISITS_CHUNK = 100000
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ Thread pool of the current process, created on first use with
+    ``ABTEST_JOBS_WORKERS`` threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ABTEST_JOBS_WORKERS', 2),
+                thread_name_prefix='abtest-jobs',
+            )
+        return _executor
+
+def submit(kind, params):
+    """ Save a new ``SimulationJob`` and run it on the thread pool once
+    the current transaction commits.
+
+    Parameters
+    ----------
+    kind : str
+        ``SimulationJob.SIMULATION`` for ``run_experiment`` or
+        ``SimulationJob.PAGE_VISITS`` for ``utils.sim_page_visits``
+    params : dict
+        JSON serializable parameters of the simulation, see
+        ``run_simulation`` and ``run_page_visits``
+
+    Returns
+    -------
+    :obj:`SimulationJob`
+        The job saved. With ``ABTEST_JOBS_EAGER``, the job has already run.
+    """
+    if kind not in RUNNERS:
+        raise ValueError(f'Invalid job kind: {kind}')
+    job = SimulationJob.objects.create(kind=kind, params=json.dumps(params))
+    if getattr(settings, 'ABTEST_JOBS_EAGER', False):
+        run_job(job.pk)
+        job.refresh_from_db()
+    else:
+        transaction.on_commit(lambda: get_executor().submit(_run_in_thread, job.pk))
+    return job
+
+def _run_in_thread(job_id):
+    close_old_connections()
+    try:
+        run_job(job_id)
+    finally:
+        # Connections are per thread, and the pool's threads are reused
+        connection.close()
+
+def run_job(job_id):
+    """ Run the job with primary key ``job_id``, saving its progress,
+    result and status. Errors are logged and saved to the job.
+    """
+    job = SimulationJob.objects.get(pk=job_id)
+    SimulationJob.objects.filter(pk=job_id).update(status=SimulationJob.RUNNING)
+    reporter = ProgressReporter(job_id)
+    try:
+        result = RUNNERS[job.kind](json.loads(job.params), reporter)
+    except Exception as e:
+        logger.exception('Simulation job %s failed', job_id)
+        reporter.flush()
+        SimulationJob.objects.filter(pk=job_id).update(
+            status=SimulationJob.FAILED,
+            error=str(e) or e.__class__.__name__,
+        )
+        return
+    reporter.progress = 1.0
+    reporter.flush()
+    SimulationJob.objects.filter(pk=job_id).update(
+        status=SimulationJob.DONE,
+        result=json.dumps(result),
+    )
+
+
+class ProgressReporter:
+    """ Collects the progress and checkpoints of a running job, and saves
+    them to the job at most every ``PROGRESS_INTERVAL`` seconds.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.progress = 0.0
+        self.checkpoints = []
+        self._last_flush = time.monotonic()
+
+    def update(self, progress, checkpoint=None):
+        """ Record the ``progress`` of the job, and ``checkpoint`` if given.
+        """
+        self.progress = min(max(progress, 0.0), 1.0)
+        if checkpoint is not None:
+            self.checkpoints.append(checkpoint)
+        if time.monotonic() - self._last_flush >= PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """ Save the progress and checkpoints to the job.
+        """
+        self._last_flush = time.monotonic()
+        SimulationJob.objects.filter(pk=self.job_id).update(
+            progress=self.progress,
+            checkpoints=json.dumps(self.checkpoints),
+        )
+
+def run_simulation(params, reporter):
+    """ Runs a ``SimulationJob.SIMULATION`` job.
+
+    Parameters
+    ----------
+    params : dict
+        ``rates``, ``N``, ``algo``, ``eps`` and ``checkpoints`` as for
+        ``run_experiment``, and the ``payload`` of the result, ``full``,
+        ``compact`` or ``params`` as for ``api.RunSimulation``
+    reporter : :obj:`ProgressReporter`
+        Receives the checkpoints as they are recorded, without the curves.
+
+    Returns
+    -------
+    list or dict
+        The checkpoints of the simulation in the format of ``payload``.
+    """
+    N = params.get('N', 10000)
+    payload = params.get('payload', 'full')
+
+    def on_checkpoint(data):
+        reporter.update(
+            data['N'] / N if N else 1.0,
+            {key: value for key, value in data.items()
+             if key == 'N' or isinstance(value, dict)},
+        )
+
+    dataset = run_experiment(
+        params['rates'],
+        N=N,
+        algo=params.get('algo', 'thompson'),
+        eps=params.get('eps', 0.1),
+        checkpoints=params.get('checkpoints'),
+        curves=payload == 'full',
+        on_checkpoint=on_checkpoint,
+    )
+    if payload != 'full':
+        return compact_dataset(dataset, curves=payload == 'compact')
+    return dataset
+
+def run_page_visits(params, reporter):
+    """ Runs a ``SimulationJob.PAGE_VISITS`` job. The visits are simulated
+    with ``utils.sim_page_visits`` in chunks of ``PAGE_VISITS_CHUNK``
+    visits, so that the impressions / conversions of the variants are
+    updated as the job progresses.
+
+    Parameters
+    ----------
+    params : dict
+        ``campaign_code``, ``n``, ``conversion_rates``, ``algo`` and
+        ``eps`` as for ``utils.sim_page_visits``
+    reporter : :obj:`ProgressReporter`
+        Receives the number of visits simulated after each chunk.
+
+    Returns
+    -------
+    dict
+        Number of page visits simulated.
+    """
+    campaign = Campaign.objects.get(code=params['campaign_code'])
+    n = params['n']
+    done = 0
+    while done < n:
+        chunk = min(PAGE_VISITS_CHUNK, n - done)
+        sim_page_visits(
+            campaign,
+            chunk,
+            params.get('conversion_rates') or {},
+            algo=params.get('algo', 'thompson'),
+            eps=params.get('eps', 0.1),
+        )
+        done += chunk
+        reporter.update(done / n, {'n': done})
+    return {'details': 'Page visits simulated', 'n': n}
+
+RUNNERS = {
+    SimulationJob.SIMULATION: run_simulation,
+    SimulationJob.PAGE_VISITS: run_page_visits,
+}
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from abtest.counters import materialize_shards
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Fold the totals of the variant counter shards into the Variant '
+        'impressions / conversions. Run periodically (e.g. from cron) when '
+        'ABTEST_COUNTER_SHARDS is set.'
+    )
+
+    def handle(self, *args, **options):
+
+        updated = materialize_shards()
+        self.stdout.write(f'{updated} variants updated')
@@ -0,0 +1,232 @@
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from abtest.counters import bulk_increment, counters_flushed
+from abtest.models import Campaign, Variant, VariantCounterShard
+
+FORMATS = ('ndjson', 'csv')
+TRUE_VALUES = ['true', 't', '1', 'yes']
+
+
+def infer_format(path):
+    """ ``ndjson`` or ``csv`` from the extension of ``path``, ignoring
+    a ``.gz`` suffix.
+    """
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    raise CommandError(f'Unable to infer the format of {path}, use --format')
+
+def read_chunks(path, format, chunksize):
+    """ Iterator over the events of a log file as :obj:`pandas.DataFrame`
+    chunks of ``chunksize`` rows. Compression is inferred from the file
+    extension.
+    """
+    if format == 'csv':
+        return pd.read_csv(
+            path,
+            chunksize=chunksize,
+            dtype={'campaign_code': str, 'variant_code': str, 'visitor_id': str},
+        )
+    return pd.read_json(
+        path,
+        lines=True,
+        chunksize=chunksize,
+        dtype=False,
+        convert_dates=False,
+    )
+
+def as_flags(column):
+    """ 0 / 1 integer array from a column of booleans, numbers or strings.
+    """
+    if not (is_bool_dtype(column) or is_numeric_dtype(column)):
+        column = column.astype(str).str.strip().str.lower().isin(TRUE_VALUES)
+    return column.fillna(0).astype(bool).to_numpy(dtype=np.int64)
+
+def normalize_code(code):
+    """ Canonical string of a campaign code, or None if it is not a UUID.
+    """
+    try:
+        return str(uuid.UUID(str(code)))
+    except ValueError:
+        return None
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Recompute the Variant impressions / conversions from event log '
+        'files (newline delimited JSON or CSV, optionally gzipped) with one '
+        'event per line in the format of the response API. Files are read '
+        'in chunks and aggregated per variant, so memory does not grow '
+        'with the number of events. The counters of the campaigns found in '
+        'the logs are replaced, or incremented with --add.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Event log files')
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help='Format of the files. Defaults to the file extension',
+        )
+        parser.add_argument(
+            '--chunksize', type=int, default=1000000,
+            help='Number of events read at once. Defaults to 1000000',
+        )
+        parser.add_argument(
+            '--add', action='store_true',
+            help='Add the events to the counters instead of replacing them',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the totals without writing them',
+        )
+
+    def handle(self, *args, **options):
+
+        self.campaigns = {
+            str(code): (pk, allow_repeat)
+            for code, pk, allow_repeat in Campaign.objects.values_list(
+                'code', 'pk', 'allow_repeat'
+            )
+        }
+        self.variants = set(Variant.objects.values_list('campaign_id', 'code'))
+        # Sorted hashes of the (campaign, visitor) pairs already counted,
+        # per kind of event
+        self.seen = {
+            kind: np.empty(0, dtype=np.uint64) for kind in ('impressions', 'conversions')
+        }
+        self.totals = {}
+        self.skipped = 0
+
+        events = 0
+        start = time.monotonic()
+        for path in options['paths']:
+            format = options['format'] or infer_format(path)
+            for chunk in read_chunks(path, format, options['chunksize']):
+                self.aggregate(chunk)
+                events += len(chunk)
+                elapsed = time.monotonic() - start
+                self.stdout.write(
+                    f'{path}: {events} events read '
+                    f'({events / max(elapsed, 1e-9):.0f} events/s)'
+                )
+
+        for (campaign_id, variant_code), (impressions, conversions) in sorted(
+            self.totals.items()
+        ):
+            self.stdout.write(
+                f'Campaign {campaign_id} variant {variant_code}: '
+                f'{impressions} impressions, {conversions} conversions'
+            )
+        if self.skipped:
+            self.stdout.write(f'{self.skipped} events of unknown campaigns or variants skipped')
+        if options['dry_run']:
+            return
+
+        campaign_ids = {campaign_id for campaign_id, variant_code in self.totals}
+        with transaction.atomic():
+            if not options['add']:
+                Variant.objects.filter(campaign_id__in=campaign_ids).update(
+                    impressions=0,
+                    conversions=0,
+                    conversion_rate=0.0,
+                )
+                VariantCounterShard.objects.filter(
+                    variant__campaign_id__in=campaign_ids
+                ).update(impressions=0, conversions=0)
+            updated = bulk_increment(self.totals)
+        counters_flushed.send(sender=Variant)
+        self.stdout.write(f'{updated} variants updated')
+
+    def aggregate(self, chunk):
+        """ Adds the impressions / conversions of a chunk of events to the
+        totals per variant.
+        """
+        missing = {'campaign_code', 'variant_code', 'register_impression'} - set(chunk)
+        if missing:
+            raise CommandError(f'Missing columns: {", ".join(sorted(missing))}')
+
+        # Campaign codes are normalized once per distinct code
+        codes = chunk['campaign_code'].astype(str)
+        frame = pd.DataFrame({
+            'campaign_code': codes.map({
+                code: normalize_code(code) for code in codes.unique()
+            }),
+            'variant_code': chunk['variant_code'].astype(str),
+            'impressions': as_flags(chunk['register_impression']),
+            'conversions': (
+                as_flags(chunk['register_conversion'])
+                if 'register_conversion' in chunk else 0
+            ),
+        })
+        if 'visitor_id' in chunk:
+            self.deduplicate(frame, chunk['visitor_id'].astype(str))
+
+        grouped = frame.groupby(['campaign_code', 'variant_code'], sort=False).agg(
+            impressions=('impressions', 'sum'),
+            conversions=('conversions', 'sum'),
+            events=('impressions', 'size'),
+        )
+        # Rows with invalid campaign codes are not grouped
+        self.skipped += len(frame) - int(grouped['events'].sum())
+        for (campaign_code, variant_code), (impressions, conversions, events) in zip(
+            grouped.index, grouped.to_numpy().tolist()
+        ):
+            campaign = self.campaigns.get(campaign_code)
+            key = (campaign[0], variant_code) if campaign else None
+            if key not in self.variants:
+                self.skipped += events
+                continue
+            total = self.totals.setdefault(key, [0, 0])
+            total[0] += impressions
+            total[1] += conversions
+
+    def deduplicate(self, frame, visitors):
+        """ Keeps the first impression / conversion of each visitor of the
+        campaigns without repeats, see ``Campaign.allow_repeat``. Visitors
+        are identified by a 64 bit hash of the campaign and visitor id.
+        Repeats within the chunk are dropped first, then the remaining
+        visitors are looked up at once in the sorted hashes of the visitors
+        of the previous chunks. Exact up to hash collisions, at the cost of
+        8 bytes of memory per visitor and kind of event.
+        """
+        no_repeat = [
+            code for code, (pk, allow_repeat) in self.campaigns.items()
+            if not allow_repeat
+        ]
+        rows = np.flatnonzero(frame['campaign_code'].isin(no_repeat).to_numpy())
+        if not len(rows):
+            return
+        keys = pd.util.hash_pandas_object(
+            pd.DataFrame({
+                'campaign_code': pd.Categorical(frame['campaign_code'].to_numpy()[rows]),
+                'visitor_id': visitors.to_numpy()[rows],
+            }),
+            index=False,
+        ).to_numpy()
+        for column in ('impressions', 'conversions'):
+            counts = frame[column].to_numpy().copy()
+            candidates = counts[rows] > 0
+            # Sorted distinct visitors of the chunk, and their first event
+            hashes, first = np.unique(keys[candidates], return_index=True)
+            seen = self.seen[column]
+            positions = np.searchsorted(seen, hashes)
+            found = np.zeros(len(hashes), dtype=bool)
+            inside = positions < len(seen)
+            found[inside] = seen[positions[inside]] == hashes[inside]
+            self.seen[column] = np.insert(seen, positions[~found], hashes[~found])
+
+            candidates = rows[candidates]
+            counted = np.zeros(len(candidates), dtype=bool)
+            counted[first[~found]] = True
+            counts[candidates[~counted]] = 0
+            frame[column] = counts
@@ -0,0 +1,121 @@
+""" The memo module contains a least recently used cache for the results
+of the decision rules in the utils module and the beta PDF curves in the
+curves module.
+
+Decision rules are pure functions of the posterior parameters of the
+variants, so a dashboard that is polled while the counts have not changed
+can reuse the results of the previous render. Entries are evicted in
+least recently used order once ``maxsize`` entries are held.
+"""
+
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache:
+    """ Thread safe least recently used cache.
+
+    Examples
+    --------
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.get_or_set((1, 1, 1, 1), lambda: 0.5)
+    0.5
+    >>> cache.get((1, 1, 1, 1))
+    0.5
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        Parameters
+        ----------
+        maxsize : int, optional
+            Maximum number of entries held. ``0`` disables the cache.
+            Defaults to 1024
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """ Returns the value cached for ``key`` and marks it as the most
+        recently used entry, or ``default`` if there is none.
+        """
+        with self._lock:
+            value = self._data.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache ``value`` for ``key``, evicting the least recently used
+        entries above ``maxsize``.
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, load):
+        """ Returns the value cached for ``key``, calling ``load()`` and
+        caching its result on a miss.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def nearest(self, key, max_distance, window=64):
+        """ Find the cached entry with the key closest to ``key``.
+
+        Keys are compared as integer tuples with the L1 distance, i.e. the
+        total number of impressions / conversions by which the posterior
+        parameters differ. Only the ``window`` most recently used entries
+        are searched, as the entries of a pair of variants that is polled
+        repeatedly are among the most recent ones.
+
+        Parameters
+        ----------
+        key : tuple
+            Tuple of integers
+        max_distance : int
+            Maximum L1 distance between ``key`` and the key found
+        window : int, optional
+            Number of most recently used entries searched. Defaults to 64
+
+        Returns
+        -------
+        tuple or None
+            ``(key, value)`` of the closest entry, or None if no entry
+            is within ``max_distance``.
+        """
+        best, best_distance = None, max_distance + 1
+        with self._lock:
+            for i, (other, value) in enumerate(reversed(self._data.items())):
+                if i >= window:
+                    break
+                distance = sum(abs(x - y) for x, y in zip(key, other))
+                if distance < best_distance:
+                    best, best_distance = (other, value), distance
+        return best
+
+    def clear(self):
+        """ Remove all entries and reset the hit / miss statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
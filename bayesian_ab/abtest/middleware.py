@@ -0,0 +1,94 @@
+""" The middleware module keeps the visitor id and the sticky variant
+assignments of stateless assignment (see ``utils.ab_assign``) in a
+signed cookie instead of the session.
+
+With the default database backed sessions, the first visit of every
+visitor inserts a session row. The cookie needs no server side storage:
+it is signed with ``SECRET_KEY``, so visitors cannot change the variants
+they were assigned, and is only set on responses to requests that
+created a visitor id or a new assignment.
+
+Add ``abtest.middleware.VisitorCookieMiddleware`` to ``MIDDLEWARE``.
+"""
+
+import json
+import uuid
+from django.conf import settings
+
+SALT = 'abtest.visitor'
+
+
+class Visitor:
+    """ Visitor id and the variant codes assigned to the visitor, per
+    campaign code.
+    """
+
+    def __init__(self, id=None, assignments=None):
+        """
+        Parameters
+        ----------
+        id : str, optional
+            Visitor id. Defaults to a new random id
+        assignments : dict, optional
+            Mapping of campaign code to the assigned variant code
+        """
+        self.changed = id is None
+        self.id = id or uuid.uuid4().hex
+        self.assignments = dict(assignments or {})
+
+    def assign(self, campaign_code, variant_code):
+        """ Record the variant assigned for a campaign.
+        """
+        if self.assignments.get(campaign_code) != variant_code:
+            self.assignments[campaign_code] = variant_code
+            self.changed = True
+
+    def dumps(self):
+        return json.dumps({'v': self.id, 'a': self.assignments}, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, value):
+        data = json.loads(value)
+        return cls(str(data['v']), {str(k): str(v) for k, v in data['a'].items()})
+
+def get_visitor(request):
+    """ Returns the ``Visitor`` of ``request``, read from the signed
+    cookie on first use. A new visitor is created if the cookie is
+    missing, or its signature or contents are invalid.
+    """
+    visitor = getattr(request, '_abtest_visitor', None)
+    if visitor is None:
+        value = request.get_signed_cookie(
+            getattr(settings, 'ABTEST_COOKIE_NAME', 'abtest'),
+            default=None,
+            salt=SALT,
+        )
+        try:
+            visitor = Visitor.loads(value)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            visitor = Visitor()
+        request._abtest_visitor = visitor
+    return visitor
+
+
+class VisitorCookieMiddleware:
+    """ Sets the signed visitor cookie on the response when the visitor
+    of the request was created or assigned a new variant.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        visitor = getattr(request, '_abtest_visitor', None)
+        if visitor is not None and visitor.changed:
+            response.set_signed_cookie(
+                getattr(settings, 'ABTEST_COOKIE_NAME', 'abtest'),
+                visitor.dumps(),
+                salt=SALT,
+                max_age=getattr(settings, 'ABTEST_COOKIE_MAX_AGE', 60 * 60 * 24 * 365),
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.6 on 2026-10-17 15:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('abtest', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VariantCounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(help_text='Shard index, 0 <= shard < ABTEST_COUNTER_SHARDS')),
+                ('impressions', models.IntegerField(default=0, help_text='Impressions not yet added to the variant')),
+                ('conversions', models.IntegerField(default=0, help_text='Conversions not yet added to the variant')),
+                ('variant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counter_shards', to='abtest.Variant')),
+            ],
+            options={
+                'unique_together': {('variant', 'shard')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.6 on 2026-10-17 15:59
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('abtest', '0002_variantcountershard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now, help_text='Time the job was submitted')),
+                ('updated', models.DateTimeField(auto_now=True, help_text='Time of the last progress update')),
+                ('kind', models.CharField(choices=[('simulation', 'Simulated A/B test'), ('page_visits', 'Simulated page visits')], max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('params', models.TextField(help_text='JSON parameters of the simulation')),
+                ('progress', models.FloatField(default=0.0, help_text='Fraction of the simulation completed, 0 <= progress <= 1')),
+                ('checkpoints', models.TextField(default='[]', help_text='JSON list of the checkpoints recorded so far')),
+                ('result', models.TextField(blank=True, help_text='JSON result of the simulation, once done', null=True)),
+                ('error', models.TextField(blank=True, default='', help_text='Error message, if the job failed')),
+            ],
+        ),
+    ]
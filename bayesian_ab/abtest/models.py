@@ -1,8 +1,8 @@
 import uuid
 import numpy as np
-import scipy.stats
 from django.utils import timezone
 from django.db import models
+from .curves import pdf
 
 class Campaign(models.Model):
 
@@ -77,14 +77,119 @@ class Variant(models.Model):
     def beta_pdf(self, x_vals):
         # Get beta distribution values given corresponding X values where 0 < X <1
         # Where alpha = conversions and beta = impressions - conversions 
-        y_vals = list(scipy.stats.beta.pdf(
+        y_vals = pdf(
             x_vals, 
             max(self.conversions, 1),
             max(self.impressions-self.conversions, 1)
-            )
         )
-        return y_vals
+        return y_vals.tolist()
 
     def __str__(self):
         return f'Variant: {self.code} | {self.campaign.code} '
 
+
+class VariantCounterShard(models.Model):
+
+    ''' Optional counter shards for a Variant. When sharding is enabled
+    (``ABTEST_COUNTER_SHARDS`` setting), increments are spread across
+    K shard rows per variant instead of a single hot Variant row.
+    Shard totals are folded into the Variant counters by
+    ``counters.materialize_shards``.
+    '''
+
+    variant = models.ForeignKey(
+        Variant,
+        related_name='counter_shards',
+        on_delete=models.CASCADE,
+    )
+    shard = models.IntegerField(
+        help_text='Shard index, 0 <= shard < ABTEST_COUNTER_SHARDS'
+    )
+    impressions = models.IntegerField(
+        default=0,
+        help_text='Impressions not yet added to the variant'
+    )
+    conversions = models.IntegerField(
+        default=0,
+        help_text='Conversions not yet added to the variant'
+    )
+
+    class Meta:
+        unique_together = ('variant', 'shard')
+
+    def __str__(self):
+        return f'Variant counter shard: {self.shard} | {self.variant_id} '
+
+
+class SimulationJob(models.Model):
+
+    ''' Simulation run outside of the request that submitted it, see the
+    ``jobs`` module. The progress and the checkpoints recorded so far are
+    saved while the job runs, so that they can be polled from any worker
+    process.
+    '''
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    SIMULATION = 'simulation'
+    PAGE_VISITS = 'page_visits'
+    KIND_CHOICES = [
+        (SIMULATION, 'Simulated A/B test'),
+        (PAGE_VISITS, 'Simulated page visits'),
+    ]
+
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False,
+    )
+    timestamp = models.DateTimeField(
+        default=timezone.now,
+        help_text='Time the job was submitted'
+    )
+    updated = models.DateTimeField(
+        auto_now=True,
+        help_text='Time of the last progress update'
+    )
+    kind = models.CharField(
+        max_length=32,
+        choices=KIND_CHOICES,
+    )
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+    )
+    params = models.TextField(
+        help_text='JSON parameters of the simulation'
+    )
+    progress = models.FloatField(
+        default=0.0,
+        help_text='Fraction of the simulation completed, 0 <= progress <= 1'
+    )
+    checkpoints = models.TextField(
+        default='[]',
+        help_text='JSON list of the checkpoints recorded so far'
+    )
+    result = models.TextField(
+        null=True,
+        blank=True,
+        help_text='JSON result of the simulation, once done'
+    )
+    error = models.TextField(
+        blank=True,
+        default='',
+        help_text='Error message, if the job failed'
+    )
+
+    def __str__(self):
+        return f'Simulation job: {self.kind} | {self.id} | {self.status} '
+
@@ -0,0 +1,139 @@
+""" The pool module contains a per-process pool of pre-drawn Thompson
+sampling winners, so that ``ab_assign`` needs no NumPy call on the
+request path.
+
+Thompson sampling assigns the variant with the largest of one sample
+drawn from the beta posterior of every variant. Since the posterior
+only changes when a new snapshot of the variant values is loaded (see
+the snapshot module), the winners of ``ABTEST_THOMPSON_POOL_SIZE``
+assignments can be drawn from it in a single vectorized call and handed
+out one at a time. The pool is a ring: it is redrawn in a background
+thread when the snapshot changes or the ring wraps around, and the
+previous winners are handed out until the new ones are ready.
+
+Assignments are therefore made from a posterior at most one snapshot
+(``ABTEST_SNAPSHOT_TTL`` seconds, see the snapshot module) plus one
+refresh older than with ``thompson_sampling``.
+"""
+
+import threading
+from django.conf import settings
+from .posterior import posterior_params
+from .rng import get_rng
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ThompsonPool:
+    """ Ring buffer of Thompson sampling winners of one campaign.
+
+    Examples
+    --------
+    >>> pool = ThompsonPool(size=1024)
+    >>> variants = get_variant_values(campaign)
+    >>> variants[pool.next(variants)]
+    {'code': 'B', 'impressions': 120, ...}
+    """
+
+    def __init__(self, size=4096, background=True, rng=None):
+        """
+        Parameters
+        ----------
+        size : int, optional
+            Number of winners drawn at once. Defaults to 4096
+        background : bool, optional
+            If True, the winners are redrawn in a background thread while
+            the previous winners are handed out. If False, they are
+            redrawn in the calling thread. Defaults to True
+        rng : :obj:`numpy.random.Generator`, optional
+            Random number generator to draw the winners with. Defaults to
+            the generator of the current process, see the ``rng`` module.
+        """
+        self.size = max(int(size), 1)
+        self.background = background
+        self.rng = rng
+        self.draws = 0
+        # (variants, winners, iterator over winners), replaced atomically
+        self._state = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def next(self, variants):
+        """ Index of the variant assigned to the next request.
+
+        Parameters
+        ----------
+        variants : tuple
+            Snapshot of the variant values of the campaign, see
+            ``snapshot.get_variant_values``. A new snapshot object
+            triggers a refresh of the winners.
+
+        Returns
+        -------
+        int
+            Index of the assigned variant in ``variants``.
+        """
+        state = self._state
+        if state is None or len(state[0]) != len(variants):
+            # No winners for these variants yet
+            state = self._refresh(variants)
+        elif state[0] is not variants:
+            self._schedule(variants)
+        try:
+            return next(state[2])
+        except StopIteration:
+            # Wrap around the ring until the refresh is done
+            self._schedule(variants)
+            iterator = iter(state[1])
+            self._state = (state[0], state[1], iterator)
+            return next(iterator)
+
+    def _draw(self, variants):
+        alpha, beta = posterior_params(variants)
+        samples = (self.rng or get_rng()).beta(alpha, beta, size=(self.size, len(variants)))
+        self.draws += 1
+        return samples.argmax(axis=1).tolist()
+
+    def _refresh(self, variants):
+        winners = self._draw(variants)
+        state = (variants, winners, iter(winners))
+        self._state = state
+        return state
+
+    def _schedule(self, variants):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        if not self.background:
+            self._run_refresh(variants)
+            return
+        threading.Thread(
+            target=self._run_refresh,
+            args=(variants,),
+            daemon=True,
+        ).start()
+
+    def _run_refresh(self, variants):
+        try:
+            self._refresh(variants)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+def get_pool(campaign):
+    """ Returns the ``ThompsonPool`` of ``campaign`` in the current
+    process, or None if ``ABTEST_THOMPSON_POOL_SIZE`` is 0.
+    """
+    size = getattr(settings, 'ABTEST_THOMPSON_POOL_SIZE', 0)
+    if not size:
+        return None
+    pool = _pools.get(campaign.pk)
+    if pool is None or pool.size != size:
+        with _pools_lock:
+            pool = _pools.get(campaign.pk)
+            if pool is None or pool.size != size:
+                pool = ThompsonPool(size=size)
+                _pools[campaign.pk] = pool
+    return pool
@@ -0,0 +1,36 @@
+""" The posterior module contains the beta posterior parameters of
+variants derived from their impression and conversion counters. Shared
+by the assignment algorithms of the utils module and the Thompson pool.
+"""
+
+import numpy as np
+
+
+def beta_params(impressions, conversions):
+    """Beta posterior parameters from arrays of impressions and conversions,
+    with a Beta(1, 1) floor so that variants without impressions or
+    conversions still have a proper posterior. See ``posterior_params``.
+    """
+    return np.maximum(conversions, 1), np.maximum(impressions - conversions, 1)
+
+def posterior_params(variant_vals):
+    """Beta posterior parameters of each variant, as arrays.
+
+    Parameters
+    ----------
+    variant_vals : list
+        A list of dictionary mappings of Variant field values for
+        a given Campaign object. Required ``Variant`` fields are
+        ``impressions`` ``conversions``.
+
+    Returns
+    -------
+    alpha : :obj:`numpy.ndarray`
+        alpha shape parameters, i.e. conversions. alpha >= 1
+    beta : :obj:`numpy.ndarray`
+        beta shape parameters, i.e. impressions - conversions. beta >= 1
+
+    """
+    conversions = np.array([var['conversions'] for var in variant_vals])
+    impressions = np.array([var['impressions'] for var in variant_vals])
+    return beta_params(impressions, conversions)
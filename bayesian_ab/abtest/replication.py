@@ -0,0 +1,207 @@
+""" The replication module runs independent replicates of the simulated
+A/B tests of ``simulation.run_experiment`` across a process pool, and
+aggregates the regret and posterior trajectories of the replicates.
+
+A single run of ``run_experiment`` is one noisy trajectory. Conclusions about
+the regret of an explore-exploit algorithm need the distribution over
+many replicates. See ``replicate`` below.
+
+Every replicate draws its random numbers from its own generator, seeded
+from a ``numpy.random.SeedSequence`` spawned from ``seed`` in a fixed
+order. Results for a given ``seed`` are therefore identical whatever the
+number of worker processes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .simulation import run_experiment, simulate_replicates, variant_codes
+
+
+def _run_replicate(task):
+    """ Run one replicate of ``run_experiment``. Module level, so that it can
+    be pickled to the worker processes.
+
+    Returns
+    -------
+    checkpoints : :obj:`numpy.ndarray`
+        Number of visits simulated at each checkpoint
+    posterior : :obj:`numpy.ndarray`
+        (checkpoints x variants x 2) array of the alpha, beta parameters
+        of each variant at each checkpoint
+    """
+    params, algo, N, seed = task
+    rates = _rates(params)
+    dataset = run_experiment(
+        rates,
+        N=N,
+        algo=algo,
+        eps=params.get('eps', 0.1),
+        checkpoints=params.get('checkpoints'),
+        rng=np.random.default_rng(seed),
+        curves=False,
+    )
+    codes = variant_codes(len(rates))
+    checkpoints = np.array([data['N'] for data in dataset])
+    posterior = np.array([
+        [[data[code]['a'], data[code]['b']] for code in codes]
+        for data in dataset
+    ])
+    return checkpoints, posterior
+
+def _run_vectorized(task):
+    """ Run all replicates of one parameters and algorithm with
+    ``simulate_replicates``. Returns the same arrays as ``_run_replicate``,
+    with an additional leading replicates axis for the posterior.
+    """
+    params, algo, N, replicates, seed = task
+    return simulate_replicates(
+        _rates(params),
+        replicates=replicates,
+        N=N,
+        algo=algo,
+        eps=params.get('eps', 0.1),
+        rng=np.random.default_rng(seed),
+        checkpoints=params.get('checkpoints'),
+    )
+
+def _rates(params):
+    """ 'true' conversion rates of a grid point, given either as
+    ``rates`` or as ``p1``, ``p2``, ``p3``.
+    """
+    if 'rates' in params:
+        return list(params['rates'])
+    return [params['p1'], params['p2'], params['p3']]
+
+def _summary(values, quantiles):
+    """ Mean and quantiles over the replicates (first axis) of ``values``.
+    """
+    return {
+        'mean': values.mean(axis=0).tolist(),
+        'quantiles': {
+            q: np.quantile(values, q, axis=0).tolist() for q in quantiles
+        },
+    }
+
+def replicate(grid, algos=('thompson',), replicates=100, N=10000, seed=None,
+              workers=None, quantiles=(0.05, 0.5, 0.95), vectorized=False):
+    """ Run ``replicates`` independent replicates of ``run_experiment`` for
+    every combination of parameters in ``grid`` and algorithm in ``algos``.
+
+    The regret at a checkpoint is the expected number of conversions lost
+    to showing variants other than the best one, i.e. the sum over the
+    variants of the number of visits to the variant times the difference
+    between the best 'true' conversion rate and the variant's.
+
+    Parameters
+    ----------
+    grid : list of dict
+        Parameters of the simulation, i.e. ``{'p1': 0.1, 'p2': 0.2, 'p3': 0.3}``
+        as for ``experiment``, or ``{'rates': [0.1, 0.2, 0.3, 0.4]}`` as for 
+        ``run_experiment``, optionally with ``eps`` and ``checkpoints``.
+    algos : list of str, optional
+        Algorithms to simulate, ``thompson``, ``UCB1``, ``uniform`` or
+        ``egreedy``. Defaults to ``['thompson']``
+    replicates : int, optional
+        Number of replicates per parameters and algorithm. Defaults to 100
+    N : int, optional
+        Number of page visits simulated in each replicate. Defaults to 10000
+    seed : int or :obj:`numpy.random.SeedSequence`, optional
+        Seed of the replicates. Defaults to fresh entropy from the OS.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+        With 1 worker the replicates run in the current process.
+    quantiles : list of float, optional
+        Quantiles of the regret and posterior means to report.
+        Defaults to ``[0.05, 0.5, 0.95]``
+    vectorized : bool, optional
+        If True, all replicates of a parameters and algorithm are run at
+        once with ``simulation.simulate_replicates``, one task per
+        parameters and algorithm. Much faster than one ``run_experiment`` 
+        per replicate, but the replicates are seeded per parameters and
+        algorithm rather than per replicate, so the results differ from
+        ``vectorized=False`` for the same ``seed``. Defaults to False
+
+    Returns
+    -------
+    :obj:`list` of ``dict``
+        One element per parameters and algorithm, in the order of
+        ``grid`` then ``algos``. The key-value pairs returned are:
+
+            * ``params`` : The parameters from ``grid``
+            * ``algo`` : The algorithm
+            * ``replicates`` : Number of replicates
+            * ``N`` : List of the number of visits simulated at each checkpoint
+            * ``regret`` : Dict of the ``mean`` regret at each checkpoint and the regret ``quantiles``, mapping each quantile to a list of values per checkpoint
+            * ``posterior`` : Dict mapping each variant code to the ``mean`` and ``quantiles`` of the posterior mean conversion rate at each checkpoint
+
+    Examples
+    --------
+    >>> replicate(
+    ...     grid=[{'p1': 0.3, 'p2': 0.5, 'p3': 0.7}],
+    ...     algos=['thompson', 'uniform'],
+    ...     replicates=1000,
+    ...     seed=42,
+    ... )
+    [
+        {
+            'params': {'p1': 0.3, 'p2': 0.5, 'p3': 0.7},
+            'algo': 'thompson',
+            'replicates': 1000,
+            'N': [0, 10, 20, ...],
+            'regret': {'mean': [0.0, ...], 'quantiles': {0.05: [...], ...}},
+            'posterior': {'A': {'mean': [0.5, ...], 'quantiles': {...}}, ...},
+        },
+        ...
+    ]
+    """
+    runs = [(params, algo) for params in grid for algo in algos]
+    if vectorized:
+        run, seeds = _run_vectorized, np.random.SeedSequence(seed).spawn(len(runs))
+        tasks = [
+            (params, algo, N, replicates, seeds[i])
+            for i, (params, algo) in enumerate(runs)
+        ]
+    else:
+        run, seeds = _run_replicate, np.random.SeedSequence(seed).spawn(len(runs) * replicates)
+        tasks = [
+            (params, algo, N, seeds[i * replicates + r])
+            for i, (params, algo) in enumerate(runs)
+            for r in range(replicates)
+        ]
+
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers == 1:
+        results = list(map(run, tasks))
+    else:
+        # executor.map returns the results in the order of the tasks
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(tasks) // (4 * workers))
+            results = list(executor.map(run, tasks, chunksize=chunksize))
+
+    summaries = []
+    for i, (params, algo) in enumerate(runs):
+        if vectorized:
+            checkpoints, posterior = results[i]
+        else:
+            checkpoints = results[i * replicates][0]
+            posterior = np.stack([
+                result[1] for result in results[i * replicates:(i + 1) * replicates]
+            ])
+        # (replicates x checkpoints x variants x 2)
+        rates = np.array(_rates(params))
+        visits = posterior.sum(axis=3) - 2
+        regret = (visits * (rates.max() - rates)).sum(axis=2)
+        posterior_mean = posterior[..., 0] / posterior.sum(axis=3)
+        summaries.append({
+            'params': params,
+            'algo': algo,
+            'replicates': replicates,
+            'N': checkpoints.tolist(),
+            'regret': _summary(regret, quantiles),
+            'posterior': {
+                code: _summary(posterior_mean[..., j], quantiles)
+                for j, code in enumerate(variant_codes(len(rates)))
+            },
+        })
+    return summaries
@@ -0,0 +1,146 @@
+""" The rng module manages the random number generators used by the
+assignment algorithms and simulations.
+
+Every process draws from its own ``numpy.random.Generator``, seeded from
+a ``numpy.random.SeedSequence`` with the ``ABTEST_RNG_SEED`` setting as
+entropy and the index of the worker process as spawn key. Streams of
+different workers are therefore independent, even when the workers are
+forked from a master process that already created a generator, and a
+run is reproducible for a given seed and number of workers. Call
+``init_worker`` from the server's post fork hook, see ``gunicorn.conf.py``.
+Processes forked without it are keyed on their process id instead.
+
+Uniform random numbers for the per-request hot path (epsilon-greedy
+exploration, uniform assignment, tie breaks) are drawn from the generator
+in blocks of ``ABTEST_RNG_BUFFER_SIZE`` and handed out one at a time,
+see ``RandomBuffer``.
+"""
+
+import os
+import threading
+import numpy as np
+from django.conf import settings
+
+_lock = threading.Lock()
+_pid = None
+_generator = None
+_buffer = None
+_worker = None
+_seed = None
+
+
+class RandomBuffer:
+    """ Thread safe buffer of uniform random numbers in [0, 1), refilled
+    from a generator in blocks. Exposes the ``random`` and ``integers``
+    methods of ``numpy.random.Generator`` used on the assignment hot path,
+    so that either can be passed as ``rng`` to the assignment algorithms.
+
+    Examples
+    --------
+    >>> buffer = RandomBuffer(np.random.default_rng(42), size=1024)
+    >>> buffer.random()
+    0.7739560485559633
+    >>> buffer.integers(3)
+    1
+    """
+
+    def __init__(self, generator, size=4096):
+        """
+        Parameters
+        ----------
+        generator : :obj:`numpy.random.Generator`
+            Generator the blocks are drawn from
+        size : int, optional
+            Number of random numbers drawn per block. Defaults to 4096
+        """
+        self.generator = generator
+        self.size = max(int(size), 1)
+        self._values = iter(())
+        self._lock = threading.Lock()
+
+    def random(self):
+        """ Returns a uniform random float in [0, 1).
+        """
+        # next() on a list iterator is atomic, only refills take the lock
+        try:
+            return next(self._values)
+        except StopIteration:
+            return self._refill()
+
+    def _refill(self):
+        with self._lock:
+            try:
+                # Refilled by another thread while waiting for the lock
+                return next(self._values)
+            except StopIteration:
+                values = iter(self.generator.random(self.size).tolist())
+                value = next(values)
+                self._values = values
+                return value
+
+    def integers(self, high):
+        """ Returns a uniform random integer in [0, ``high``).
+        """
+        return int(self.random() * high)
+
+def _reset():
+    """ Creates the generator and buffer of the current process.
+    """
+    global _pid, _generator, _buffer
+    pid = os.getpid()
+    if _worker is not None and _worker[0] == pid:
+        spawn_key = (_worker[1],)
+    elif _pid is None:
+        # First process to draw random numbers, i.e. a single process server
+        spawn_key = ()
+    else:
+        # Forked from a process with a generator, without init_worker
+        spawn_key = (pid,)
+    seed = _seed if _seed is not None else getattr(settings, 'ABTEST_RNG_SEED', None)
+    sequence = np.random.SeedSequence(seed, spawn_key=spawn_key)
+    _generator = np.random.Generator(np.random.PCG64(sequence))
+    _buffer = RandomBuffer(
+        _generator, getattr(settings, 'ABTEST_RNG_BUFFER_SIZE', 4096)
+    )
+    _pid = pid
+
+def get_rng():
+    """ Returns the ``numpy.random.Generator`` of the current process.
+    """
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _reset()
+    return _generator
+
+def get_buffer():
+    """ Returns the ``RandomBuffer`` of the current process.
+    """
+    get_rng()
+    return _buffer
+
+def init_worker(index):
+    """ Seeds the generator of a newly forked worker process from the
+    ``index``-th child of the root seed sequence. Only records the index,
+    so that it can be called before Django settings are configured.
+
+    Parameters
+    ----------
+    index : int
+        Index of the worker, unique per worker process, i.e. the ``age``
+        of a gunicorn worker
+    """
+    global _worker, _pid
+    with _lock:
+        _worker = (os.getpid(), int(index))
+        _pid = None
+
+def seed(value=None):
+    """ Reseeds the generator of the current process with ``value``
+    instead of the ``ABTEST_RNG_SEED`` setting, i.e. for reproducible
+    tests. ``None`` restores the setting.
+    """
+    global _seed
+    with _lock:
+        _seed = value
+        _reset()
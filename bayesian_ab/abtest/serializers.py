@@ -2,26 +2,57 @@ from rest_framework import serializers
 
 class ABResponseSerializer(serializers.Serializer):
 
-    campaign_code = serializers.CharField(max_length=36) 
-    variant_code = serializers.CharField(max_length=32)
+    campaign_code = serializers.CharField(max_length=36, required=False) 
+    variant_code = serializers.CharField(max_length=32, required=False)
     register_impression = serializers.BooleanField()
     register_conversion = serializers.BooleanField()
     params = serializers.JSONField(required=False)
+    # Response token of stateless assignment, see tokens module
+    token = serializers.CharField(max_length=512, required=False, allow_blank=True)
+
+    def validate(self, data):
+        if not data.get('token') and not (
+            data.get('campaign_code') and data.get('variant_code')
+        ):
+            raise serializers.ValidationError(
+                'Provide either token or campaign_code and variant_code'
+            )
+        return data
 
 
 class SimPageVisitsSerializer(serializers.Serializer):
 
     campaign_code = serializers.CharField()
     conversion_rates = serializers.JSONField(required=False)
-    n = serializers.IntegerField(min_value=1, max_value=100)
+    n = serializers.IntegerField(min_value=1, max_value=1000000)
     algo = serializers.CharField(max_length=64)
 
+class AssignBatchSerializer(serializers.Serializer):
+
+    campaign_code = serializers.CharField(max_length=36)
+    n = serializers.IntegerField(min_value=1, max_value=100000, required=False)
+    user_ids = serializers.ListField(
+        child=serializers.CharField(max_length=64),
+        min_length=1,
+        max_length=100000,
+        required=False,
+    )
+    algo = serializers.CharField(max_length=64, default='thompson')
+    eps = serializers.FloatField(min_value=0.01, max_value=0.99, required=False)
+
+    def validate(self, data):
+        if ('n' in data) == ('user_ids' in data):
+            raise serializers.ValidationError('Provide either n or user_ids')
+        return data
+
 class SimulationSerializer(serializers.Serializer):
 
     # Serializer for SimulationSerializer
     p1 = serializers.FloatField(min_value=0.01, max_value=0.99)
     p2 = serializers.FloatField(min_value=0.01, max_value=0.99)
     p3 = serializers.FloatField(min_value=0.01, max_value=0.99)
+    N = serializers.IntegerField(min_value=1, max_value=1000000, required=False)
+    checkpoints = serializers.IntegerField(min_value=2, max_value=10000, required=False)
     algo = serializers.CharField(max_length=64)
     eps = serializers.FloatField(min_value=0.01, max_value=0.99, required=False)
 
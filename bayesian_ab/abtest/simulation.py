@@ -1,77 +1,407 @@
-""" The simulation module is independent from the rest of the application.
+""" The simulation module does not use the models or the database.
 Used mainly to simulate a three variant Bayesian A/B/C Test abd to generate
 the XY values for plotting the Beta distribution curves at regular checkpoints
 of the simulation. See ``experiment`` function below.
+
+Random numbers are drawn from the generator of the current process (see
+the rng module, which reads the ``ABTEST_RNG_SEED`` setting), so Django
+settings must be configured, and the curves are computed with the curves
+module.
+
+``simulate_replicates`` runs many independent replicates of the simulation
+at once on (replicates x arms) arrays, see the replication module.
 """
 
-import random
+import base64
 import numpy as np
-import scipy.stats
+from .curves import grid, pdf
+from .rng import get_rng
 
-class SimVariant:
-    """ Simple variant object for simulating A/B test.
+
+class SimVariants:
+    """ Array-backed variants of many replicates of a simulated A/B test.
+    Holds (replicates x arms) arrays of beta distribution parameters, so
+    that every replicate is advanced one step with a handful of NumPy
+    operations.
     """
-    def __init__(self, p):
+    def __init__(self, p, replicates=1):
         """
         Parameters
         ----------
-        p : float
-            The 'true' probability of converting. I.e., 
-            the probability that a user visiting this variant will 
-            generate a conversion. 0 < p < 1
+        p : array_like
+            The 'true' probability of converting of each arm. 0 < p < 1
+        replicates : int, optional
+            Number of independent replicates. Defaults to 1
+
+        a : :obj:`numpy.ndarray`
+            (replicates x arms) array of the alpha parameters, i.e. 
+            conversions + 1. a >= 1
 
-        a : int
-            Number of conversions + 1, or the alpha parameter for a beta 
-            distribution. a >= 1
+        b : :obj:`numpy.ndarray`
+            (replicates x arms) array of the beta parameters, i.e.
+            impressions - conversions + 1. b >= 1
+        """
+        self.p = np.asarray(p, dtype=float)
+        self.a = np.ones((replicates, len(self.p)), dtype=np.int64)
+        self.b = np.ones((replicates, len(self.p)), dtype=np.int64)
+        # Offsets of the rows in the flattened arrays, for updates
+        self._offsets = np.arange(replicates) * len(self.p)
+
+    def select(self, algo, step, eps=0.1, rng=None):
+        """ Select one arm per replicate with an explore-exploit algorithm.
 
-        b : int
-            Number of impressions - conversions -1, or the beta parameter
-            for a beta distribution. b >= 1
+        Parameters
+        ----------
+        algo : str
+            ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``
+        step : int
+            Number of visits simulated so far, for ``UCB1``
+        eps : float, optional
+            Exploration parameter for ``egreedy``. Defaults to 0.1
+        rng : :obj:`numpy.random.Generator`, optional
+            Random number generator for the selection.
 
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            Index of the selected arm of each replicate.
         """
-        self.p = p
-        self.a = 1
-        self.b = 1
+        rng = rng or get_rng()
+        replicates, arms = self.a.shape
+        if algo == 'thompson':
+            return self.sample(rng).argmax(axis=1)
+        if algo == 'uniform':
+            return rng.integers(arms, size=replicates)
+        rates = self.a / (self.a + self.b)
+        if algo == 'UCB1':
+            return (rates + np.sqrt(2*np.log(step+1)/(self.a + self.b))).argmax(axis=1)
+        if algo == 'egreedy':
+            selected = rates.argmax(axis=1)
+            explore = rng.random(replicates) < eps
+            selected[explore] = rng.integers(arms, size=explore.sum())
+            return selected
+        raise ValueError(f'Invalid algorithm: {algo}')
 
-    def simulate(self):
+    def simulate(self, arms, rng=None):
         """
+        Parameters
+        ----------
+        arms : :obj:`numpy.ndarray`
+            Index of the arm shown in each replicate
+        rng : :obj:`numpy.random.Generator`, optional
+            Random number generator to draw the conversions with.
+
         Returns
         -------
-        int
-            1 or 0. Returns 1 with a probability ``p``
-            and 0 with probability 1 - ``p``.
+        :obj:`numpy.ndarray`
+            1 or 0 for each replicate. 1 with probability ``p`` of the arm.
         """
-        return random.random() < self.p
+        return ((rng or get_rng()).random(len(arms)) < self.p[arms]).astype(np.int64)
 
-    def sample(self):
-        """ 
+    def sample(self, rng=None):
+        """
         Returns
         -------
-        float
-            Sample value drawn from a beta distribution X 
-            where X ~ Beta( ``a`` , ``b`` ).
+        :obj:`numpy.ndarray`
+            (replicates x arms) array of samples drawn from the beta
+            distributions X ~ Beta( ``a`` , ``b`` ).
         """
-        return np.random.beta(self.a, self.b)
+        return (rng or get_rng()).beta(self.a, self.b)
 
-    def update(self, x):
-        """ Function to update ``a`` and ``b`` parameters
-        of the beta distribution for the SimVariant instance
+    def update(self, arms, x):
+        """ Update the ``a`` and ``b`` parameters of the arm shown in
+        each replicate.
 
         Parameters
         ----------
-        x : int
-            1 if instance is updated with conversion.
-            I.e. ``a`` increment by 1
-            0 if instance is updated with no converion.
-            I.e., ``b`` increment by 1    
+        arms : :obj:`numpy.ndarray`
+            Index of the arm shown in each replicate
+        x : :obj:`numpy.ndarray`
+            1 for a conversion, 0 for no conversion, for each replicate
         """
-        self.a += x
-        self.b += 1-x
+        indices = self._offsets + arms
+        self.a.ravel()[indices] += x
+        self.b.ravel()[indices] += 1 - x
+
+
+def simulate_replicates(rates, replicates=1000, N=10000, algo='thompson', 
+                        eps=0.1, rng=None, checkpoints=None):
+    """ Simulate many independent replicates of a bayesian A/B test at
+    once. Equivalent to running ``experiment`` ``replicates`` times, 
+    with all replicates advanced one page visit per step in NumPy.
+
+    Parameters
+    ----------
+    rates : array_like
+        'true' conversion rate of each arm.
+    replicates : int, optional
+        Number of independent replicates. Defaults to 1000
+    N : int, optional
+        The number of page visits to simulate. Defaults to 10000
+    algo : str, optional
+        ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``. See 
+        ``experiment``. Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm.
+        Defaults to 0.1
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation.
+    checkpoints : list of int, optional
+        Number of visits at which the beta distribution parameters are
+        recorded, in addition to 0. Defaults to ``CHECKPOINTS``
+
+    Returns
+    -------
+    checkpoints : :obj:`numpy.ndarray`
+        Number of visits simulated at each recorded checkpoint
+    posterior : :obj:`numpy.ndarray`
+        (replicates x checkpoints x arms x 2) array of the alpha, beta
+        parameters of each arm of each replicate at each checkpoint.
+
+    Examples
+    --------
+    >>> checkpoints, posterior = simulate_replicates([0.3, 0.5, 0.7], replicates=1000)
+    >>> posterior.shape
+    (1000, 10, 3, 2)
+    """
+    rng = rng or get_rng()
+    variants = SimVariants(rates, replicates)
+    checkpoints = [0] + sorted(c for c in set(checkpoints or CHECKPOINTS) if 0 < c <= N)
+    posterior = np.empty((replicates, len(checkpoints), len(variants.p), 2), dtype=np.int64)
+    posterior[:, 0] = 1
+
+    # Index of the next checkpoint to record
+    next_checkpoint = 1
+    for i in range(N):
+        arms = variants.select(algo, i, eps=eps, rng=rng)
+        variants.update(arms, variants.simulate(arms, rng))
+        if next_checkpoint < len(checkpoints) and i+1 == checkpoints[next_checkpoint]:
+            posterior[:, next_checkpoint, :, 0] = variants.a
+            posterior[:, next_checkpoint, :, 1] = variants.b
+            next_checkpoint += 1
+
+    return np.array(checkpoints), posterior
+
+
+# Default checkpoints at which the beta distribution parameters of the
+# variants are recorded
+CHECKPOINTS = (10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+# Output formats of the checkpoints, see compact_dataset
+PAYLOADS = ('full', 'compact', 'params')
+
+def variant_codes(k):
+    """ Codes of ``k`` simulated variants, ``A`` to ``Z`` then ``AA``,
+    ``AB`` etc.
+    """
+    codes = []
+    for i in range(k):
+        code = ''
+        i += 1
+        while i:
+            i, r = divmod(i - 1, 26)
+            code = chr(ord('A') + r) + code
+        codes.append(code)
+    return codes
+
+def log_checkpoints(N, points=50):
+    """ Log-spaced checkpoint schedule from 1 to ``N`` page visits.
+
+    Parameters
+    ----------
+    N : int
+        The number of page visits simulated.
+    points : int, optional
+        Number of checkpoints before rounding to integers, which removes
+        duplicates of the first visits. Defaults to 50
+
+    Returns
+    -------
+    list of int
+
+    Examples
+    --------
+    >>> log_checkpoints(1000000, points=7)
+    [1, 10, 100, 1000, 10000, 100000, 1000000]
+    """
+    return sorted(set(np.geomspace(1, N, points).round().astype(int).tolist()))
+
+def _checkpoint(n, codes, a, b, x_vals, curves):
+    data = {'N': n}
+    for code, a_i, b_i in zip(codes, a.tolist(), b.tolist()):
+        data[code] = {'a': int(a_i), 'b': int(b_i)}
+    if curves:
+        y_vals = pdf(x_vals, a, b)
+        for code, y in zip(codes, y_vals):
+            data[f'xy_{code}'] = list(zip(x_vals, y.tolist()))
+        data['x_vals'] = x_vals
+        # The flat prior is plotted at half the height of the axis
+        data['max_y'] = float(y_vals.max()) if n else 2
+    return data
+
+def iter_experiment(rates, N=10000, algo='thompson', eps=0.1, checkpoints=None,
+                    rng=None, curves=True):
+    """ Simulate a bayesian A/B test of any number of variants with 
+    given ``N`` number of page visits, yielding each checkpoint as soon
+    as it is reached. The checkpoints are not held in memory, so any
+    number of checkpoints can be requested, i.e. to stream them to the
+    client. See ``run_experiment`` for the list of checkpoints.
+
+    The state of the variants is held in arrays and the random numbers for
+    conversions and exploration are drawn in blocks, so tests of tens of
+    variants can be simulated for millions of page visits. The checkpoint
+    schedule is sorted once, and each visit is compared to the next
+    checkpoint only.
+
+    Parameters
+    ----------
+    rates : list of float
+        'true' conversion rate of each variant. 0 < rate < 1. The variants
+        are named ``A``, ``B``, ``C`` etc., see ``variant_codes``.
+    N : int, optional
+        The number of page visits (user requests) to simulate.
+        Defaults to 10000
+    algo : str, optional
+        ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``. See 
+        ``experiment``. Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Defaults to 0.1
+    checkpoints : list of int, optional
+        Number of visits at which the beta distribution parameters are
+        recorded, in addition to 0. I.e. ``log_checkpoints(N)``. 
+        Defaults to ``CHECKPOINTS``
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation.
+    curves : bool, optional
+        If False, the (x,y) values of the beta distribution curves and
+        ``max_y`` are left out of the checkpoints. Defaults to True
+
+    Yields
+    ------
+    dict
+        Checkpoint of the simulation, see ``experiment``. Holds one
+        ``{'a':..., 'b':...}`` and, with ``curves``, one ``xy_`` list 
+        per variant code.
+
+    Examples
+    --------
+    >>> for data in iter_experiment([0.1, 0.2], N=100, curves=False):
+    ...     print(data)
+    {'N': 0, 'A': {'a': 1, 'b': 1}, 'B': {'a': 1, 'b': 1}}
+    {'N': 10, 'A': {'a': 1, 'b': 5}, 'B': {'a': 2, 'b': 5}}
+    ...
+    """
+    rng = rng or get_rng()
+    p = np.asarray(rates, dtype=float)
+    k = len(p)
+    codes = variant_codes(k)
+    p = p.tolist()
+    # Float counts save a conversion on every call to rng.beta
+    a = np.ones(k)
+    b = np.ones(k)
+    x_vals = grid().tolist()
+
+    if algo == 'thompson':
+        select = lambda i, explore, arm: int(rng.beta(a, b).argmax())
+    elif algo == 'uniform':
+        select = lambda i, explore, arm: arm
+    elif algo == 'egreedy':
+        select = lambda i, explore, arm: (
+            arm if explore < eps else int((a / (a + b)).argmax())
+        )
+    elif algo == 'UCB1':
+        select = lambda i, explore, arm: int(
+            (a/(a+b) + np.sqrt(2*np.log(i+1)/(a + b))).argmax()
+        )
+    else:
+        raise ValueError(f'Invalid algorithm: {algo}')
+
+    yield _checkpoint(0, codes, a, b, x_vals, curves)
+    schedule = iter(sorted(c for c in set(checkpoints or CHECKPOINTS) if 0 < c <= N))
+    next_checkpoint = next(schedule, None)
+
+    block = 65536
+    for start in range(0, N, block):
+        m = min(block, N - start)
+        # Conversion and exploration uniforms, and random variants
+        converts = rng.random(m).tolist()
+        explores = rng.random(m).tolist() if algo == 'egreedy' else [0.0] * m
+        arms = rng.integers(k, size=m).tolist()
+        for j in range(m):
+            i = start + j
+            selected = select(i, explores[j], arms[j])
+            if converts[j] < p[selected]:
+                a[selected] += 1
+            else:
+                b[selected] += 1
+            if i+1 == next_checkpoint:
+                yield _checkpoint(i+1, codes, a, b, x_vals, curves)
+                next_checkpoint = next(schedule, None)
+
+def run_experiment(rates, N=10000, algo='thompson', eps=0.1, checkpoints=None,
+                   rng=None, curves=True, on_checkpoint=None):
+    """ Simulate a bayesian A/B test of any number of variants with 
+    given ``N`` number of page visits. Returns the list of the checkpoints
+    of ``iter_experiment``.
+
+    Parameters
+    ----------
+    rates : list of float
+        'true' conversion rate of each variant. 0 < rate < 1. The variants
+        are named ``A``, ``B``, ``C`` etc., see ``variant_codes``.
+    N : int, optional
+        The number of page visits (user requests) to simulate.
+        Defaults to 10000
+    algo : str, optional
+        ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``. See 
+        ``experiment``. Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Defaults to 0.1
+    checkpoints : list of int, optional
+        Number of visits at which the beta distribution parameters are
+        recorded, in addition to 0. I.e. ``log_checkpoints(N)``. 
+        Defaults to ``CHECKPOINTS``
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation.
+    curves : bool, optional
+        If False, the (x,y) values of the beta distribution curves and
+        ``max_y`` are left out of the checkpoints. Defaults to True
+    on_checkpoint : callable, optional
+        Called with each checkpoint as soon as it is recorded, i.e. to 
+        report the progress of a long simulation. See the ``jobs`` module.
+
+    Returns
+    -------
+    :obj:`list` of ``dict``
+        Checkpoints of the simulation, see ``experiment``. Holds one
+        ``{'a':..., 'b':...}`` and, with ``curves``, one ``xy_`` list 
+        per variant code.
 
+    Examples
+    --------
+    >>> run_experiment(
+    ...     [0.010, 0.011, 0.012, 0.013, 0.014, 0.015, 0.016, 0.017],
+    ...     N=1000000,
+    ...     checkpoints=log_checkpoints(1000000),
+    ...     curves=False,
+    ... )[-1]
+    {'N': 1000000, 'A': {'a': 34, 'b': 3208}, ..., 'H': {'a': 15846, 'b': 920123}}
+    """
+    dataset = []
+    for data in iter_experiment(rates, N=N, algo=algo, eps=eps,
+                                checkpoints=checkpoints, rng=rng, curves=curves):
+        dataset.append(data)
+        if on_checkpoint is not None:
+            on_checkpoint(data)
+    return dataset
 
-def experiment(p1, p2, p3, N=10000, algo="thompson", eps=0.2  ):
+def experiment(p1, p2, p3, N=10000, algo="thompson", eps=0.1, rng=None,
+               curves=True, checkpoints=None):
     """ Main function to simulate a bayesian A/B/C test with 
-    given ``N`` number of page visits.
+    given ``N`` number of page visits. Three variant shortcut for 
+    ``run_experiment``.
     
     Parameters
     ----------
@@ -100,6 +430,15 @@ def experiment(p1, p2, p3, N=10000, algo="thompson", eps=0.2  ):
     eps : float, optional
         Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
         Only applicable to ``egreedy`` algorithm option. Defaults to 0.1
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation. Pass a seeded 
+        generator for reproducible results.
+    curves : bool, optional
+        If False, the (x,y) values of the beta distribution curves and
+        ``max_y`` are left out of the checkpoints. Defaults to True
+    checkpoints : list of int, optional
+        Number of visits at which the beta distribution parameters are
+        recorded, in addition to 0. Defaults to ``CHECKPOINTS``
 
     Returns
     -------
@@ -144,77 +483,110 @@ def experiment(p1, p2, p3, N=10000, algo="thompson", eps=0.2  ):
     ]
     
     """
+    return run_experiment(
+        [p1, p2, p3],
+        N=N,
+        algo=algo,
+        eps=eps,
+        checkpoints=checkpoints,
+        rng=rng,
+        curves=curves,
+    )
 
-    A = SimVariant(p=p1)
-    B = SimVariant(p=p2)
-    C = SimVariant(p=p3)
-    variants = [A, B, C]
+def compact_dataset(dataset, curves=True, points=500):
+    """ Compact form of the checkpoints of ``run_experiment``.
 
-    #  initialize dataset
-    dataset = []
-    x_vals = list(np.linspace(0,1,500))
-    init_y_val = list(scipy.stats.beta.pdf(x_vals, 1, 1))
-    init_xy_val = list(zip(x_vals, init_y_val))
-    dataset.append({
-        'N': 0,
-        'A':{'a':1, 'b' : 1 },
-        'B':{'a':1, 'b' : 1 },
-        'C':{'a':1, 'b' : 1 },
-        'xy_A': init_xy_val,
-        'xy_B': init_xy_val,
-        'x_vals': x_vals,
-        'xy_C': init_xy_val,
-        'max_y': 2,
-    })
+    The checkpoints returned by ``run_experiment`` hold the (x,y) values
+    of every curve as lists of tuples, with a copy of the x values per 
+    checkpoint. In the compact form the x values are sent once and the y
+    values of all curves are packed into one float32 array encoded in
+    base64, which is an order of magnitude smaller and faster to
+    serialize as JSON.
 
-    for i in range(N):
+    Parameters
+    ----------
+    dataset : :obj:`list` of ``dict``
+        Checkpoints returned by ``run_experiment``. Can be computed with
+        ``curves=False``, the curves are computed here.
+    curves : bool, optional
+        If False, only the beta distribution parameters are returned and
+        the curves are left to the client. Defaults to True
+    points : int, optional
+        Number of x values of the curves. Defaults to 500
+
+    Returns
+    -------
+    dict
+        The key-value pairs returned are:
+
+            * ``codes`` : List of variant codes
+            * ``N`` : List of the number of visits at each checkpoint
+            * ``a`` : List of the alpha parameters of each variant, per checkpoint
+            * ``b`` : List of the beta parameters of each variant, per checkpoint
+            * ``x_vals`` : List of the x values of the curves. Only with ``curves``
+            * ``max_y`` : List of the max value of the curves per checkpoint. Only with ``curves``
+            * ``y`` : Base64 encoded little-endian float32 array of shape (checkpoints x variants x points) of the y values of the curves. Only with ``curves``
+
+    Examples
+    --------
+    >>> compact_dataset(experiment(0.3, 0.5, 0.7, curves=False), curves=False)
+    {'codes': ['A', 'B', 'C'], 'N': [0, 10, ...], 'a': [[1, 1, 1], ...], 'b': [[1, 1, 1], ...]}
+    """
+    codes = [code for code, value in dataset[0].items() if isinstance(value, dict)]
+    a = np.array([[data[code]['a'] for code in codes] for data in dataset])
+    b = np.array([[data[code]['b'] for code in codes] for data in dataset])
+    result = {
+        'codes': codes,
+        'N': [data['N'] for data in dataset],
+        'a': a.tolist(),
+        'b': b.tolist(),
+    }
+    if not curves:
+        return result
+
+    x_vals = grid(points)
+    # (checkpoints x variants x points)
+    y_vals = pdf(x_vals, a, b)
+    max_y = y_vals.max(axis=(1, 2))
+    # The flat prior is plotted at half the height of the axis
+    max_y[np.array(result['N']) == 0] = 2
+    result['x_vals'] = x_vals.tolist()
+    result['max_y'] = max_y.tolist()
+    result['y'] = base64.b64encode(y_vals.astype('<f4').tobytes()).decode('ascii')
+    return result
+
+def iter_payload(checkpoints, payload='full', points=500):
+    """ Convert the checkpoints of ``iter_experiment`` one at a time to
+    the format of ``payload``, i.e. to stream them as newline delimited
+    JSON.
+
+    Parameters
+    ----------
+    checkpoints : iterable of ``dict``
+        Checkpoints yielded by ``iter_experiment``. With ``compact`` and
+        ``params``, can be computed with ``curves=False``.
+    payload : str, optional
+        ``full`` yields the checkpoints unchanged. ``compact`` and 
+        ``params`` yield the ``compact_dataset`` of each checkpoint, with
+        and without the curves. Since the x values are the same for all
+        checkpoints, ``x_vals`` is only included in the first one.
+        Defaults to ``full``
+    points : int, optional
+        Number of x values of the curves of ``compact``. Defaults to 500
+
+    Yields
+    ------
+    dict
+        Checkpoint in the format of ``payload``.
+    """
+    if payload not in PAYLOADS:
+        raise ValueError(f'Invalid payload: {payload}')
+    for i, data in enumerate(checkpoints):
+        if payload == 'full':
+            yield data
+            continue
+        data = compact_dataset([data], curves=payload == 'compact', points=points)
+        if i and 'x_vals' in data:
+            del data['x_vals']
+        yield data
 
-        if algo == 'uniform':
-            # Random selection
-            selected = random.sample(variants, 1)[0]
-            selected.update(selected.simulate())
-        if algo == 'thompson':
-            variants_samples = [A.sample(), B.sample(), C.sample()]
-            selected = variants[variants_samples.index(max(variants_samples))]
-            selected.update(selected.simulate())
-        if algo == 'egreedy':
-            # epsilon is default 0.1
-            if random.random() < 0.1:
-                selected = random.sample(variants, 1)[0]
-                selected.update(selected.simulate())
-            else:
-                variants_rates = [
-                    A.a/(A.a+A.b),
-                    B.a/(B.a+B.b),
-                    C.a/(C.a+C.b)
-                ]
-                selected = variants[variants_rates.index(max(variants_rates))]
-                selected.update(selected.simulate())
-        if algo == 'UCB1':
-            variants_scores = [
-                A.a/(A.a+A.b) + np.sqrt(2*np.log(i+1)/(A.a + A.b)),
-                B.a/(B.a+B.b) + np.sqrt(2*np.log(i+1)/(B.a + B.b)),
-                C.a/(C.a+C.b) + np.sqrt(2*np.log(i+1)/(C.a + C.b)),
-            ]
-            selected = variants[variants_scores.index(max(variants_scores))]
-            selected.update(selected.simulate())
-        
-        # Append data at intervals
-        if i+1 in [10, 20, 50, 100, 200, 500, 1000, 5000, 10000]:
-            data = {
-                'N': i+1,
-                'A':{'a':A.a, 'b' : A.b },
-                'B':{'a':B.a, 'b' : B.b },
-                'C':{'a':C.a, 'b' : C.b }
-            }
-            y_A = list(scipy.stats.beta.pdf(x_vals, A.a, A.b))
-            y_B = list(scipy.stats.beta.pdf(x_vals, B.a, B.b))
-            y_C = list(scipy.stats.beta.pdf(x_vals, C.a, C.b))
-            data['xy_A'] = list(zip(x_vals, y_A))
-            data['xy_B'] = list(zip(x_vals, y_B))
-            data['xy_C'] = list(zip(x_vals, y_C))
-            data['x_vals'] = x_vals
-            data['max_y'] = max([max(y_A), max(y_B), max(y_C)])
-            dataset.append(data)
-
-    return dataset
\ No newline at end of file
@@ -0,0 +1,100 @@
+""" The snapshot module contains a per-process cache of campaigns and
+their variant values, so that the assignment of variants to page requests
+needs no database round trips on the hot path.
+
+Cached snapshots expire after ``ABTEST_SNAPSHOT_TTL`` seconds. The
+bandit algorithms tolerate slightly stale counts, so the setting bounds
+how stale the impressions / conversions used for assignment may be.
+All snapshots of the process are invalidated when buffered counters are
+flushed, when counter shards are materialized and when a ``Campaign`` or
+``Variant`` is saved or deleted in the process.
+"""
+
+import time
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .counters import counters_flushed, variant_values
+from .models import Campaign, Variant
+
+_snapshots = {}
+_version = 0
+
+def invalidate():
+    """ Invalidate all cached snapshots of the current process.
+    """
+    global _version
+    _version += 1
+    _snapshots.clear()
+
+def version():
+    """ Returns the current snapshot version. The version changes
+    every time the snapshots are invalidated.
+    """
+    return _version
+
+def _cached(key, load):
+    ttl = getattr(settings, 'ABTEST_SNAPSHOT_TTL', 5.0)
+    if not ttl:
+        return load()
+
+    now = time.monotonic()
+    snapshot = _snapshots.get(key)
+    if snapshot is not None and snapshot[0] == _version and snapshot[1] > now:
+        return snapshot[2]
+
+    # Read the version before loading, so that a snapshot loaded while
+    # the cache is being invalidated is not kept
+    loaded_version = _version
+    value = load()
+    _snapshots[key] = (loaded_version, now + ttl, value)
+    return value
+
+def get_campaign(**lookup):
+    """ Cached ``Campaign.objects.get``.
+
+    Parameters
+    ----------
+    **lookup
+        Field lookups for the campaign, i.e. ``name`` or ``code``.
+
+    Returns
+    -------
+    :obj:`Campaign`
+        A/B test Campaign model object. Raises ``Campaign.DoesNotExist``
+        if the campaign does not exist.
+
+    Examples
+    --------
+    >>> get_campaign(name="Test Homepage")
+    <Campaign: AB Test Campaign: ...>
+    """
+    key = ('campaign',) + tuple(sorted(lookup.items()))
+    return _cached(key, lambda: Campaign.objects.get(**lookup))
+
+def get_variant_values(campaign):
+    """ Cached ``counters.variant_values``.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign`
+        A/B test Campaign model object
+
+    Returns
+    -------
+    tuple
+        Tuple of dictionary mappings of Variant field values ``code``
+        ``impressions`` ``conversions`` ``conversion_rate``
+        ``html_template``, ordered by ``code``. The mappings are shared
+        between callers and must not be modified.
+    """
+    key = ('variants', campaign.pk)
+    return _cached(key, lambda: tuple(variant_values(campaign)))
+
+@receiver(counters_flushed)
+@receiver(post_save, sender=Campaign)
+@receiver(post_delete, sender=Campaign)
+@receiver(post_save, sender=Variant)
+@receiver(post_delete, sender=Variant)
+def _invalidate_snapshots(sender, **kwargs):
+    invalidate()
@@ -1,9 +1,37 @@
 from django.contrib.sessions.middleware import SessionMiddleware
-from django.test import TestCase, RequestFactory
-from .models import Campaign, Variant
-from .simulation import experiment
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory, override_settings
+from io import StringIO
+from unittest import mock
+import base64
+import gzip
+import os
+import tempfile
+import threading
+import json
+import uuid
+import numpy as np
+from .models import Campaign, SimulationJob, Variant, VariantCounterShard
+from .simulation import (experiment, run_experiment, simulate_replicates,
+                         log_checkpoints, variant_codes, compact_dataset,
+                         iter_experiment, iter_payload)
+from .replication import replicate
+from .counters import (increment_variant, bulk_increment,
+                       variant_values, materialize_shards)
+from .buffer import EventBuffer, record_response
+from .snapshot import get_campaign, get_variant_values
+from .memo import LRUCache
+from .jobs import submit
+from .pool import ThompsonPool, get_pool
+from . import rng
+from .curves import _curve_cache, clear_cache, curves, grid
 from .utils import (epsilon_greedy, thompson_sampling, UCB1,
-                    h, loss, ab_assign, sim_page_visits)
+                    h, loss, select_method, decision_matrix, ab_assign,
+                    ab_assign_batch, sim_page_visits, simulate_visits,
+                    clear_decision_cache, allocation_weights, assign_visitor)
+from .middleware import Visitor, get_visitor
+from .tokens import issue_token, read_token
+from .dedup import BloomFilter, RotatingBloomFilter, get_filter
 
 class AlgorithmTests(TestCase):
 
@@ -48,6 +76,17 @@ class AlgorithmTests(TestCase):
         
         self.assertTrue(selected_variant in list(self.variant_vals))
 
+    def test_thompson_sampling_many_variants(self):
+        # Variant with the dominant posterior is selected among many
+        variant_vals = [
+            {'code': str(i), 'impressions': 1000, 'conversions': 1}
+            for i in range(300)
+        ]
+        variant_vals[123]['conversions'] = 900
+        selected_variant = thompson_sampling(variant_vals)
+
+        self.assertEqual(selected_variant['code'], '123')
+
     def test_ucb1(self):
 
         selected_variant = UCB1(self.variant_vals)
@@ -68,15 +107,123 @@ class DecicsionRuleTest(TestCase):
 
     def test_h_2(self):
 
-        self.assertEqual(h(99,123,23,36), 0.784752290600683)
+        self.assertAlmostEqual(h(99,123,23,36), 0.784752290600683, places=12)
 
     def test_loss_1(self):
 
-        self.assertEqual(loss(1,1,1,1), 0.16666666666666669)
+        self.assertAlmostEqual(loss(1,1,1,1), 0.16666666666666669, places=12)
 
     def test_loss_2(self):
 
-        self.assertEqual(loss(23,36,78,120), 0.026744171285783824)
+        self.assertAlmostEqual(loss(23,36,78,120), 0.026744171285783824, places=12)
+
+    def test_h_symmetry(self):
+        # P(X>Y) + P(Y>X) = 1, whichever parameter the series runs over
+        for a, b, c, d in [(5, 300, 40, 7), (1000, 20, 3, 9), (17, 17, 17, 16)]:
+            self.assertAlmostEqual(h(a, b, c, d) + h(c, d, a, b), 1, places=12)
+
+    def test_h_large_counts(self):
+        # Million-scale counts
+        self.assertAlmostEqual(h(50000, 950000, 51000, 949000), 0.00062, places=5)
+        self.assertAlmostEqual(h(500000, 500000, 500000, 500000), 0.5, places=3)
+
+    def test_h_methods(self):
+        # Approximate methods agree with the exact closed form
+        exact_h = h(2000, 18000, 2100, 17900)
+        exact_loss = loss(2000, 18000, 2100, 17900)
+        for method, places in [('quad', 9), ('normal', 3), ('mc', 2), ('auto', 4)]:
+            self.assertAlmostEqual(h(2000, 18000, 2100, 17900, method=method), exact_h, places=places)
+            self.assertAlmostEqual(loss(2000, 18000, 2100, 17900, method=method), exact_loss, places=places)
+
+    def test_loss_quad_asymmetric(self):
+        # Quadrature runs over the narrower posterior, whichever it is
+        for a, b, c, d in [(12000, 30000, 900000, 2200000), (20000, 180000, 2000000, 18000000)]:
+            exact_loss = loss(a, b, c, d, method='exact', cache=False)
+            self.assertAlmostEqual(loss(a, b, c, d, method='quad'), exact_loss, places=10)
+            self.assertAlmostEqual(loss(a, b, c, d, method='auto', tol=1e-9), exact_loss, places=10)
+
+    def test_select_method(self):
+
+        self.assertEqual(select_method(3, 5, 4, 2), 'exact')
+        self.assertEqual(select_method(100000, 900000, 101000, 899000), 'normal')
+        self.assertEqual(select_method(20000, 30000, 40000, 50000, tol=1e-12), 'quad')
+
+    def test_decision_matrix(self):
+        # Batched pairwise decision rules agree with h() and loss()
+        counts = [(99, 123), (23, 36), (78, 120), (2000, 18000)]
+        variant_vals = [
+            {'code': code, 'impressions': a + b, 'conversions': a}
+            for code, (a, b) in zip('ABCD', counts)
+        ]
+        decision = decision_matrix(variant_vals)
+        self.assertEqual(decision['codes'], ['A', 'B', 'C', 'D'])
+        for i, (a, b) in enumerate(counts):
+            for j, (c, d) in enumerate(counts):
+                if i == j:
+                    continue
+                self.assertAlmostEqual(decision['prob'][i, j], h(a, b, c, d), places=8)
+                self.assertAlmostEqual(decision['loss'][i, j], loss(a, b, c, d), places=8)
+        self.assertAlmostEqual(decision['p_best'].sum(), 1, places=8)
+        self.assertTrue((decision['expected_loss'] >= 0).all())
+
+    def test_decision_matrix_two_variants(self):
+        # With two variants P(best) of X is P(X>Y) and the expected loss
+        # of choosing X is loss(Y,X)
+        variant_vals = [
+            {'code': 'A', 'impressions': 59, 'conversions': 23},
+            {'code': 'B', 'impressions': 198, 'conversions': 78},
+        ]
+        decision = decision_matrix(variant_vals)
+        self.assertAlmostEqual(decision['p_best'][0], h(23, 36, 78, 120), places=8)
+        self.assertAlmostEqual(decision['expected_loss'][0], loss(78, 120, 23, 36), places=8)
+
+    def test_h_cache(self):
+        # Cached results are the uncached results
+        clear_decision_cache()
+        for method in ['exact', 'normal', 'quad']:
+            expected = h(2000, 18000, 2100, 17900, method=method, cache=False)
+            self.assertEqual(h(2000, 18000, 2100, 17900, method=method), expected)
+            self.assertEqual(h(2000, 18000, 2100, 17900, method=method), expected)
+            expected = loss(2000, 18000, 2100, 17900, method=method, cache=False)
+            self.assertAlmostEqual(loss(2000, 18000, 2100, 17900, method=method), expected, places=12)
+            self.assertAlmostEqual(loss(2000, 18000, 2100, 17900, method=method), expected, places=12)
+
+    def test_h_incremental(self):
+        # Adding impressions / conversions updates the cached value
+        # with the recurrences instead of restarting the series
+        clear_decision_cache()
+        a, b, c, d = 2000, 18000, 2100, 17900
+        h(a, b, c, d)
+        for delta in [(1, 9, 0, 10), (0, 10, 2, 8), (3, 0, 0, 0), (-2, -5, 1, 4)]:
+            a, b, c, d = [x + y for x, y in zip((a, b, c, d), delta)]
+            with mock.patch('abtest.utils._h_exact') as h_exact:
+                value = h(a, b, c, d)
+            h_exact.assert_not_called()
+            self.assertAlmostEqual(value, h(a, b, c, d, cache=False), places=10)
+
+    def test_decision_matrix_cache(self):
+        clear_decision_cache()
+        variant_vals = [
+            {'code': 'A', 'impressions': 59, 'conversions': 23},
+            {'code': 'B', 'impressions': 198, 'conversions': 78},
+        ]
+        first = decision_matrix(variant_vals)
+        second = decision_matrix(variant_vals)
+        self.assertIs(first['prob'], second['prob'])
+        self.assertFalse(first['prob'].flags.writeable)
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put((1, 1, 1, 1), 0.5)
+        cache.put((2, 1, 1, 1), 0.6)
+        cache.get((1, 1, 1, 1))
+        cache.put((3, 1, 1, 1), 0.7)
+        # Least recently used entry evicted
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get((2, 1, 1, 1)))
+        self.assertEqual(cache.get((1, 1, 1, 1)), 0.5)
+        self.assertEqual(cache.nearest((3, 2, 1, 1), max_distance=1), ((3, 1, 1, 1), 0.7))
+        self.assertIsNone(cache.nearest((9, 9, 9, 9), max_distance=1))
 
 class ABAssignmentTest(TestCase):
     '''
@@ -142,6 +289,42 @@ class ABAssignmentTest(TestCase):
         )
         self.assertTrue(selected_variant in list(self.variant_vals))
 
+    @override_settings(ABTEST_THOMPSON_POOL_SIZE=64)
+    def test_ab_assign_thompson_pool(self):
+        # Assignments are made from the pre-drawn winners
+        pool = get_pool(self.campaign)
+        for _ in range(10):
+            selected_variant = ab_assign(
+                self.request, 
+                self.campaign, 
+                algo='thompson',
+                sticky_session=False,
+                default_template='/abtest/homepage.html', 
+            )
+            self.assertTrue(selected_variant in list(self.variant_vals))
+        self.assertEqual(pool.draws, 1)
+
+    def test_thompson_pool(self):
+        pool = ThompsonPool(size=100, background=False, rng=np.random.default_rng(0))
+        variants = (
+            {'code': 'A', 'impressions': 1000, 'conversions': 100},
+            {'code': 'B', 'impressions': 1000, 'conversions': 500},
+        )
+        winners = [pool.next(variants) for _ in range(100)]
+        self.assertEqual(pool.draws, 1)
+        self.assertEqual(set(winners), {1})
+        # The ring wraps around and is redrawn
+        pool.next(variants)
+        self.assertEqual(pool.draws, 2)
+        # A new snapshot triggers a redraw from the new posterior
+        variants = (
+            {'code': 'A', 'impressions': 1000, 'conversions': 500},
+            {'code': 'B', 'impressions': 1000, 'conversions': 100},
+        )
+        pool.next(variants)
+        self.assertEqual(pool.draws, 3)
+        self.assertEqual({pool.next(variants) for _ in range(99)}, {0})
+
     def test_ab_assign_ucb1(self):
         # Test assign with ucb1 algorithm
         selected_variant = ab_assign(
@@ -162,6 +345,97 @@ class ABAssignmentTest(TestCase):
         )
         self.assertTrue(selected_variant in list(self.variant_vals))
 
+    def test_ab_assign_stateless(self):
+        # No session writes, the assignment is kept in the visitor cookie
+        request = self.request_factory.get('/')
+        request.session = mock.Mock()
+        selected_variant = ab_assign(
+            request,
+            self.campaign,
+            default_template='/abtest/homepage.html',
+            stateless=True,
+        )
+        token = read_token(selected_variant.pop('token'))
+        self.assertTrue(selected_variant in list(self.variant_vals))
+        self.assertEqual(request.session.mock_calls, [])
+        visitor = get_visitor(request)
+        self.assertTrue(visitor.changed)
+        self.assertEqual(
+            visitor.assignments[str(self.campaign.code)], selected_variant['code']
+        )
+        self.assertEqual(token['u'], visitor.id)
+        self.assertEqual(token['v'], selected_variant['code'])
+        # Sticky assignment read back from the cookie
+        Variant.objects.filter(code=selected_variant['code']).update(impressions=10**6)
+        assigned = ab_assign(request, self.campaign, '/abtest/homepage.html', stateless=True)
+        assigned.pop('token')
+        self.assertEqual(assigned, selected_variant)
+
+    def test_assign_visitor(self):
+        # Same visitor same variant, shares follow the allocation weights
+        Variant.objects.filter(code='A').update(impressions=1000, conversions=500)
+        Variant.objects.filter(code__in=['B', 'C']).update(impressions=1000, conversions=100)
+        for algo in ['thompson', 'egreedy', 'UCB1', 'uniform']:
+            weights = allocation_weights(self.variant_vals, algo=algo)
+            self.assertAlmostEqual(weights.sum(), 1)
+            codes = [
+                assign_visitor(self.campaign, f'visitor-{i}', algo=algo)['code']
+                for i in range(2000)
+            ]
+            self.assertEqual(
+                codes[:20],
+                [assign_visitor(self.campaign, f'visitor-{i}', algo=algo)['code'] 
+                 for i in range(20)],
+            )
+            for var, weight in zip(self.variant_vals, weights):
+                self.assertAlmostEqual(codes.count(var['code']) / 2000, weight, delta=0.05)
+        self.assertEqual(list(allocation_weights(self.variant_vals, 'UCB1')), [1, 0, 0])
+
+    @override_settings(ABTEST_STATELESS_ASSIGNMENT=True)
+    def test_visitor_cookie(self):
+        # Signed cookie set once per visitor, tampered cookies are replaced
+        response = self.client.get('/')
+        cookie = response.cookies['abtest']
+        self.assertTrue(cookie['httponly'])
+        self.assertNotIn('sessionid', response.cookies)
+        request = self.request_factory.get('/')
+        request.COOKIES['abtest'] = cookie.value
+        visitor = get_visitor(request)
+        self.assertFalse(visitor.changed)
+        response = self.client.get('/')
+        self.assertNotIn('abtest', response.cookies)
+
+        tampered = Visitor('someone-else').dumps() + cookie.value[cookie.value.index(':'):]
+        self.client.cookies['abtest'] = tampered
+        response = self.client.get('/')
+        self.assertNotEqual(response.cookies['abtest'].value, cookie.value)
+        request = self.request_factory.get('/')
+        request.COOKIES['abtest'] = response.cookies['abtest'].value
+        self.assertNotEqual(get_visitor(request).id, visitor.id)
+        self.assertNotEqual(get_visitor(request).id, 'someone-else')
+
+    def test_ab_assign_batch(self):
+        # Batch assignment for all algorithms
+        codes = [var['code'] for var in self.variant_vals]
+        for algo in ['thompson', 'egreedy', 'UCB1', 'uniform']:
+            assigned = ab_assign_batch(self.campaign, n=50, algo=algo)
+            self.assertEqual(len(assigned), 50)
+            self.assertTrue(set(assigned) <= set(codes))
+
+    def test_assign_batch_api(self):
+        # Assignments mapped to the user ids provided
+        response = self.client.post(
+            '/api/experiment/assign_batch',
+            {
+                'campaign_code': str(self.campaign.code),
+                'user_ids': ['u1', 'u2', 'u3'],
+                'algo': 'thompson',
+            },
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['assignments']), {'u1', 'u2', 'u3'})
+
 class SimulationTests(TestCase):
 
     ''' Test cases for simulation-related functions
@@ -233,6 +507,70 @@ class SimulationTests(TestCase):
 
         self.assertTrue(all_simulated)
 
+    def test_sim_page_visits_queries(self):
+        # Simulation runs in memory, counters written back in one UPDATE
+        before = sum(var['impressions'] for var in variant_values(self.campaign))
+        with self.assertNumQueries(2):
+            sim_page_visits(self.campaign, 10000, {'A': 0.1, 'B': 0.2, 'C': 0.3})
+        variant_vals = variant_values(self.campaign)
+        self.assertEqual(sum(var['impressions'] for var in variant_vals) - before, 10000)
+        for var in variant_vals:
+            self.assertEqual(var['conversion_rate'], var['conversions'] / max(var['impressions'], 1))
+
+    def test_simulate_visits(self):
+        for algo in ['thompson', 'egreedy', 'UCB1', 'uniform']:
+            impressions, conversions = simulate_visits(
+                [10, 0], [1, 0], [0.0, 1.0], 500, algo=algo, batch_size=1
+            )
+            self.assertEqual(impressions.sum(), 510)
+            self.assertEqual(conversions[0], 1)
+            self.assertEqual(conversions[1], impressions[1])
+        # The bandit state is updated between rounds
+        impressions, conversions = simulate_visits([0, 0], [0, 0], [0.05, 0.5], 10000)
+        self.assertGreater(impressions[1], impressions[0])
+
+    def test_dashboard(self):
+        # Dashboard renders the decision rules of any number of variants
+        Variant.objects.create(
+            campaign=self.campaign,
+            code='D',
+            name='Homepage Design D',
+            html_template='abtest/homepage_D.html',
+        )
+        sim_page_visits(self.campaign, 200, {'A': 0.1, 'B': 0.2, 'C': 0.3, 'D': 0.4})
+        response = self.client.get('/dashboard')
+        self.assertEqual(response.status_code, 200)
+        variant_vals = response.context['variant_vals']
+        self.assertEqual([var['code'] for var in variant_vals], ['A', 'B', 'C', 'D'])
+        self.assertAlmostEqual(sum(var['p_best'] for var in variant_vals), 1, places=6)
+        self.assertEqual(len(variant_vals[0]['prob']), 4)
+        self.assertIsNone(variant_vals[0]['prob'][0])
+
+    def test_curves(self):
+        import scipy.stats
+        clear_cache()
+        x, y = curves([1, 5, 30], [1, 20, 70])
+        self.assertIs(x, grid())
+        self.assertFalse(x.flags.writeable)
+        np.testing.assert_allclose(
+            y, scipy.stats.beta.pdf(x, [[1], [5], [30]], [[1], [20], [70]]), rtol=1e-9
+        )
+        # Cached curves are reused
+        hits = _curve_cache.hits
+        _, y2 = curves([30, 1], [70, 1])
+        self.assertEqual(_curve_cache.hits, hits + 2)
+        np.testing.assert_array_equal(y2, y[[2, 0]])
+        # Large counts narrow the grid to the posterior mass, where the
+        # log-space PDF stays finite
+        x, y = curves([200000, 210000], [800000, 790000], adaptive=True)
+        self.assertGreater(x[0], 0.19)
+        self.assertLess(x[-1], 0.22)
+        self.assertTrue(np.isfinite(y).all())
+        self.assertAlmostEqual(y[0].sum() * (x[1] - x[0]), 1, places=3)
+        # Wide posteriors keep the shared grid
+        x, _ = curves([1, 2], [1, 2], adaptive=True)
+        self.assertIs(x, grid())
+
     def test_experiment_1(self):
         # Test experiment function for simulating 2 variant A/B test
         # Test for all algorithms
@@ -244,4 +582,647 @@ class SimulationTests(TestCase):
                 p3=0.66,
                 N=10000,
             )
-        self.assertTrue(dataset)
\ No newline at end of file
+        self.assertTrue(dataset)
+
+    def test_experiment_seeded(self):
+        # Same seed, same trajectory
+        first = experiment(0.1, 0.2, 0.3, N=500, algo='egreedy', eps=0.2,
+                           rng=np.random.default_rng(1), curves=False)
+        second = experiment(0.1, 0.2, 0.3, N=500, algo='egreedy', eps=0.2,
+                            rng=np.random.default_rng(1), curves=False)
+        self.assertEqual(first, second)
+        self.assertNotIn('xy_A', first[-1])
+
+    def test_replicate(self):
+        grid = [{'p1': 0.1, 'p2': 0.2, 'p3': 0.3}, {'p1': 0.5, 'p2': 0.4, 'p3': 0.3}]
+        summaries = replicate(grid, ['thompson', 'uniform'], replicates=4,
+                              N=200, seed=7, workers=1)
+        self.assertEqual(len(summaries), 4)
+        self.assertEqual(summaries[3]['params'], grid[1])
+        self.assertEqual(summaries[3]['algo'], 'uniform')
+        self.assertEqual(summaries[0]['N'], [0, 10, 20, 50, 100, 200])
+        regret = summaries[0]['regret']
+        self.assertEqual(regret['mean'][0], 0)
+        self.assertLessEqual(regret['quantiles'][0.05][-1], regret['mean'][-1])
+        self.assertLessEqual(regret['mean'][-1], regret['quantiles'][0.95][-1])
+        self.assertEqual(set(summaries[0]['posterior']), {'A', 'B', 'C'})
+
+    def test_run_experiment(self):
+        # Any number of variants with a custom checkpoint schedule
+        rates = np.linspace(0.01, 0.2, 12)
+        for algo in ['thompson', 'egreedy', 'UCB1', 'uniform']:
+            dataset = run_experiment(rates, N=5000, algo=algo, 
+                                     checkpoints=log_checkpoints(5000, points=10))
+            self.assertEqual(dataset[-1]['N'], 5000)
+            self.assertEqual(
+                [data['N'] for data in dataset], 
+                [0] + log_checkpoints(5000, points=10),
+            )
+            visits = sum(
+                dataset[-1][code]['a'] + dataset[-1][code]['b'] - 2 
+                for code in variant_codes(12)
+            )
+            self.assertEqual(visits, 5000)
+            self.assertIn('xy_L', dataset[-1])
+
+    def test_variant_codes(self):
+        self.assertEqual(variant_codes(3), ['A', 'B', 'C'])
+        self.assertEqual(variant_codes(28)[25:], ['Z', 'AA', 'AB'])
+        self.assertEqual(log_checkpoints(1000, points=4), [1, 10, 100, 1000])
+
+    def test_compact_dataset(self):
+        full = experiment(0.3, 0.5, 0.7, N=500, rng=np.random.default_rng(2))
+        compact = compact_dataset(
+            experiment(0.3, 0.5, 0.7, N=500, rng=np.random.default_rng(2), curves=False)
+        )
+        self.assertEqual(compact['codes'], ['A', 'B', 'C'])
+        self.assertEqual(compact['N'], [data['N'] for data in full])
+        y = np.frombuffer(base64.b64decode(compact['y']), dtype='<f4')
+        y = y.reshape(len(full), 3, 500)
+        for i, data in enumerate(full):
+            self.assertEqual(compact['a'][i][2], data['C']['a'])
+            self.assertAlmostEqual(compact['max_y'][i], data['max_y'], places=6)
+            np.testing.assert_allclose(y[i, 1], [xy[1] for xy in data['xy_B']], rtol=1e-6)
+
+    def test_run_simulation_payload(self):
+        params = {'p1': 0.3, 'p2': 0.5, 'p3': 0.7, 'algo': 'thompson'}
+        sizes = {}
+        for payload in ['full', 'compact', 'params']:
+            response = self.client.post(
+                f'/api/experiment/simulation?payload={payload}',
+                params,
+                content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 200)
+            sizes[payload] = len(response.content)
+            self.assertEqual('y' in response.json(), payload == 'compact')
+        self.assertLess(sizes['compact'] * 5, sizes['full'])
+        self.assertLess(sizes['params'] * 100, sizes['full'])
+        response = self.client.post(
+            '/api/experiment/simulation?payload=xml', params,
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/simulation').status_code, 200)
+
+    def test_iter_experiment(self):
+        checkpoints = iter_experiment([0.2, 0.4], N=1000, rng=np.random.default_rng(5))
+        self.assertEqual(next(checkpoints)['N'], 0)
+        self.assertEqual(
+            [data['N'] for data in checkpoints], [10, 20, 50, 100, 200, 500, 1000]
+        )
+        self.assertEqual(
+            list(iter_experiment([0.2, 0.4], N=1000, rng=np.random.default_rng(5), curves=False)),
+            run_experiment([0.2, 0.4], N=1000, rng=np.random.default_rng(5), curves=False),
+        )
+        dataset = run_experiment([0.2, 0.4], N=1000, rng=np.random.default_rng(5))
+        lines = list(iter_payload(iter(dataset), 'compact'))
+        self.assertIn('x_vals', lines[0])
+        self.assertNotIn('x_vals', lines[1])
+        self.assertEqual([line['N'] for line in lines], [[data['N']] for data in dataset])
+        with self.assertRaises(ValueError):
+            next(iter_payload(iter(dataset), 'xml'))
+
+    def test_stream_simulation(self):
+        params = {
+            'p1': 0.3, 'p2': 0.5, 'p3': 0.7, 'algo': 'thompson',
+            'N': 5000, 'checkpoints': 20,
+        }
+        response = self.client.post(
+            '/api/experiment/simulation/stream?payload=params',
+            params,
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [
+            json.loads(line)
+            for line in b''.join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(lines[0]['N'], [0])
+        self.assertEqual(lines[-1]['N'], [5000])
+        self.assertEqual(len(lines), 1 + len(log_checkpoints(5000, points=20)))
+        self.assertEqual(sum(lines[-1]['a'][0]) + sum(lines[-1]['b'][0]), 5000 + 6)
+        response = self.client.post(
+            '/api/experiment/simulation/stream', dict(params, algo='bogus'),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        # Simulations too long for the request are not streamed
+        response = self.client.post(
+            '/api/experiment/simulation/stream', dict(params, N=20000),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(ABTEST_JOBS_EAGER=True)
+    def test_simulation_job(self):
+        params = {'p1': 0.3, 'p2': 0.5, 'p3': 0.7, 'algo': 'thompson', 'N': 20000}
+        response = self.client.post(
+            '/api/experiment/simulation?payload=params&async=1',
+            params,
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        data = self.client.get(status_url).json()
+        self.assertEqual(data['status'], SimulationJob.DONE)
+        self.assertEqual(data['progress'], 1.0)
+        self.assertEqual(data['result']['N'][-1], 20000)
+        self.assertEqual([c['N'] for c in data['checkpoints']], data['result']['N'])
+        self.assertEqual(data['checkpoints'][-1]['C']['a'], data['result']['a'][-1][2])
+        # Only the checkpoints after ``since`` are returned
+        later = self.client.get(status_url, {'since': data['next'] - 2}).json()
+        self.assertEqual(later['checkpoints'], data['checkpoints'][-2:])
+        self.assertEqual(self.client.get(status_url, {'since': 'x'}).status_code, 400)
+        self.assertEqual(
+            self.client.get(f'/api/jobs/{uuid.uuid4()}').status_code, 404
+        )
+        # Simulations too long for the request run as jobs without async
+        response = self.client.post(
+            '/api/experiment/simulation?payload=params', params,
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 202)
+
+    @override_settings(ABTEST_JOBS_EAGER=True)
+    def test_page_visits_job(self):
+        before = sum(var['impressions'] for var in variant_values(self.campaign))
+        with mock.patch('abtest.jobs.PAGE_VISITS_CHUNK', 1000):
+            response = self.client.post(
+                '/api/sim_page_views?async=true',
+                {'campaign_code': self.campaign.code, 'n': 2500, 'algo': 'uniform'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 202)
+        job = SimulationJob.objects.get(pk=response.json()['job'])
+        self.assertEqual(job.status, SimulationJob.DONE)
+        self.assertEqual(
+            [c['n'] for c in json.loads(job.checkpoints)], [1000, 2000, 2500]
+        )
+        after = sum(var['impressions'] for var in variant_values(self.campaign))
+        self.assertEqual(after - before, 2500)
+
+    @override_settings(ABTEST_JOBS_EAGER=True)
+    def test_failed_job(self):
+        with self.assertLogs('abtest.jobs', 'ERROR'):
+            job = submit(SimulationJob.SIMULATION, {'rates': [0.1, 0.2], 'algo': 'bogus'})
+        self.assertEqual(job.status, SimulationJob.FAILED)
+        self.assertEqual(job.error, 'Invalid algorithm: bogus')
+        with self.assertRaises(ValueError):
+            submit('bogus', {})
+
+    def test_simulate_replicates(self):
+        for algo in ['thompson', 'egreedy', 'UCB1', 'uniform']:
+            checkpoints, posterior = simulate_replicates(
+                [0.1, 0.9], replicates=50, N=300, algo=algo,
+                rng=np.random.default_rng(0),
+            )
+            self.assertEqual(checkpoints.tolist(), [0, 10, 20, 50, 100, 200])
+            self.assertEqual(posterior.shape, (50, 6, 2, 2))
+            # Visits of every replicate add up to the checkpoint
+            visits = posterior.sum(axis=3).sum(axis=2) - 4
+            self.assertTrue((visits == checkpoints).all())
+
+    def test_replicate_vectorized(self):
+        grid = [{'p1': 0.3, 'p2': 0.5, 'p3': 0.7}]
+        thompson, uniform = replicate(grid, ['thompson', 'uniform'], 
+                                      replicates=200, N=1000, seed=1, 
+                                      vectorized=True)
+        self.assertEqual(uniform['N'][-1], 1000)
+        # Expected regret of uniform sampling is N * (0.4 + 0.2) / 3
+        self.assertAlmostEqual(uniform['regret']['mean'][-1] / 200, 1, places=1)
+        self.assertLess(thompson['regret']['mean'][-1], uniform['regret']['mean'][-1])
+
+    def test_replicate_rates(self):
+        summaries = replicate([{'rates': [0.1, 0.2, 0.3, 0.4], 'checkpoints': [50, 100]}],
+                              ['egreedy'], replicates=3, N=100, seed=0, workers=1)
+        self.assertEqual(summaries[0]['N'], [0, 50, 100])
+        self.assertEqual(set(summaries[0]['posterior']), {'A', 'B', 'C', 'D'})
+
+    def test_replicate_workers(self):
+        # Results for a seed do not depend on the number of workers
+        grid = [{'p1': 0.1, 'p2': 0.2, 'p3': 0.3}]
+        self.assertEqual(
+            replicate(grid, ['thompson'], replicates=3, N=100, seed=3, workers=1),
+            replicate(grid, ['thompson'], replicates=3, N=100, seed=3, workers=2),
+        )
+
+class CounterTests(TestCase):
+
+    ''' Test cases for atomic variant counter updates
+    '''
+    campaign = None
+
+    def setUp(self):
+
+        self.campaign, created = Campaign.objects.get_or_create(
+            name="Test Homepage",
+            description="Testing Homepage designs"    
+        )
+        for code in ['A', 'B', 'C']:
+            variant, created = Variant.objects.get_or_create(
+                campaign=self.campaign,
+                code=code,
+                name=f'Homepage Design {code}',
+                html_template=f'abtest/homepage_{code}.html'
+            )
+
+    def test_increment_variant(self):
+        # Counters and conversion rate are updated in a single statement
+        with self.assertNumQueries(1):
+            updated = increment_variant(self.campaign, 'A', impressions=3, conversions=1)
+        variant = Variant.objects.get(campaign=self.campaign, code='A')
+        self.assertEqual(updated, 1)
+        self.assertEqual(variant.impressions, 4)
+        self.assertEqual(variant.conversions, 2)
+        self.assertEqual(variant.conversion_rate, 0.5)
+
+    def test_increment_variant_not_found(self):
+
+        self.assertEqual(increment_variant(self.campaign, 'Z', impressions=1), 0)
+
+    def test_ab_response(self):
+        # Impression registered through the response API
+        self.client.get('/')
+        variant_code = [
+            code for code in ['A', 'B', 'C']
+            if self.client.session[str(self.campaign.code)].get('code') == code
+        ][0]
+        response = self.client.post(
+            '/api/experiment/response',
+            {
+                'campaign_code': str(self.campaign.code),
+                'variant_code': variant_code,
+                'register_impression': True,
+                'register_conversion': False,
+            },
+            content_type='application/json',
+        )
+        variant = Variant.objects.get(campaign=self.campaign, code=variant_code)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(variant.impressions, 2)
+
+    @override_settings(ABTEST_DEDUP_DIR=None)
+    def test_ab_response_token(self):
+        # Responses with a token need no session, repeats are not counted
+        self.campaign.allow_repeat = False
+        self.campaign.save()
+        token = issue_token(self.campaign.code, 'B', 'visitor-1')
+        data = {
+            'token': token,
+            'register_impression': True,
+            'register_conversion': False,
+        }
+        before = Variant.objects.get(campaign=self.campaign, code='B').impressions
+        for _ in range(2):
+            response = self.client.post(
+                '/api/experiment/response', data, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertNotIn('sessionid', self.client.cookies)
+        variant = Variant.objects.get(campaign=self.campaign, code='B')
+        self.assertEqual(variant.impressions - before, 1)
+        # Sized for an impression and a conversion key per visitor
+        with override_settings(ABTEST_DEDUP_CAPACITY=1000):
+            self.assertEqual(get_filter(uuid.uuid4()).capacity, 2000)
+
+        # Tampered tokens and tokens of other variants are rejected
+        for data in [
+            {'token': token + 'x'},
+            {'token': token, 'variant_code': 'A'},
+        ]:
+            response = self.client.post(
+                '/api/experiment/response',
+                {**data, 'register_impression': True, 'register_conversion': False},
+                content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(ABTEST_DEDUP_DIR=None)
+    def test_batch_response(self):
+        # Valid responses aggregated per variant, a result per response
+        code = str(self.campaign.code)
+        before = {v.code: v.impressions for v in self.campaign.variants.all()}
+        events = [
+            {'campaign_code': code, 'variant_code': 'A', 
+             'register_impression': True, 'register_conversion': False},
+            {'campaign_code': code, 'variant_code': 'A', 
+             'register_impression': True, 'register_conversion': True},
+            {'campaign_code': code, 'variant_code': 'B', 
+             'register_impression': True, 'register_conversion': False},
+            {'campaign_code': code, 'variant_code': 'Z', 
+             'register_impression': True, 'register_conversion': False},
+            {'campaign_code': str(uuid.uuid4()), 'variant_code': 'A', 
+             'register_impression': True, 'register_conversion': False},
+            {'campaign_code': 'not-a-uuid', 'variant_code': 'A', 
+             'register_impression': True, 'register_conversion': False},
+            {'campaign_code': code, 'register_impression': True},
+        ]
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                '/api/experiment/responses', events, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(response.json()['registered'], 3)
+        self.assertEqual([r['registered'] for r in results], [True] * 3 + [False] * 4)
+        self.assertEqual(results[3]['details'], 'Variant not found')
+        self.assertEqual(results[4]['details'], 'Campaign not found')
+        self.assertEqual(results[5]['details'], 'Campaign not found')
+        self.assertIn('errors', results[6])
+        after = {v.code: v for v in self.campaign.variants.all()}
+        self.assertEqual(after['A'].impressions - before['A'], 2)
+        self.assertEqual(after['B'].impressions - before['B'], 1)
+
+        # Newline delimited JSON, tokens required without repeats
+        self.campaign.allow_repeat = False
+        self.campaign.save()
+        token = issue_token(code, 'C', f'visitor-{uuid.uuid4()}')
+        response = self.client.post(
+            '/api/experiment/responses',
+            '\n'.join(json.dumps(event) for event in [
+                events[0],
+                {'token': token, 'register_impression': True, 'register_conversion': False},
+                {'token': token, 'register_impression': True, 'register_conversion': False},
+            ]),
+            content_type='application/x-ndjson',
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['registered'] for r in results], [False, True, True])
+        self.assertEqual(
+            Variant.objects.get(campaign=self.campaign, code='C').impressions - before['C'], 1
+        )
+
+    @override_settings(ABTEST_BATCH_MAX_EVENTS=2)
+    def test_batch_response_invalid(self):
+        for body in [{'campaign_code': 'x'}, [{}] * 3]:
+            response = self.client.post(
+                '/api/experiment/responses', body, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_replay_events(self):
+        # Counters recomputed from gzipped NDJSON and CSV logs
+        code = str(self.campaign.code)
+        with tempfile.TemporaryDirectory() as directory:
+            ndjson = os.path.join(directory, 'events.ndjson.gz')
+            with gzip.open(ndjson, 'wt') as f:
+                for i in range(25):
+                    f.write(json.dumps({
+                        'campaign_code': code,
+                        'variant_code': 'AB'[i % 2],
+                        'register_impression': True,
+                        'register_conversion': i % 5 == 0,
+                    }) + '\n')
+            csv = os.path.join(directory, 'events.csv.gz')
+            with gzip.open(csv, 'wt') as f:
+                f.write('campaign_code,variant_code,register_impression,register_conversion\n')
+                f.write(f'{code.upper()},C,true,false\n')
+                f.write(f'{code},C,1,1\n')
+                f.write(f'{code},Z,1,0\n')
+                f.write(f'{uuid.uuid4()},A,1,0\n')
+            out = StringIO()
+            call_command('replay_events', ndjson, csv, chunksize=10, stdout=out)
+        variants = {v.code: v for v in self.campaign.variants.all()}
+        self.assertEqual(variants['A'].impressions, 13)
+        self.assertEqual(variants['A'].conversions, 3)
+        self.assertEqual(variants['B'].impressions, 12)
+        self.assertEqual(variants['B'].conversions, 2)
+        self.assertEqual(variants['C'].impressions, 2)
+        self.assertEqual(variants['C'].conversion_rate, 0.5)
+        self.assertIn('2 events of unknown campaigns or variants skipped', out.getvalue())
+        self.assertIn('25 events read', out.getvalue())
+
+    def test_replay_events_dedup(self):
+        # First impression / conversion per visitor without repeats
+        self.campaign.allow_repeat = False
+        self.campaign.save()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.csv')
+            with open(path, 'w') as f:
+                f.write('campaign_code,variant_code,register_impression,register_conversion,visitor_id\n')
+                for visitor in ['v1', 'v1', 'v2', 'v1', 'v3', 'v2', 'v4']:
+                    f.write(f'{self.campaign.code},A,true,{visitor != "v3"},{visitor}\n')
+            # Repeats within and across chunks
+            call_command('replay_events', path, add=True, chunksize=3, stdout=StringIO())
+        variant = Variant.objects.get(campaign=self.campaign, code='A')
+        self.assertEqual(variant.impressions, 5)
+        self.assertEqual(variant.conversions, 4)
+
+    def test_bloom_filter(self):
+        # No false negatives, false positives close to the error rate
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        self.assertGreater(sum(bloom.add(f'seen-{i}') for i in range(10000)), 9800)
+        self.assertTrue(all(f'seen-{i}' in bloom for i in range(10000)))
+        false_positives = sum(f'unseen-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom.approx_len(), 10000, delta=500)
+
+    def test_rotating_bloom_filter(self):
+        # Visitors of the last two generations are remembered
+        bloom = RotatingBloomFilter(capacity=100)
+        for i in range(150):
+            self.assertTrue(bloom.add(f'visitor-{i}'))
+        self.assertEqual(bloom.generation, 1)
+        self.assertFalse(bloom.add('visitor-0'))
+        for i in range(150, 200):
+            bloom.add(f'visitor-{i}')
+        self.assertEqual(bloom.generation, 2)
+        self.assertTrue(bloom.add('visitor-10'))
+
+    def test_bloom_filter_saved(self):
+        # Filters of several processes are merged through the file
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'campaign.npz')
+            first = RotatingBloomFilter(capacity=1000, path=path)
+            second = RotatingBloomFilter(capacity=1000, path=path)
+            first.add('visitor-1')
+            second.add('visitor-2')
+            first.save()
+            second.save()
+            restarted = RotatingBloomFilter(capacity=1000, path=path)
+            self.assertIn('visitor-1', restarted)
+            self.assertIn('visitor-2', restarted)
+            self.assertIn('visitor-1', second)
+            # Other settings, starts empty
+            resized = RotatingBloomFilter(capacity=5000, path=path)
+            self.assertNotIn('visitor-1', resized)
+
+    def test_bloom_filter_concurrent_saves(self):
+        # Savers hold the file lock, no visitors are overwritten
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'campaign.npz')
+            blooms = [RotatingBloomFilter(capacity=1000, path=path) for _ in range(4)]
+            for i, bloom in enumerate(blooms):
+                bloom.add(f'visitor-{i}')
+            threads = [threading.Thread(target=bloom.save) for bloom in blooms]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            restarted = RotatingBloomFilter(capacity=1000, path=path)
+            for i in range(4):
+                self.assertIn(f'visitor-{i}', restarted)
+
+    def test_bulk_increment(self):
+        # Deltas for several variants are applied in a single statement
+        with self.assertNumQueries(1):
+            updated = bulk_increment({
+                (self.campaign.pk, 'A'): (9, 4),
+                (self.campaign.pk, 'B'): (1, 0),
+            })
+        variant_vals = {
+            v['code']: v for v in self.campaign.variants.all().values()
+        }
+        self.assertEqual(updated, 2)
+        self.assertEqual(variant_vals['A']['impressions'], 10)
+        self.assertEqual(variant_vals['A']['conversions'], 5)
+        self.assertEqual(variant_vals['A']['conversion_rate'], 0.5)
+        self.assertEqual(variant_vals['B']['impressions'], 2)
+        self.assertEqual(variant_vals['C']['impressions'], 1)
+
+    def test_event_buffer(self):
+        # Events are coalesced and flushed once max_events is reached
+        event_buffer = EventBuffer(max_events=3, flush_interval=60, background=False)
+        event_buffer.add(self.campaign.pk, 'A', impressions=1)
+        event_buffer.add(self.campaign.pk, 'A', impressions=1, conversions=1)
+        self.assertEqual(len(event_buffer), 2)
+        self.assertEqual(Variant.objects.get(campaign=self.campaign, code='A').impressions, 1)
+        with self.assertNumQueries(1):
+            event_buffer.add(self.campaign.pk, 'B', impressions=1)
+        self.assertEqual(len(event_buffer), 0)
+        self.assertEqual(Variant.objects.get(campaign=self.campaign, code='A').impressions, 3)
+        self.assertEqual(Variant.objects.get(campaign=self.campaign, code='B').impressions, 2)
+
+    def test_record_response_buffered(self):
+        # Buffered responses are checked against the cached snapshot
+        event_buffer = EventBuffer(max_events=100, flush_interval=60, background=False)
+        with mock.patch('abtest.buffer.get_buffer', return_value=event_buffer):
+            get_variant_values(self.campaign)
+            with self.assertNumQueries(0):
+                self.assertTrue(record_response(self.campaign, 'A', impressions=1))
+            self.assertFalse(record_response(self.campaign, 'Z', impressions=1))
+        self.assertEqual(len(event_buffer), 1)
+
+    def test_event_buffer_at_least_once(self):
+        # Failed flushes are retried in at-least-once mode only
+        for mode, remaining in [('at-least-once', 1), ('bounded-loss', 0)]:
+            event_buffer = EventBuffer(
+                max_events=10, flush_interval=60, mode=mode, background=False
+            )
+            event_buffer.add(self.campaign.pk, 'A', impressions=1)
+            with mock.patch('abtest.buffer.bulk_increment', side_effect=Exception):
+                event_buffer.flush()
+            self.assertEqual(len(event_buffer), remaining)
+
+    @override_settings(ABTEST_COUNTER_SHARDS=4)
+    def test_counter_shards(self):
+        # Increments land on shard rows and are included on read
+        for i in range(3):
+            increment_variant(self.campaign, 'A', impressions=1, conversions=i%2)
+        self.assertEqual(increment_variant(self.campaign, 'Z', impressions=1), 0)
+        variant = Variant.objects.get(campaign=self.campaign, code='A')
+        self.assertEqual(variant.impressions, 1)
+        self.assertEqual(VariantCounterShard.objects.filter(variant=variant).count(), 1)
+        variant_vals = variant_values(self.campaign)
+        self.assertEqual(variant_vals[0]['impressions'], 4)
+        self.assertEqual(variant_vals[0]['conversions'], 2)
+
+        # Shard totals are folded into the variant
+        self.assertEqual(materialize_shards(), 1)
+        variant = Variant.objects.get(campaign=self.campaign, code='A')
+        self.assertEqual(variant.impressions, 4)
+        self.assertEqual(variant.conversions, 2)
+        self.assertEqual(variant_values(self.campaign)[0]['impressions'], 4)
+
+
+class SnapshotTests(TestCase):
+
+    ''' Test cases for the cached campaign / variant snapshots
+    '''
+    campaign = None
+
+    def setUp(self):
+
+        self.campaign, created = Campaign.objects.get_or_create(
+            name="Test Homepage",
+            description="Testing Homepage designs"    
+        )
+        for code in ['A', 'B', 'C']:
+            variant, created = Variant.objects.get_or_create(
+                campaign=self.campaign,
+                code=code,
+                name=f'Homepage Design {code}',
+                html_template=f'abtest/homepage_{code}.html'
+            )
+
+    def test_get_campaign(self):
+
+        self.assertEqual(get_campaign(name="Test Homepage"), self.campaign)
+        with self.assertNumQueries(0):
+            campaign = get_campaign(name="Test Homepage")
+        self.assertEqual(campaign, self.campaign)
+
+    def test_get_variant_values(self):
+        # Snapshot is cached until counters are flushed
+        self.assertEqual(len(get_variant_values(self.campaign)), 3)
+        with self.assertNumQueries(0):
+            get_variant_values(self.campaign)
+
+        event_buffer = EventBuffer(max_events=1, background=False)
+        event_buffer.add(self.campaign.pk, 'A', impressions=1)
+        self.assertEqual(get_variant_values(self.campaign)[0]['impressions'], 2)
+
+    @override_settings(ABTEST_SNAPSHOT_TTL=0)
+    def test_snapshot_disabled(self):
+
+        get_variant_values(self.campaign)
+        with self.assertNumQueries(1):
+            get_variant_values(self.campaign)
+
+
+class RngTests(TestCase):
+
+    ''' Test cases for the per-process random number generators
+    '''
+
+    def tearDown(self):
+        rng.seed(None)
+
+    def test_seed(self):
+        variant_vals = [
+            {'code': code, 'impressions': 10, 'conversions': 5, 'conversion_rate': 0.5}
+            for code in ['A', 'B', 'C']
+        ]
+        draws = []
+        for _ in range(2):
+            rng.seed(7)
+            draws.append((
+                rng.get_rng().random(5).tolist(),
+                [epsilon_greedy(variant_vals, eps=0.5)['code'] for _ in range(50)],
+                [thompson_sampling(variant_vals)['code'] for _ in range(50)],
+            ))
+        self.assertEqual(draws[0], draws[1])
+
+    def test_worker_streams(self):
+        # Workers draw from independent, reproducible streams
+        streams = []
+        for index in [1, 2, 1]:
+            rng.init_worker(index)
+            streams.append(rng.get_rng().random(3).tolist())
+        self.assertNotEqual(streams[0], streams[1])
+        with override_settings(ABTEST_RNG_SEED=11):
+            rng.init_worker(1)
+            first = rng.get_rng().random(3).tolist()
+            rng.init_worker(1)
+            self.assertEqual(rng.get_rng().random(3).tolist(), first)
+
+    def test_random_buffer(self):
+        buffer = rng.RandomBuffer(np.random.default_rng(3), size=4)
+        values = [buffer.random() for _ in range(10)]
+        expected = np.random.default_rng(3)
+        self.assertEqual(values, np.concatenate([expected.random(4) for _ in range(3)])[:10].tolist())
+        self.assertTrue(all(0 <= buffer.integers(3) < 3 for _ in range(100)))
+
@@ -0,0 +1,66 @@
+""" The tokens module contains the signed response tokens of stateless
+assignment, see ``utils.ab_assign``.
+
+A token carries the campaign code, the assigned variant code and the
+visitor id, signed with ``SECRET_KEY`` and timestamped. The response API
+verifies the token instead of reading the assignment from the session, so
+a beacon sent with a token needs neither a session read nor a write.
+Tokens expire after ``ABTEST_TOKEN_MAX_AGE`` seconds.
+
+Campaigns that do not allow repeated impressions and conversions count
+the first impression and conversion of each visitor only. Without the
+session these are remembered in the Bloom filters of the ``dedup``
+module, see ``first_response``.
+"""
+
+from django.conf import settings
+from django.core import signing
+from .dedup import get_filter
+
+SALT = 'abtest.response'
+
+
+def issue_token(campaign_code, variant_code, visitor_id):
+    """ Signed response token of a variant assigned to a visitor.
+
+    Examples
+    --------
+    >>> token = issue_token(campaign.code, 'B', 'visitor-42')
+    >>> read_token(token)
+    {'c': '...', 'v': 'B', 'u': 'visitor-42'}
+    """
+    return signing.dumps(
+        {'c': str(campaign_code), 'v': str(variant_code), 'u': str(visitor_id)},
+        salt=SALT,
+    )
+
+def read_token(token):
+    """ Returns the contents of a response token, a mapping of ``c`` to
+    the campaign code, ``v`` to the variant code and ``u`` to the visitor
+    id.
+
+    Raises
+    ------
+    :obj:`django.core.signing.BadSignature`
+        If the signature of the token is invalid, or
+        :obj:`django.core.signing.SignatureExpired` if the token is older
+        than ``ABTEST_TOKEN_MAX_AGE`` seconds.
+    """
+    data = signing.loads(
+        token,
+        salt=SALT,
+        max_age=getattr(settings, 'ABTEST_TOKEN_MAX_AGE', 60 * 60 * 24),
+    )
+    if not isinstance(data, dict) or not {'c', 'v', 'u'} <= set(data):
+        raise signing.BadSignature('Invalid response token')
+    return data
+
+def first_response(campaign_code, visitor_id, kind):
+    """ True if no response of ``kind`` (``'i'`` for impressions, ``'c'``
+    for conversions) was seen from the visitor for the campaign, see the
+    ``dedup`` module. Always True if ``ABTEST_DEDUP_CAPACITY`` is 0.
+    """
+    bloom = get_filter(campaign_code)
+    if bloom is None:
+        return True
+    return bloom.add(f'{kind}:{visitor_id}')
@@ -7,6 +7,10 @@ urlpatterns = [
     path('clear_stats', clear_stats, name='clear_stats'),
     path('simulation', simulation, name='simulation'),
     path('api/experiment/response', ABResponse.as_view(), name='ABResponse'),
+    path('api/experiment/responses', BatchResponseAPI.as_view(), name='BatchResponse'),
     path('api/experiment/simulation', RunSimulation.as_view(), name='RunSimulation'),
+    path('api/experiment/simulation/stream', StreamSimulation.as_view(), name='StreamSimulation'),
     path('api/sim_page_views', SimPageVisitsAPI.as_view(), name= 'SimPageVisits'),
+    path('api/experiment/assign_batch', AssignBatchAPI.as_view(), name='AssignBatch'),
+    path('api/jobs/<uuid:job_id>', JobStatusAPI.as_view(), name='JobStatus'),
 ]
\ No newline at end of file
@@ -3,15 +3,50 @@ for Bayesian A/B testing. Contains functions for various explore-exploit
 algorithms as well as for decision rules.
 """
 
+import bisect
+import hashlib
 import numpy as np
-import random
 import scipy.stats
 import json
+from django.conf import settings
 from .models import Campaign, Variant
-from scipy.special import betaln
+from .counters import bulk_increment, counters_flushed, variant_values
+from .memo import LRUCache
+from .pool import get_pool
+from .posterior import beta_params, posterior_params
+from .middleware import get_visitor
+from .tokens import issue_token
+from .rng import get_buffer, get_rng
+from .snapshot import get_variant_values
+from scipy.special import (betainc, betaincinv, betaln, logsumexp,
+                           xlog1py, xlogy)
+
+
+# Crossover between the exact series and quadrature for the auto
+# decision rule method, see bench_decision_rules.py
+AUTO_EXACT_MAX_TERMS = 10000
+QUAD_NODES = 64
+
+# Exact P(X>Y) values are updated from a cached value of nearby posterior
+# parameters with at most INCREMENTAL_MAX_STEPS recurrence steps, and
+# recomputed from the series after INCREMENTAL_MAX_CHAIN updates in a row
+INCREMENTAL_MAX_STEPS = 5000
+INCREMENTAL_MAX_CHAIN = 20
+
+# Simulated page visits update the in-memory bandit at most
+# SIM_MAX_ROUNDS times, see simulate_visits
+SIM_MAX_ROUNDS = 1000
+
+# Decision rule results and beta PDF curves keyed on posterior parameters
+_h_cache = LRUCache(getattr(settings, 'ABTEST_DECISION_CACHE_SIZE', 4096))
+_rule_cache = LRUCache(getattr(settings, 'ABTEST_DECISION_CACHE_SIZE', 4096))
+
+# Allocation tables of stateless assignment, keyed on (campaign, algo, eps)
+_allocation_tables = {}
 
 def ab_assign(request, campaign, default_template, 
-            sticky_session=True, algo='thompson', eps=0.1):
+            sticky_session=True, algo='thompson', eps=0.1, rng=None,
+            stateless=None, visitor_id=None):
 
     """ Main function for A/B testing. Used in Django Views.
     Determines the HTML template to serve for a given request
@@ -50,6 +85,23 @@ def ab_assign(request, campaign, default_template,
     eps : float, optional
         Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
         Only applicable to ``egreedy`` algorithm option. Defaults to 0.1
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the assignment. Defaults to the 
+        generator of the current process, see the ``rng`` module, or 
+        with ``ABTEST_THOMPSON_POOL_SIZE`` set, to the pre-drawn winners
+        of the ``pool`` module for ``thompson``.
+    stateless : bool, optional
+        If True, the session is neither read nor written. The variant is
+        derived from a hash of the visitor id and the allocation table of
+        the campaign (see ``assign_visitor``), and the visitor id and 
+        sticky assignments are kept in a signed cookie (see the 
+        ``middleware`` module). The returned values include a signed
+        ``token`` for the response API, see the ``tokens`` module. 
+        ``rng`` is not used. Defaults to the ``ABTEST_STATELESS_ASSIGNMENT``
+        setting
+    visitor_id : str, optional
+        Visitor id of stateless assignment, i.e. the id of a logged in
+        user. Defaults to the visitor id of the cookie
 
     Returns
     -------
@@ -76,13 +128,15 @@ def ab_assign(request, campaign, default_template,
         'html_template':'abtest/homepage_A.html'
     }
     """
-    variants = campaign.variants.all().values(
-        'code',
-        'impressions',
-        'conversions',
-        'conversion_rate',
-        'html_template',
-    ) 
+    # Cached snapshot of variant values, see snapshot module
+    variants = get_variant_values(campaign)
+
+    if stateless is None:
+        stateless = getattr(settings, 'ABTEST_STATELESS_ASSIGNMENT', False)
+    if stateless:
+        return _assign_stateless(
+            request, campaign, variants, sticky_session, algo, eps, visitor_id
+        )
 
     # Sticky sessions - User gets previously assigned template
     campaign_code = str(campaign.code)
@@ -97,13 +151,19 @@ def ab_assign(request, campaign, default_template,
         }
 
     if algo == 'thompson':
-        assigned_variant = thompson_sampling(variants)
+        # Pre-drawn winners, if ABTEST_THOMPSON_POOL_SIZE is set
+        pool = get_pool(campaign) if rng is None else None
+        if pool is not None:
+            assigned_variant = variants[pool.next(variants)]
+        else:
+            assigned_variant = thompson_sampling(variants, rng=rng)
     if algo == 'egreedy':
-        assigned_variant = epsilon_greedy(variants, eps=eps)
+        assigned_variant = epsilon_greedy(variants, eps=eps, rng=rng)
     if algo == 'UCB1':
-        assigned_variant = UCB1(variants)
+        assigned_variant = UCB1(variants, rng=rng)
     if algo == 'uniform':
-        assigned_variant = random.sample(list(variants), 1)[0]
+        variants = list(variants)
+        assigned_variant = variants[int((rng or get_buffer()).integers(len(variants)))]
 
     # Record assigned template in session variable
     request.session[campaign_code] = {
@@ -112,9 +172,85 @@ def ab_assign(request, campaign, default_template,
     }
     request.session.modified = True
 
-    return assigned_variant
+    # Copy, as the snapshot values are shared between requests
+    return dict(assigned_variant)
+
+def _assign_stateless(request, campaign, variants, sticky_session, algo,
+                      eps, visitor_id):
+    """ ``ab_assign`` without the session, see ``stateless``.
+    """
+    visitor = get_visitor(request)
+    visitor_id = visitor_id or visitor.id
+    campaign_code = str(campaign.code)
+    assigned_variant = None
+    if sticky_session:
+        code = visitor.assignments.get(campaign_code)
+        for var in variants:
+            if var['code'] == code:
+                assigned_variant = var
+
+    if assigned_variant is None:
+        assigned_variant = assign_visitor(
+            campaign, visitor_id, algo=algo, eps=eps, variants=variants
+        )
+        if sticky_session:
+            visitor.assign(campaign_code, assigned_variant['code'])
+    return {
+        **assigned_variant,
+        'token': issue_token(campaign_code, assigned_variant['code'], visitor_id),
+    }
+
+def ab_assign_batch(campaign, n=None, user_ids=None, algo='thompson', 
+            eps=0.1, rng=None):
+
+    """ Assign variants to many users / requests at once. Used for
+    server side rendering and email / push sends.
+
+    All assignments are drawn from the same posterior snapshot in one
+    vectorized pass (see ``assign_indices``), instead of calling the 
+    assignment algorithm once per user.
+
+    Parameters
+    ----------
+    campaign : :obj:`Campaign`
+        A/B test Campaign model object.
+    n : int, optional
+        Number of assignments to make. Required if ``user_ids`` is
+        not provided.
+    user_ids : list, optional
+        Identifiers of the users to assign variants to. One assignment
+        is made per user id, in the same order.
+    algo : str, optional
+        Choice of explore-exploit algorithms, ``thompson``, ``UCB1``,
+        ``uniform`` or ``egreedy``. Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Only applicable to ``egreedy`` algorithm option. Defaults to 0.1
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator to draw assignments with.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Array of assigned variant codes, of length ``n`` or
+        ``len(user_ids)``.
 
-def epsilon_greedy(variant_vals, eps=0.1):
+    Examples
+    --------
+    >>> campaign = Campaign.objects.get(name="Test Homepage")
+    ... ab_assign_batch(campaign, n=5, algo='thompson')
+    array(['B', 'C', 'C', 'B', 'C'], dtype='<U1')
+    """
+    if user_ids is not None:
+        n = len(user_ids)
+    if n is None:
+        raise ValueError('Either n or user_ids must be provided')
+
+    variants = get_variant_values(campaign)
+    codes = np.array([var['code'] for var in variants])
+    return codes[assign_indices(variants, n, algo=algo, eps=eps, rng=rng)]
+
+def epsilon_greedy(variant_vals, eps=0.1, rng=None):
     """Epsilon-greedy algorithm implementation 
     on Variant model values.
 
@@ -137,6 +273,9 @@ def epsilon_greedy(variant_vals, eps=0.1):
     eps : float
         Exploration parameter. Values between 0.0 and 1.0.
         Defaults to 0.1
+    rng : :obj:`numpy.random.Generator` or :obj:`RandomBuffer`, optional
+        Source of the uniform random numbers. Defaults to the buffer of
+        the current process, see ``rng.get_buffer``.
 
     Returns
     -------
@@ -147,10 +286,12 @@ def epsilon_greedy(variant_vals, eps=0.1):
 
     """
 
-    if random.random() < eps: 
+    rng = rng or get_buffer()
+    if rng.random() < eps: 
         # If random number < eps, exploration is chosen over 
         # exploitation
-        selected_variant = random.sample(list(variant_vals), 1)[0]
+        variant_vals = list(variant_vals)
+        selected_variant = variant_vals[int(rng.integers(len(variant_vals)))]
 
     else:
         # If random number >= eps, exploitation is chosen over
@@ -163,14 +304,18 @@ def epsilon_greedy(variant_vals, eps=0.1):
                 selected_variant = var
             if var['conversion_rate'] == best_conversion_rate:
                 # Break tie - randomly choose between current and best
-                selected_variant = random.sample([var, selected_variant], 1)[0]
+                selected_variant = (var, selected_variant)[int(rng.integers(2))]
 
     return selected_variant
 
-def thompson_sampling(variant_vals):
+def thompson_sampling(variant_vals, rng=None):
     """Thompson Sampling algorithm implementation 
     on Variant model values.
 
+    One sample is drawn from the beta posterior of every variant in a
+    single vectorized call, so campaigns with hundreds of variants are
+    handled without per-variant overhead.
+
     Parameters
     ----------
     variant_vals : list
@@ -187,6 +332,9 @@ def thompson_sampling(variant_vals):
                 'html_template'
             )            
 
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator to draw samples with.
+
     Returns
     -------
     selected_variant : dict
@@ -195,20 +343,12 @@ def thompson_sampling(variant_vals):
         algorithm
 
     """
-    selected_variant = None
-    best_sample = 0.0
-    for var in variant_vals:
-        sample = np.random.beta(
-            max(var['conversions'], 1), 
-            max(var['impressions'] - var['conversions'],1 )
-        )
-        if sample > best_sample:
-            best_sample = sample
-            selected_variant = var
+    variant_vals = list(variant_vals)
+    alpha, beta = posterior_params(variant_vals)
+    samples = (rng or get_rng()).beta(alpha, beta)
+    return variant_vals[int(np.argmax(samples))]
 
-    return selected_variant
-
-def UCB1(variant_vals):
+def UCB1(variant_vals, rng=None):
     """Upper Confidence Bound algorithm implementation 
     on Variant model values.
 
@@ -228,6 +368,10 @@ def UCB1(variant_vals):
                 'html_template'
             )            
 
+    rng : :obj:`numpy.random.Generator` or :obj:`RandomBuffer`, optional
+        Source of the uniform random numbers breaking ties. Defaults to 
+        the buffer of the current process, see ``rng.get_buffer``.
+
     Returns
     -------
     selected_variant : dict
@@ -236,6 +380,7 @@ def UCB1(variant_vals):
         algorithm
 
     """
+    rng = rng or get_buffer()
     selected_variant = None
     best_score = 0.0
     total_impressions = sum([ var['impressions'] for var in variant_vals ])
@@ -246,22 +391,370 @@ def UCB1(variant_vals):
             selected_variant = var
         if score == best_score:
             # Tie breaker
-            selected_variant = random.sample([var, selected_variant], 1)[0]
+            selected_variant = (var, selected_variant)[int(rng.integers(2))]
 
     return selected_variant
 
-def h(a, b, c, d):
+def assign_indices(variant_vals, n, algo='thompson', eps=0.1, rng=None):
+    """Vectorized implementation of the explore-exploit algorithms,
+    making ``n`` assignments from the same Variant model values.
+
+    Parameters
+    ----------
+    variant_vals : list
+        A list of dictionary mappings of Variant field values for
+        a given Campaign object. Required ``Variant`` fields are
+        ``impressions`` ``conversions`` ``conversion_rate``.
+    n : int
+        Number of assignments to make.
+    algo : str, optional
+        ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``.
+        Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Defaults to 0.1
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator to draw assignments with.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Array of ``n`` indexes into ``variant_vals``.
+
+    """
+    variant_vals = list(variant_vals)
+    return _assign_counts(
+        np.array([var['impressions'] for var in variant_vals]),
+        np.array([var['conversions'] for var in variant_vals]),
+        n, algo, eps, rng,
+    )
+
+def _assign_counts(impressions, conversions, n, algo='thompson', eps=0.1, rng=None):
+    """``assign_indices`` on arrays of impressions and conversions.
+    """
+    rng = rng or get_rng()
+    k = len(impressions)
+
+    if algo == 'thompson':
+        # (n x variants) matrix of posterior samples
+        alpha, beta = beta_params(impressions, conversions)
+        return rng.beta(alpha, beta, size=(n, k)).argmax(axis=1)
+    if algo == 'uniform':
+        return rng.integers(k, size=n)
+
+    # Break ties randomly between the best variants
+    best = _best_indices(impressions, conversions, algo)
+    indices = rng.choice(best, size=n)
+    if algo == 'egreedy':
+        explore = rng.random(n) < eps
+        indices[explore] = rng.integers(k, size=explore.sum())
+    return indices
+
+def _best_indices(impressions, conversions, algo):
+    """ Indices of the variants with the best score of the greedy
+    algorithms, ``UCB1`` or ``egreedy``.
+    """
+    rates = conversions / np.maximum(impressions, 1)
+    if algo == 'UCB1':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = rates + np.sqrt(2*np.log(impressions.sum())/impressions)
+        # Variants without impressions are explored first
+        scores = np.nan_to_num(scores, nan=np.inf)
+    elif algo == 'egreedy':
+        scores = rates
+    else:
+        raise ValueError(f'Invalid algorithm: {algo}')
+    return np.flatnonzero(scores == scores.max())
+
+def allocation_weights(variant_vals, algo='thompson', eps=0.1):
+    """Probability of each variant being assigned to a request by an
+    explore-exploit algorithm, given the Variant model values.
+
+    For ``thompson`` this is the probability of each variant being the
+    best, see ``decision_matrix``. The greedy algorithms split the 
+    assignments evenly between the best variants, ``egreedy`` after
+    ``eps`` of the assignments are spread evenly over all variants.
+
+    Parameters
+    ----------
+    variant_vals : list
+        A list of dictionary mappings of Variant field values for
+        a given Campaign object. Required ``Variant`` fields are
+        ``code`` ``impressions`` ``conversions``.
+    algo : str, optional
+        ``thompson``, ``UCB1``, ``uniform`` or ``egreedy``.
+        Defaults to *thompson*.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Defaults to 0.1
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+        Probabilities of the variants, summing to 1.
+    """
+    variant_vals = list(variant_vals)
+    k = len(variant_vals)
+    if algo == 'thompson':
+        weights = np.clip(decision_matrix(variant_vals)['p_best'], 0, None)
+    elif algo == 'uniform':
+        weights = np.ones(k)
+    else:
+        best = _best_indices(
+            np.array([var['impressions'] for var in variant_vals]),
+            np.array([var['conversions'] for var in variant_vals]),
+            algo,
+        )
+        weights = np.zeros(k)
+        weights[best] = 1 / len(best)
+        if algo == 'egreedy':
+            weights = (1 - eps) * weights + eps / k
+    return weights / weights.sum()
+
+def visitor_bucket(campaign_code, visitor_id):
+    """Uniform number in [0, 1) derived from a hash of the campaign code
+    and the visitor id. The same visitor gets the same bucket every time,
+    and the buckets of different campaigns are independent.
+    """
+    digest = hashlib.blake2b(
+        f'{campaign_code}:{visitor_id}'.encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, 'big') / 2**64
+
+def allocation_table(campaign, algo='thompson', eps=0.1, variants=None):
+    """Allocation table of a campaign, recomputed with 
+    ``allocation_weights`` whenever the snapshot of the variant values 
+    changes (see the snapshot module), and cached per process in between.
+
+    Returns
+    -------
+    variants : tuple
+        Snapshot of the variant values
+    cumulative : list of float
+        Cumulative allocation weights of the variants
+    """
+    if variants is None:
+        variants = get_variant_values(campaign)
+    key = (campaign.pk, algo, eps)
+    table = _allocation_tables.get(key)
+    if table is None or table[0] is not variants:
+        cumulative = np.cumsum(allocation_weights(variants, algo, eps)).tolist()
+        table = (variants, cumulative)
+        _allocation_tables[key] = table
+    return table
+
+def assign_visitor(campaign, visitor_id, algo='thompson', eps=0.1, variants=None):
+    """Deterministic assignment of a visitor to a variant, from the 
+    visitor's bucket (see ``visitor_bucket``) and the allocation table of
+    the campaign (see ``allocation_table``). The share of visitors 
+    assigned to each variant follows the explore-exploit algorithm, with
+    no state kept per visitor.
+
+    Returns
+    -------
+    dict
+        The Variant model values of the assigned variant.
+
+    Examples
+    --------
+    >>> campaign = Campaign.objects.get(name="Test Homepage")
+    ... assign_visitor(campaign, 'visitor-42')['code']
+    'B'
+    """
+    variants, cumulative = allocation_table(campaign, algo, eps, variants)
+    index = bisect.bisect_right(cumulative, visitor_bucket(campaign.code, visitor_id))
+    return variants[min(index, len(variants) - 1)]
+
+def _h_series(a, b, c, d):
+    """Sum of the ``c`` terms of the closed form series for P(Y>X),
+    X ~ Beta(a,b), Y ~ Beta(c,d), computed as a vectorized log-sum-exp.
+    """
+    if c <= 0:
+        return 0.0
+    j = np.arange(c)
+    log_terms = betaln(a+j, b+d) - np.log(d+j) - betaln(1+j, d) - betaln(a, b)
+    return np.exp(logsumexp(log_terms))
+
+def _beta_moments(a, b):
+    """Mean, variance, skewness and excess kurtosis of Beta(a,b).
+    """
+    mean = a / (a + b)
+    var = a * b / ((a + b)**2 * (a + b + 1))
+    skew = 2 * (b - a) * np.sqrt(a + b + 1) / ((a + b + 2) * np.sqrt(a * b))
+    kurt = 6 * ((a - b)**2 * (a + b + 1) - a * b * (a + b + 2)) / \
+           (a * b * (a + b + 2) * (a + b + 3))
+    return mean, var, skew, kurt
+
+def _normal_error(a, b, c, d):
+    """Estimated absolute error of the normal approximation of P(X>Y),
+    from the first Edgeworth correction terms of Z = X - Y with a safety
+    factor of 2. See ``bench_decision_rules.py``.
+    """
+    _, var_x, skew_x, kurt_x = _beta_moments(a, b)
+    _, var_y, skew_y, kurt_y = _beta_moments(c, d)
+    var = var_x + var_y
+    skew = (skew_x * var_x**1.5 - skew_y * var_y**1.5) / var**1.5
+    kurt = (kurt_x * var_x**2 + kurt_y * var_y**2) / var**2
+    return 0.8 * (abs(skew) / 6 + abs(kurt) / 24)
+
+def select_method(a, b, c, d, tol=1e-4):
+    """Cheapest decision rule method meeting an error tolerance.
+
+    In order of cost: the normal approximation (constant time) if its
+    estimated error is within ``tol``, the exact series if it has at most
+    ``AUTO_EXACT_MAX_TERMS`` terms, and Gauss-Legendre quadrature 
+    (constant time, error < 1e-10) otherwise. Monte Carlo is never selected,
+    as quadrature is both cheaper and more accurate for any tolerance.
+
+    Parameters
+    ----------
+    a, b, c, d : int
+        Shape parameters of X ~ Beta(a,b), Y ~ Beta(c,d)
+    tol : float, optional
+        Absolute error tolerance. Defaults to 1e-4
+
+    Returns
+    -------
+    str
+        ``normal``, ``exact`` or ``quad``
+    """
+    if _normal_error(a, b, c, d) <= tol:
+        return 'normal'
+    if min(a, b, c, d) <= AUTO_EXACT_MAX_TERMS:
+        return 'exact'
+    return 'quad'
+
+def _quad(a, b, c, d, integrand):
+    """Gauss-Legendre integral of ``f_X(x) * integrand(x)`` where
+    X ~ Beta(a,b), over the interval holding all but 1e-15 of the mass
+    of X at each end.
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(QUAD_NODES)
+    lo, hi = betaincinv(a, b, 1e-15), betaincinv(a, b, 1 - 1e-15)
+    x = 0.5 * (hi - lo) * nodes + 0.5 * (hi + lo)
+    log_pdf = xlogy(a - 1, x) + xlog1py(b - 1, -x) - betaln(a, b)
+    return 0.5 * (hi - lo) * np.sum(weights * np.exp(log_pdf) * integrand(x))
+
+def _h_exact(a, b, c, d):
+    n = min(a, b, c, d)
+    if c == n:
+        return 1 - _h_series(a, b, c, d)
+    if a == n:
+        # P(X>Y) = P(Y<X), series over a
+        return _h_series(c, d, a, b)
+    if d == n:
+        # 1-X ~ Beta(b,a), 1-Y ~ Beta(d,c), series over d
+        return _h_series(b, a, d, c)
+    return 1 - _h_series(d, c, b, a)
+
+def _h_walk(value, start, end):
+    """Update P(X>Y) from the parameters ``start`` to ``end`` with the
+    recurrences, for g(a,b,c,d) = B(a+c,b+d) / (B(a,b) B(c,d)):
+
+        h(a+1,b,c,d) = h(a,b,c,d) + g(a,b,c,d) / a
+        h(a,b+1,c,d) = h(a,b,c,d) - g(a,b,c,d) / b
+        h(a,b,c+1,d) = h(a,b,c,d) - g(a,b,c,d) / c
+        h(a,b,c,d+1) = h(a,b,c,d) + g(a,b,c,d) / d
+
+    The steps of each parameter are summed as one vectorized expression,
+    so the cost grows with the distance between ``start`` and ``end``
+    rather than with the counts.
+    """
+    params = list(start)
+    for i, sign in enumerate((1, -1, -1, 1)):
+        if params[i] == end[i]:
+            continue
+        direction = 1 if end[i] > params[i] else -1
+        steps = np.arange(min(params[i], end[i]), max(params[i], end[i]))
+        a, b, c, d = params[:i] + [steps] + params[i+1:]
+        terms = np.exp(betaln(a + c, b + d) - betaln(a, b) - betaln(c, d)) / steps
+        value += sign * direction * terms.sum()
+        params[i] = end[i]
+    return value
+
+def _h_cached(a, b, c, d):
+    """Exact P(X>Y), cached. On a cache miss the value is updated from
+    the cached value of the closest recently used parameters if that takes
+    fewer steps than the series has terms, i.e. when a few impressions /
+    conversions were added since the value was last computed.
+    """
+    key = (a, b, c, d)
+    cached = _h_cache.get(key)
+    if cached is not None:
+        return cached[0]
+
+    value, chain = None, 0
+    max_steps = min(INCREMENTAL_MAX_STEPS, min(key) // 2)
+    anchor = _h_cache.nearest(key, max_steps) if max_steps else None
+    if anchor is not None and anchor[1][1] < INCREMENTAL_MAX_CHAIN:
+        value, chain = _h_walk(anchor[1][0], anchor[0], key), anchor[1][1] + 1
+    if value is None:
+        value = _h_exact(a, b, c, d)
+    _h_cache.put(key, (value, chain))
+    return value
+
+def clear_decision_cache():
+    """Clear the cached decision rule results and beta PDF curves.
+    """
+    _h_cache.clear()
+    _rule_cache.clear()
+
+def _h_quad(a, b, c, d):
+    # Integrate over the narrower distribution, so that the CDF of the 
+    # other one is smooth over the interval
+    if _beta_moments(a, b)[1] > _beta_moments(c, d)[1]:
+        return 1 - _h_quad(c, d, a, b)
+    return _quad(a, b, c, d, lambda x: betainc(c, d, x))
+
+def _h_normal(a, b, c, d):
+    mean_x, var_x, _, _ = _beta_moments(a, b)
+    mean_y, var_y, _, _ = _beta_moments(c, d)
+    return scipy.stats.norm.cdf((mean_x - mean_y) / np.sqrt(var_x + var_y))
+
+def h(a, b, c, d, method='exact', tol=1e-4, samples=100000, rng=None, 
+      cache=True):
     """Closed form solution for P(X>Y).
     Where: 
 
     X ~ Beta(a,b), Y ~ Beta(c,d)  
 
+    The series is evaluated as a vectorized log-sum-exp, which is stable
+    for million-scale counts. The number of terms is the smallest of the
+    four parameters, using the symmetries P(X>Y) = 1 - P(Y>X) and
+    P(X>Y) = P(1-Y > 1-X). As the series is O(min(a,b,c,d)), faster
+    approximate methods are available for large counts.
+
     Parameters
     ----------
     a : int
-        alpha shape parameter for the beta distribution. a > 0
+        alpha shape parameter for the beta distribution of X. a > 0
     b : int
-        beta shape parameter for the beta distribution. b > 0
+        beta shape parameter for the beta distribution of X. b > 0
+    c : int
+        alpha shape parameter for the beta distribution of Y. c > 0
+    d : int
+        beta shape parameter for the beta distribution of Y. d > 0
+    method : str, optional
+        Method used to compute the probability:
+
+            * *exact* : Closed form series
+            * *normal* : Normal approximation of X and Y
+            * *quad* : Gauss-Legendre numerical integration
+            * *mc* : Monte Carlo estimate from ``samples`` draws
+            * *auto* : Cheapest method meeting the error tolerance ``tol``, see ``select_method``
+
+        Defaults to *exact*.
+    tol : float, optional
+        Absolute error tolerance for the *auto* method. Defaults to 1e-4
+    samples : int, optional
+        Number of samples for the *mc* method. Defaults to 100000
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the *mc* method.
+    cache : bool, optional
+        If True, results of the deterministic methods are cached in a 
+        least recently used cache keyed on ``(a, b, c, d)``, and exact 
+        results for parameters close to a cached entry are updated from
+        it incrementally. Defaults to True
 
     Returns
     -------
@@ -273,12 +766,25 @@ def h(a, b, c, d):
     https://www.chrisstucchio.com/blog/2014/bayesian_ab_decision_rule.html
  
     """
-    total = 0.0 
-    for j in range(c):
-        total += np.exp(betaln(a+j, b+d) - np.log(d+j) - betaln(1+j, d) - betaln(a, b))
-    return 1 - total
+    a, b, c, d = int(a), int(b), int(c), int(d)
+    if method == 'auto':
+        method = select_method(a, b, c, d, tol=tol)
+    if method == 'exact':
+        return _h_cached(a, b, c, d) if cache else _h_exact(a, b, c, d)
+    if method in ('normal', 'quad'):
+        compute = _h_normal if method == 'normal' else _h_quad
+        if not cache:
+            return compute(a, b, c, d)
+        return _rule_cache.get_or_set(
+            ('h', method, a, b, c, d), lambda: compute(a, b, c, d)
+        )
+    if method == 'mc':
+        rng = rng or get_rng()
+        return np.mean(rng.beta(a, b, samples) > rng.beta(c, d, samples))
+    raise ValueError(f'Invalid method: {method}')
 
-def loss(a, b, c, d):
+def loss(a, b, c, d, method='exact', tol=1e-4, samples=100000, rng=None,
+         cache=True):
     """Expected loss function built on P(X>Y)
     Where:
     
@@ -287,9 +793,25 @@ def loss(a, b, c, d):
     Parameters
     ----------
     a : int
-        alpha shape parameter for the beta distribution. a > 0
+        alpha shape parameter for the beta distribution of X. a > 0
     b : int
-        beta shape parameter for the beta distribution. b > 0
+        beta shape parameter for the beta distribution of X. b > 0
+    c : int
+        alpha shape parameter for the beta distribution of Y. c > 0
+    d : int
+        beta shape parameter for the beta distribution of Y. d > 0
+    method : str, optional
+        *exact*, *normal*, *quad*, *mc* or *auto*. See ``h``.
+        Defaults to *exact*.
+    tol : float, optional
+        Absolute error tolerance for the *auto* method. Defaults to 1e-4
+    samples : int, optional
+        Number of samples for the *mc* method. Defaults to 100000
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the *mc* method.
+    cache : bool, optional
+        If True, results of the deterministic methods are cached. See ``h``.
+        Defaults to True
 
     Returns
     -------
@@ -304,16 +826,223 @@ def loss(a, b, c, d):
         https://cdn2.hubspot.net/hubfs/310840/VWO_SmartStats_technical_whitepaper.pdf
  
     """
-    return np.exp(betaln(a+1,b)-betaln(a,b))*h(a+1,b,c,d) - \
-           np.exp(betaln(c+1,d)-betaln(c,d))*h(a,b,c+1,d)
+    a, b, c, d = int(a), int(b), int(c), int(d)
+    if method == 'auto':
+        method = select_method(a, b, c, d, tol=tol)
+    if method == 'mc':
+        rng = rng or get_rng()
+        return np.mean(np.maximum(rng.beta(a, b, samples) - rng.beta(c, d, samples), 0))
+    if not cache:
+        return _loss(a, b, c, d, method, cache=False)
+    return _rule_cache.get_or_set(
+        ('loss', method, a, b, c, d), lambda: _loss(a, b, c, d, method)
+    )
+
+def _loss(a, b, c, d, method, cache=True):
+    if method == 'normal':
+        # E[max(Z, 0)] for Z = X - Y ~ N(mean, var)
+        mean_x, var_x, _, _ = _beta_moments(a, b)
+        mean_y, var_y, _, _ = _beta_moments(c, d)
+        mean, sd = mean_x - mean_y, np.sqrt(var_x + var_y)
+        return mean * scipy.stats.norm.cdf(mean / sd) + \
+               sd * scipy.stats.norm.pdf(mean / sd)
+    if method == 'quad':
+        # Integrate over the narrower distribution, as in _h_quad, with
+        # loss(X,Y) = loss(Y,X) + E[X] - E[Y]
+        if _beta_moments(a, b)[1] > _beta_moments(c, d)[1]:
+            return _loss(c, d, a, b, method) + a / (a + b) - c / (c + d)
+        # E[max(X - Y, 0)] = integral of f_X(x) * E[(x - Y) 1{Y < x}]
+        return _quad(a, b, c, d, lambda x: 
+            x * betainc(c, d, x) - c / (c + d) * betainc(c + 1, d, x)
+        )
+    if method == 'exact':
+        return np.exp(betaln(a+1,b)-betaln(a,b))*h(a+1,b,c,d, cache=cache) - \
+               np.exp(betaln(c+1,d)-betaln(c,d))*h(a,b,c+1,d, cache=cache)
+    raise ValueError(f'Invalid method: {method}')
 
 
-def sim_page_visits(campaign, n, conversion_rates, algo='thompson', eps=0.1, ):
+def decision_matrix(variant_vals, nodes=32, cache=True):
+    """Decision rules for any number of variants, computed in one
+    batched numerical integration.
+
+    Computes the full matrix of pairwise probabilities P(X>Y), the matrix
+    of pairwise expected losses ``loss(X, Y)``, the probability of each 
+    variant being the best, and the expected loss of choosing each variant
+    (the expected difference between the best conversion rate and the
+    variant's conversion rate).
+
+    All quantities are integrals of beta PDFs and CDFs, evaluated on one
+    shared composite Gauss-Legendre grid. The grid is split at the 1e-15 
+    and 1-1e-15 quantiles of every variant, so that the posterior mass of
+    even the narrowest variant is resolved. The pairwise matrices are
+    full matrix products of the PDF and CDF arrays: for the number of
+    variants of a campaign, one BLAS product of all pairs is cheaper than
+    gathering the upper triangle pairs and deriving the lower triangle
+    with P(Y>X) = 1 - P(X>Y).
+
+    Parameters
+    ----------
+    variant_vals : list
+        A list of dictionary mappings of Variant field values for
+        a given Campaign object. Required ``Variant`` fields are
+        ``code`` ``impressions`` ``conversions``.
+    nodes : int, optional
+        Number of Gauss-Legendre nodes per grid interval. Defaults to 32
+    cache : bool, optional
+        If True, the result is cached keyed on the posterior parameters of
+        all variants, and the returned arrays are read-only. Defaults to True
+
+    Returns
+    -------
+    dict
+        The key-value pairs returned are:
+
+            * ``codes`` : List of variant codes, in the order of ``variant_vals``
+            * ``prob`` : K x K array, P(X>Y) for X in rows and Y in columns. The diagonal is NaN
+            * ``loss`` : K x K array, ``loss(X, Y)`` for X in rows and Y in columns
+            * ``p_best`` : Array of the probability of each variant being the best
+            * ``expected_loss`` : Array of the expected loss of choosing each variant
+
+    Examples
+    --------
+    >>> decision_matrix(campaign.variants.all().values(
+    ...     'code', 'impressions', 'conversions'
+    ... ))['p_best']
+    array([0.0134..., 0.8027..., 0.1838...])
+    """
+    variant_vals = list(variant_vals)
+    alpha, beta = posterior_params(variant_vals)
+    codes = [var['code'] for var in variant_vals]
+    if not cache:
+        return dict(_decision_matrix(alpha, beta, nodes), codes=codes)
+
+    key = ('matrix', nodes, tuple(alpha.tolist()), tuple(beta.tolist()))
+    return dict(
+        _rule_cache.get_or_set(key, lambda: _read_only(_decision_matrix(alpha, beta, nodes))),
+        codes=codes,
+    )
+
+def _read_only(arrays):
+    for array in arrays.values():
+        array.setflags(write=False)
+    return arrays
+
+def _decision_matrix(alpha, beta, nodes):
+    alpha, beta = alpha.astype(float), beta.astype(float)
+    mean = alpha / (alpha + beta)
+
+    # Composite grid split at the quantile bounds of every variant
+    bounds = np.unique(np.concatenate([
+        betaincinv(alpha, beta, 1e-15), 
+        betaincinv(alpha, beta, 1 - 1e-15),
+    ]))
+    lo, hi = bounds[:-1], bounds[1:]
+    points, weights = np.polynomial.legendre.leggauss(nodes)
+    x = (0.5 * (hi - lo)[:, None] * points + 0.5 * (hi + lo)[:, None]).ravel()
+    w = (0.5 * (hi - lo)[:, None] * weights).ravel()
+
+    # (variants x grid) arrays
+    a, b = alpha[:, None], beta[:, None]
+    weighted_pdf = w * np.exp(xlogy(a - 1, x) + xlog1py(b - 1, -x) - betaln(a, b))
+    cdf = betainc(a, b, x)
+
+    prob = weighted_pdf @ cdf.T
+    pairwise_loss = weighted_pdf @ (x * cdf).T - \
+        (weighted_pdf @ betainc(a + 1, b, x).T) * mean
+    np.fill_diagonal(prob, np.nan)
+    np.fill_diagonal(pairwise_loss, 0.0)
+
+    # Product of the CDFs of all other variants, from prefix / suffix 
+    # products so that no division by a zero CDF is needed
+    ones = np.ones((1, len(x)))
+    prefix = np.cumprod(np.vstack([ones, cdf[:-1]]), axis=0)
+    suffix = np.cumprod(np.vstack([cdf[1:], ones])[::-1], axis=0)[::-1]
+    others = prefix * suffix
+
+    p_best = (weighted_pdf * others).sum(axis=1)
+    expected_max = (weighted_pdf * x * others).sum()
+
+    return {
+        'prob': prob,
+        'loss': pairwise_loss,
+        'p_best': p_best,
+        'expected_loss': expected_max - mean,
+    }
+
+def simulate_visits(impressions, conversions, rates, n, algo='thompson', 
+                    eps=0.1, batch_size=None, rng=None):
+    """ In-memory simulation engine for page visits to a page that is
+    being A/B tested.
+
+    The bandit state is held in NumPy arrays of impressions / conversions.
+    Visits are simulated in rounds of ``batch_size`` visits: the variants
+    of all visits of a round are assigned in one vectorized draw from the
+    current state, conversions are drawn with the true ``rates`` and the
+    state is updated before the next round, as if the counts seen by the
+    assignment algorithm were refreshed every ``batch_size`` visits.
+
+    Parameters
+    ----------
+    impressions : array_like
+        Impressions of each variant at the start of the simulation
+    conversions : array_like
+        Conversions of each variant at the start of the simulation
+    rates : array_like
+        True conversion rate of each variant
+    n : int
+        Number of page visits to simulate.
+    algo : str, optional
+        ``thompson``, ``egreedy``, ``uniform`` or ``UCB1``.
+        Defaults to ``thompson``.
+    eps : float, optional
+        Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
+        Defaults to 0.1
+    batch_size : int, optional
+        Number of visits assigned from the same state. Defaults to
+        ``n / SIM_MAX_ROUNDS`` rounded up, i.e. at most 1000 rounds
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation.
+
+    Returns
+    -------
+    impressions : :obj:`numpy.ndarray`
+        Impressions of each variant at the end of the simulation
+    conversions : :obj:`numpy.ndarray`
+        Conversions of each variant at the end of the simulation
+
+    Examples
+    --------
+    >>> simulate_visits([0, 0], [0, 0], [0.1, 0.2], n=1000000)
+    (array([   498, 999502]), array([    41, 200496]))
+    """
+    rng = rng or get_rng()
+    impressions = np.array(impressions, dtype=np.int64)
+    conversions = np.array(conversions, dtype=np.int64)
+    rates = np.asarray(rates, dtype=float)
+    k = len(impressions)
+    batch_size = batch_size or max(1, -(-n // SIM_MAX_ROUNDS))
+
+    for start in range(0, n, batch_size):
+        m = min(batch_size, n - start)
+        indices = _assign_counts(impressions, conversions, m, algo, eps, rng)
+        converted = rng.random(m) < rates[indices]
+        impressions += np.bincount(indices, minlength=k)
+        conversions += np.bincount(indices[converted], minlength=k)
+
+    return impressions, conversions
+
+def sim_page_visits(campaign, n, conversion_rates, algo='thompson', eps=0.1, 
+                    batch_size=None, rng=None):
 
     """ Simulate `n` page visits to the page that is being A/B tested. 
     The probability of each simulated page visited generating a conversion
     is determined by the conversion rates provided in the `conversion_rates` param.
 
+    The simulation runs in memory with ``simulate_visits``, starting from
+    the current impressions / conversions of the variants. The simulated
+    impressions / conversions are then added to the variants with a single
+    bulk ``UPDATE``.
+
     Parameters
     ----------
     campaign : :obj:`Campaign`
@@ -333,6 +1062,11 @@ def sim_page_visits(campaign, n, conversion_rates, algo='thompson', eps=0.1, ):
     eps : float, optional
         Exploration parameter for the epsilon-greedy ``egreedy`` algorithm. 
         Only applicable to ``egreedy`` algorithm option. Defaults to 0.1
+    batch_size : int, optional
+        Number of visits assigned from the same impressions / conversions.
+        See ``simulate_visits``.
+    rng : :obj:`numpy.random.Generator`, optional
+        Random number generator for the simulation.
 
     
     Returns
@@ -356,33 +1090,24 @@ def sim_page_visits(campaign, n, conversion_rates, algo='thompson', eps=0.1, ):
 
     """
 
-    variants = campaign.variants.all().values(
-        'code',
-        "impressions",
-        'conversions',
-        'conversion_rate',
-        'html_template',
-    ) 
-    for i in range(n):
-        if algo == 'thompson':
-            assigned_variant = thompson_sampling(variants)
-        if algo == 'egreedy':
-            assigned_variant = epsilon_greedy(variants, eps=eps)
-        if algo == 'UCB1':
-            assigned_variant = UCB1(variants)
-        if algo == 'uniform':
-            assigned_variant = random.sample(list(variants), 1)[0]
-
-        # Simulate user conversion after version assigned
-        conversion_prob = conversion_rates.get(assigned_variant['code'], 0.5)
-        conversion = 1 if random.random() > 1 - conversion_prob else 0
-        variant = Variant.objects.get(
-            campaign=campaign, 
-            code=assigned_variant['code']
+    variant_vals = variant_values(campaign)
+    codes = [var['code'] for var in variant_vals]
+    impressions = np.array([var['impressions'] for var in variant_vals])
+    conversions = np.array([var['conversions'] for var in variant_vals])
+    rates = [conversion_rates.get(code, 0.5) for code in codes]
+
+    new_impressions, new_conversions = simulate_visits(
+        impressions, conversions, rates, n, 
+        algo=algo, eps=eps, batch_size=batch_size, rng=rng,
+    )
+    updated = bulk_increment({
+        (campaign.pk, code): (int(i), int(c))
+        for code, i, c in zip(
+            codes, new_impressions - impressions, new_conversions - conversions
         )
-        variant.impressions = variant.impressions + 1
-        variant.conversions = variant.conversions + conversion
-        variant.conversion_rate = variant.conversions / variant.impressions
-        variant.save()
+        if i
+    })
+    if updated:
+        counters_flushed.send(sender=Variant)
 
-    return True
\ No newline at end of file
+    return True
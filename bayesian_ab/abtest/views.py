@@ -1,8 +1,10 @@
 from django.shortcuts import render, redirect
-from .utils import ab_assign, h, sim_page_visits
-from .simulation import experiment
-from .models import Campaign, Variant
-import numpy as np
+from .utils import ab_assign, decision_matrix, sim_page_visits
+from .curves import curves
+from .simulation import compact_dataset, experiment
+from .models import Campaign, Variant, VariantCounterShard
+from .counters import variant_values
+from .snapshot import get_campaign
 import json
 import datetime
 
@@ -10,7 +12,7 @@ def homepage(request):
     ''' Homepage view where we test different versions
     of the html template
     ''' 
-    campaign = Campaign.objects.get(name="Test Homepage")
+    campaign = get_campaign(name="Test Homepage")
     assigned_variant = ab_assign(
         request=request,
         campaign=campaign,
@@ -35,16 +37,7 @@ def dashboard(request):
     ''' Demonstration dashboard for statistics on ab test
     '''
     campaign = Campaign.objects.get(name="Test Homepage")
-    variant_vals = list(campaign.variants.all().order_by('code').values(
-        'code',
-        'impressions',
-        'conversions',
-        'conversion_rate',
-        'html_template',
-    ))
-    x_vals = list(np.linspace(0,1,500))
-    xy_vals = []
-    max_y = 0
+    variant_vals = variant_values(campaign)
     N = 0 # Total number of page visits
     COLOUR_PALETTE = [
         '#66c2a5',
@@ -54,53 +47,31 @@ def dashboard(request):
         '#a6d854',
     ]
 
-    for i, variant in enumerate(campaign.variants.all().order_by('code')):
-        y_vals = variant.beta_pdf(x_vals)
-        variant_vals[i]['xy'] = list(zip(x_vals, y_vals))
+    # Beta PDF curves of all variants, on a grid narrowed to the 
+    # posterior mass once the counts are large
+    x_vals, y_vals = curves(
+        [max(variant['conversions'], 1) for variant in variant_vals],
+        [max(variant['impressions'] - variant['conversions'], 1) for variant in variant_vals],
+        adaptive=True,
+    )
+    x_vals = x_vals.tolist()
+    max_y = float(y_vals.max()) if len(variant_vals) else 0
+    for i, variant in enumerate(variant_vals):
+        variant_vals[i]['xy'] = list(zip(x_vals, y_vals[i].tolist()))
         variant_vals[i]['color'] = COLOUR_PALETTE[i%len(COLOUR_PALETTE)]
-        if max(y_vals) > max_y:
-            max_y = max(y_vals)
         N += variant_vals[i]['impressions'] 
 
     # Calculate pairwise probability of variant X conversion rate
-    # greater than variant Y conversion rate
-
-    h_ab = h(
-        variant_vals[0]['conversions'], 
-        variant_vals[0]['impressions'] - variant_vals[0]['conversions'],
-        variant_vals[1]['conversions'], 
-        variant_vals[1]['impressions'] - variant_vals[1]['conversions']
-    )
-    h_ac = h(
-        variant_vals[0]['conversions'], 
-        variant_vals[0]['impressions'] - variant_vals[0]['conversions'],
-        variant_vals[2]['conversions'], 
-        variant_vals[2]['impressions'] - variant_vals[2]['conversions']
-    )
-    h_ba = h(
-        variant_vals[1]['conversions'], 
-        variant_vals[1]['impressions'] - variant_vals[1]['conversions'],
-        variant_vals[0]['conversions'], 
-        variant_vals[0]['impressions'] - variant_vals[0]['conversions']
-    )
-    h_bc = h(
-        variant_vals[1]['conversions'], 
-        variant_vals[1]['impressions'] - variant_vals[1]['conversions'],
-        variant_vals[2]['conversions'], 
-        variant_vals[2]['impressions'] - variant_vals[2]['conversions']
-    )
-    h_ca = h(
-        variant_vals[2]['conversions'], 
-        variant_vals[2]['impressions'] - variant_vals[2]['conversions'],
-        variant_vals[0]['conversions'], 
-        variant_vals[0]['impressions'] - variant_vals[0]['conversions']
-    )
-    h_cb = h(
-        variant_vals[2]['conversions'], 
-        variant_vals[2]['impressions'] - variant_vals[2]['conversions'],
-        variant_vals[1]['conversions'], 
-        variant_vals[1]['impressions'] - variant_vals[1]['conversions']
-    )
+    # greater than variant Y conversion rate, the probability of each
+    # variant being the best and the expected loss of choosing it
+    decision = decision_matrix(variant_vals)
+    for i, variant in enumerate(variant_vals):
+        variant['p_best'] = float(decision['p_best'][i])
+        variant['expected_loss'] = float(decision['expected_loss'][i])
+        variant['prob'] = [
+            None if i == j else float(p)
+            for j, p in enumerate(decision['prob'][i])
+        ]
 
     context = {
         'campaign':campaign,
@@ -108,12 +79,6 @@ def dashboard(request):
         'x_vals': json.dumps(x_vals),
         'max_y':max_y,
         'N':N,
-        'h_ab':h_ab,
-        'h_ac':h_ac,
-        'h_ba':h_ba,
-        'h_bc':h_bc,
-        'h_ca':h_ca,
-        'h_cb':h_cb,
         'last_update': datetime.datetime.utcnow().strftime('%Y-%m-%d | %H:%M:%S')
     }
     return render(
@@ -131,6 +96,10 @@ def clear_stats(request):
         impressions=0,
         conversion_rate=0.0,
     )
+    VariantCounterShard.objects.all().update(
+        conversions=0,
+        impressions=0,
+    )
     return redirect(dashboard)
 
 def simulation(request):
@@ -141,9 +110,10 @@ def simulation(request):
         p3=0.65,
         N=10000, 
         algo="thompson", 
+        curves=False,
     )
     context = {
-        'dataset':json.dumps(dataset)
+        'dataset':json.dumps(compact_dataset(dataset))
     }
     return render(
         request,
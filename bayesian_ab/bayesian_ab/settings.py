@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'abtest.middleware.VisitorCookieMiddleware',
 ]
 
 ROOT_URLCONF = 'bayesian_ab.urls'
@@ -130,4 +131,79 @@ COLOUR_PALETTE = [
     '#8da0cb',
     '#e78ac3',
     '#a6d854',
-]
\ No newline at end of file
+]
+
+# A/B testing
+
+# Write-behind buffering of variant impressions / conversions.
+# Responses are coalesced in memory and written in one bulk UPDATE every
+# ABTEST_BUFFER_FLUSH_MS milliseconds or ABTEST_BUFFER_MAX_EVENTS events.
+# ABTEST_BUFFER_MODE is either 'bounded-loss' or 'at-least-once'
+ABTEST_BUFFER_ENABLED = False
+ABTEST_BUFFER_MAX_EVENTS = 500
+ABTEST_BUFFER_FLUSH_MS = 500
+ABTEST_BUFFER_MODE = 'bounded-loss'
+
+# Number of counter shard rows per variant. 0 disables sharding.
+# Shard totals are folded into the variants by the materialize_counters
+# management command. ABTEST_COUNTER_SHARD_BY is either 'pid' or 'random'
+ABTEST_COUNTER_SHARDS = 0
+ABTEST_COUNTER_SHARD_BY = 'pid'
+
+# Seconds for which campaigns and variant counts used for assignment are
+# cached per process. Bounds the staleness of counts seen by the bandit
+# algorithms. 0 disables the cache
+ABTEST_SNAPSHOT_TTL = 5.0
+
+# Number of decision rule results (P(X>Y), expected loss, decision
+# matrices) and beta PDF curves cached per process, keyed on the
+# posterior parameters. 0 disables the cache
+ABTEST_DECISION_CACHE_SIZE = 4096
+
+# Number of threads per process running simulation jobs submitted with
+# the async query parameter. ABTEST_JOBS_EAGER runs jobs in the request
+# that submitted them instead, i.e. for tests. Simulations of more than
+# ABTEST_SIM_SYNC_MAX_N visits always run as jobs, and cannot be streamed
+ABTEST_JOBS_WORKERS = 2
+ABTEST_JOBS_EAGER = False
+ABTEST_SIM_SYNC_MAX_N = 10000
+
+# Seed of the random number generators of the assignment algorithms and
+# simulations. Each worker process draws from its own stream spawned from
+# the seed. None seeds from fresh OS entropy. Uniform random numbers are
+# drawn in blocks of ABTEST_RNG_BUFFER_SIZE
+ABTEST_RNG_SEED = None
+ABTEST_RNG_BUFFER_SIZE = 4096
+
+# Number of Thompson sampling winners pre-drawn per campaign and process
+# from the cached variant snapshot, see abtest.pool. Redrawn in the
+# background when the snapshot changes. 0 draws on every assignment
+ABTEST_THOMPSON_POOL_SIZE = 0
+
+# Assign variants from a hash of the visitor id and the allocation table of
+# the campaign instead of the session, see abtest.middleware. The visitor
+# id and sticky assignments are kept in a signed cookie
+ABTEST_STATELESS_ASSIGNMENT = False
+ABTEST_COOKIE_NAME = 'abtest'
+ABTEST_COOKIE_MAX_AGE = 60 * 60 * 24 * 365
+
+# Lifetime in seconds of the signed response tokens returned by stateless
+# assignment, see abtest.tokens
+ABTEST_TOKEN_MAX_AGE = 60 * 60 * 24
+
+# Campaigns without allow_repeat count the first response of each visitor
+# posted with a token, remembered in a rotating Bloom filter per campaign
+# of two generations of ABTEST_DEDUP_CAPACITY visitors, see abtest.dedup.
+# 0 counts every response. Filters are saved to ABTEST_DEDUP_DIR every
+# ABTEST_DEDUP_SAVE_INTERVAL seconds, None keeps them in memory only. Set
+# it to a writable directory outside the source tree, i.e.
+# '/var/lib/abtest/dedup'. Workers merge their filters when saving, so a
+# repeat that reaches another worker within the save interval is counted
+# again
+ABTEST_DEDUP_CAPACITY = 1000000
+ABTEST_DEDUP_ERROR_RATE = 0.001
+ABTEST_DEDUP_DIR = None
+ABTEST_DEDUP_SAVE_INTERVAL = 60
+
+# Maximum number of responses per request to the batch responses API
+ABTEST_BATCH_MAX_EVENTS = 10000
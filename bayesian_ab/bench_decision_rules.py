@@ -0,0 +1,37 @@
+#Benchmark of the decision rule methods available for h() and loss()
+#Shows the time and absolute error of each method as the counts grow,
+#and the crossover points used by the 'auto' method. Results are not
+#cached, see the 'cache' parameter of h() and loss().
+#Usage: python bench_decision_rules.py
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bayesian_ab.settings")
+
+import django
+django.setup()
+
+import timeit
+from abtest.utils import h, loss, select_method
+
+METHODS = ['exact', 'normal', 'quad', 'mc']
+
+def bench(func, a, b, c, d):
+
+    reference = func(a, b, c, d, method='exact', cache=False)
+    row = []
+    for method in METHODS:
+        timer = timeit.Timer(lambda: func(a, b, c, d, method=method, cache=False))
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(repeat=3, number=number)) / number
+        error = abs(func(a, b, c, d, method=method, cache=False) - reference)
+        row.append(f'{seconds*1e3:9.3f}ms {error:8.1e}')
+    return row
+
+print(f'{"impressions":>12} {"method":>7} | ' + ' | '.join(f'{m:>19}' for m in METHODS))
+for func in [h, loss]:
+    print(func.__name__)
+    for n in [100, 1000, 10000, 100000, 1000000]:
+        # Two variants with conversion rates 10% and 10.5%
+        a, b = n // 10, n - n // 10
+        c, d = n // 10 + n // 200, n - n // 10 - n // 200
+        method = select_method(a, b, c, d)
+        print(f'{n:>12} {method:>7} | ' + ' | '.join(bench(func, a, b, c, d)))
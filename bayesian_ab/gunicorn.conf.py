@@ -0,0 +1,17 @@
+# gunicorn configuration, see docker-compose.yml
+# Usage: gunicorn -c gunicorn.conf.py bayesian_ab.wsgi:application
+
+def post_fork(server, worker):
+    # Give each worker its own random number stream, spawned from
+    # ABTEST_RNG_SEED, see abtest.rng
+    from abtest.rng import init_worker
+    init_worker(worker.age)
+
+def worker_exit(server, worker):
+    # Flush buffered variant impressions / conversions before the
+    # worker shuts down
+    from abtest.buffer import worker_exit
+    worker_exit(server, worker)
+    # Save the dedup filters of the worker, see abtest.dedup
+    from abtest import dedup
+    dedup.worker_exit(server, worker)